@@ -0,0 +1,788 @@
+"""A frozen copy of the portfolio selection as it was before the
+vectorized sort and allocation engines: the pixel by pixel binary sort of
+`natcap.rios.disk_sort.sort_to_disk`, the `heapq.merge` allocation loop of
+`natcap.rios.rios.calculate_activity_portfolio` and the helpers they call.
+
+It's the reference `ipa_benchmark` checks every allocation engine against,
+don't change it to follow changes to the model."""
+
+import tempfile
+import struct
+import heapq
+import atexit
+import logging
+import os
+import json
+import shutil
+
+from osgeo import gdal
+from osgeo import ogr
+import numpy
+import pygeoprocessing
+
+LOGGER = logging.getLogger('ipa_baseline')
+
+
+def sort_to_disk(
+        dataset_uri, dataset_index, score_weight=1.0,
+        cache_element_size=2**17):
+    """Sorts the non-nodata pixels in the dataset on disk and returns
+    an iterable in sorted order.
+
+    Parameters:
+        dataset_uri (string): a path to a floating point GDAL dataset
+        score_weight (float): a number to multiply all values by, which can be
+            used to reverse the order of the iteration if negative.
+        cache_element_size (int): approximate number of single elements to hold
+            in memory before flushing to disk.  Due to the internal blocksize
+            of the input raster, it is possible this cache could go over
+            this value by that size before the cache is flushed.
+
+    Returns:
+        an iterable that produces (value * score_weight, flat_index) in
+        decreasing sorted order by value * score_weight"""
+
+    def _read_score_index_from_disk(
+            score_file_name, index_file_name, buffer_size=1024):
+        """Generator to yield a float/int value from the given filenames.
+        reads a buffer of `buffer_size` big before to avoid keeping the
+        file open between generations."""
+
+        score_buffer = ''
+        index_buffer = ''
+        file_offset = 0
+        buffer_offset = 1  # initialize to 1 to trigger the first load
+        while True:
+            if buffer_offset >= len(score_buffer):
+                score_file = open(score_file_name, 'rb')
+                index_file = open(index_file_name, 'rb')
+                score_file.seek(file_offset)
+                index_file.seek(file_offset)
+
+                score_buffer = score_file.read(buffer_size)
+                index_buffer = index_file.read(buffer_size)
+                score_file.close()
+                index_file.close()
+
+                file_offset += buffer_size
+                buffer_offset = 0
+            packed_score = score_buffer[buffer_offset:buffer_offset+4]
+            packed_index = index_buffer[buffer_offset:buffer_offset+4]
+            buffer_offset += 4
+            if not packed_score:
+                break
+            yield (struct.unpack('f', packed_score)[0],
+                   struct.unpack('i', packed_index)[0]) + (dataset_index,)
+
+    def _sort_cache_to_iterator(index_cache, score_cache):
+        """Flushes the current cache to a heap and returns it
+
+        Parameters:
+            index_cache (1d numpy.array): contains flat indexes to the
+                score pixels `score_cache`
+            score_cache (1d numpy.array): contains score pixels
+
+        Returns:
+            Iterable to visit scores/indexes in increasing score order."""
+
+        # sort the whole bunch to disk
+        sort_index = score_cache.argsort()
+        score_cache = score_cache[sort_index]
+        index_cache = index_cache[sort_index]
+
+        #Dump all the scores and indexes to disk
+        score_file = tempfile.NamedTemporaryFile(delete=False)
+        score_file.write(struct.pack('%sf' % score_cache.size, *score_cache))
+        index_file = tempfile.NamedTemporaryFile(delete=False)
+        index_file.write(struct.pack('%si' % index_cache.size, *index_cache))
+
+        index_cache = None
+        score_cache = None
+        sort_index = None
+
+        #Get the filename and register a command to delete it after the
+        #interpreter exits
+        score_file_name = score_file.name
+        score_file.close()
+        index_file_name = index_file.name
+        index_file.close()
+
+        def _remove_file(path):
+            """Function to remove a file and handle exceptions to
+                register in atexit."""
+            try:
+                os.remove(path)
+            except OSError:
+                # This happens if the file didn't exist, okay because
+                # maybe we deleted it in a method
+                pass
+        atexit.register(_remove_file, score_file_name)
+        atexit.register(_remove_file, index_file_name)
+        return _read_score_index_from_disk(score_file_name, index_file_name)
+
+    # scale the nodata so they can be filtered out in the sort later
+    nodata = pygeoprocessing.get_nodata_from_uri(dataset_uri) * score_weight
+
+    # This will be a list of file iterators we'll pass to heap.merge
+    iters = []
+
+    _, n_cols = pygeoprocessing.get_row_col_from_uri(dataset_uri)
+
+    index_cache = numpy.empty((0,), dtype=numpy.int32)
+    score_cache = numpy.empty((0,), dtype=numpy.float32)
+    for scores_data, scores_block in pygeoprocessing.iterblocks(dataset_uri):
+        # flatten and scale the results
+        scores_block = scores_block.flatten() * score_weight
+
+        col_coords, row_coords = numpy.meshgrid(
+            xrange(scores_data['xoff'], scores_data['xoff'] +
+                   scores_data['win_xsize']),
+            xrange(scores_data['yoff'], scores_data['yoff'] +
+                   scores_data['win_ysize']))
+
+        flat_indexes = (col_coords + row_coords * n_cols).flatten()
+
+        sort_index = scores_block.argsort()
+        sorted_scores = scores_block[sort_index]
+        sorted_indexes = flat_indexes[sort_index]
+
+        # search for nodata values are so we can splice them out
+        left_index = numpy.searchsorted(sorted_scores, nodata, side='left')
+        right_index = numpy.searchsorted(
+            sorted_scores, nodata, side='right')
+
+        # remove nodata values and sort in decreasing order
+        score_cache = numpy.concatenate(
+            (score_cache, sorted_scores[0:left_index],
+             sorted_scores[right_index::]))
+        index_cache = numpy.concatenate(
+            (index_cache, sorted_indexes[0:left_index],
+             sorted_indexes[right_index::]))
+
+        # check if we need to flush the cache
+        if index_cache.size >= cache_element_size:
+            iters.append(_sort_cache_to_iterator(index_cache, score_cache))
+            index_cache = numpy.empty((0,), dtype=numpy.int32)
+            score_cache = numpy.empty((0,), dtype=numpy.float32)
+
+    iters.append(_sort_cache_to_iterator(index_cache, score_cache))
+    return heapq.merge(*iters)
+
+
+def calculate_activity_portfolio(args, report_data=None):
+    """Does the portfolio selection given activity scores, budgets and
+        shapefile restrictions.
+
+        args['activities'] - a dictionary describing activity issues like
+            {'activity_name0':
+               {'out_id': id that goes in a raster,
+                'measurement_unit': 'area' or 'linear',
+                'unit_cost': unit cost,
+                'prioritization_raster_uri': uri to the activity score layer}
+             ...}
+        args['budget_config'] - dictionary to describe budget selection
+            {'years_to_spend': an integer >= 1,
+             'activity_budget':
+                 {'activity0': {'budget_amount': float >= 0.0},
+                  ...}
+             'if_left_over': 'Report remainder' or 'Proportionally reallocate',
+             'floating_budget': float >= 0.0}
+        args['lulc_activity_potential_map'] - a datastructure to map lulc ids
+            to which activities are allowed on the map, ex:
+            {'general_lucode0':
+                {'lucode0': '[list of user's lucodes, '32', ...]',
+                 'activities': '[list of allowed activities, 'activity_1', ...]'
+                },
+             ...},
+        args['activity_shapefiles']: [prefer/prevent shapefile uris, ...],
+        args['output_dir']: uri for portfolio outputs,
+        args['activity_portfolio_uri']: uri for the explicty total activity
+            portfolio (this must be known at a global level for intercomponent
+            connectivity)
+        args['max_transition_activity_portfolio_uri']: uri to the max transition
+            raster that causes each activity
+        args['lulc_uri']: a link to the original land cover map
+        args['results_suffix'] - a suffix to append to each output filename
+        args['activity_lookup_table_uri'] - a uri to to dump the activity lookup table
+            to.
+        args['transition_dictionary'] - a python dictionary that maps transition ids
+            to transition names
+
+        report_data - (optional) an input list that when output has the form
+           [{
+                 year_index: n,
+                 floating_budget: n,
+                 activity_budget: {
+                    'activity_n': n,
+                    ...},
+                 activity_spent: {
+                    'activity_n': n,
+                    ...},
+                 area_converted: { in Ha
+                    'activity_n': n,
+                    ...}
+            },...
+           ]
+
+        returns nothing"""
+
+    #This will keep track of the budget spending
+    if report_data == None:
+        report_data = []
+
+    pygeoprocessing.geoprocessing.create_directories([args['output_dir']])
+
+    budget_selection_activity_uris = {}
+
+    activity_nodata = -1.0
+
+    #Calculate the amount to offset the activity costs based on 1+ the min per
+    #pixel cost.  This will let us uniformly offset all the activity scores in
+    #a way that all the prefered activities will come first but still be
+    #relatively sorted by priority and ROI.
+    min_activity_cost = min([x['unit_cost'] for x in args['activities'].itervalues()])
+    prefer_boost = min_activity_cost + 1.0
+
+    #These will be used for heapq.merge iterators later
+    activity_iterators = {}
+    activity_list = sorted(args['activities'].keys())
+
+    id_to_activity_dict = {}
+    for index, activity_name in enumerate(activity_list):
+        id_to_activity_dict[index] = activity_name
+
+    _dump_to_table(
+        id_to_activity_dict, args['activity_lookup_table_uri'], 'activity_id',
+        'activity_type')
+
+    #This will become a list of per activity costs indexed by
+    #activity_index
+    activity_cost = []
+
+    #THis will be used to record what activity ID in a raster matches
+    #to what real world activity.
+    activity_raster_lookup = {}
+
+    for activity_name in activity_list:
+        args['activities'][activity_name]['prioritization_raster_uri']
+        budget_selection_activity_uris[activity_name] = (
+            args['activities'][activity_name]['prioritization_raster_uri'] + '_prioritization.tif')
+
+    pixel_size_out = pygeoprocessing.geoprocessing.get_cell_size_from_uri(
+        args['lulc_uri'])
+    for activity_index, activity_name in enumerate(activity_list):
+        activity_dict = args['activities'][activity_name]
+        activity_raster_lookup[activity_name] = {
+            'index': activity_index,
+            'uri': activity_dict['prioritization_raster_uri']
+            }
+
+        #Get the normalized cost of activity per unit area, then multiply by
+        #the area of a cell to get the per cell cost.  Build as an index for
+        #later usage in activity selection
+        per_cell_cost = (
+            args['activities'][activity_name]['unit_cost'] /
+            args['activities'][activity_name]['measurement_value']
+            * pixel_size_out ** 2)
+        activity_cost.append(per_cell_cost)
+
+        _mask_activity_areas(
+            args, activity_dict['prioritization_raster_uri'],
+            activity_name, activity_index, activity_nodata,
+            budget_selection_activity_uris[activity_name], per_cell_cost,
+            prefer_boost, pixel_size_out)
+
+
+    LOGGER.info('sort the prefer/prevent/activity score to disk')
+    for activity_index, activity_name in enumerate(activity_list):
+        #Creating the activity iterators here, sorting by highest to lowest.
+        activity_iterators[activity_index] = sort_to_disk(
+            budget_selection_activity_uris[activity_name],
+            activity_index, score_weight=-1.0)
+
+    #This section counts how many pixels TOTAL we have available for setting
+    total_available_pixels = 0
+    available_mask_uri = pygeoprocessing.geoprocessing.temporary_filename()
+    def _mask_maker(*activity_score):
+        """Used to make an activity mask"""
+        nodata_mask = numpy.empty(activity_score[0].shape, dtype=numpy.bool)
+        nodata_mask[:] = True
+        for score in activity_score:
+            nodata_mask = nodata_mask & (score == activity_nodata)
+        return numpy.where(nodata_mask, activity_nodata, 1)
+        #if all(activity_nodata == score for score in activity_score):
+        #    return activity_nodata
+        #return 1
+    pygeoprocessing.geoprocessing.vectorize_datasets(
+        budget_selection_activity_uris.values(), _mask_maker,
+        available_mask_uri, gdal.GDT_Byte, activity_nodata, pixel_size_out,
+        "intersection", dataset_to_align_index=0, vectorize_op=False)
+    mask_ds = gdal.Open(available_mask_uri)
+    mask_band = mask_ds.GetRasterBand(1)
+
+    n_rows, n_cols = pygeoprocessing.geoprocessing.get_row_col_from_uri(
+        available_mask_uri)
+
+    #Make a consistent directory registry.
+    directory_registry = {
+        'continuous_activity_portfolio': os.path.join(
+            args['output_dir'], 'continuous_activity_portfolios'),
+        'yearly_activity_portfolio': os.path.join(
+            args['output_dir'], 'yearly_activity_portfolios'),
+        'total_activity_portfolio': os.path.join(
+            args['output_dir'])
+        }
+    pygeoprocessing.geoprocessing.create_directories(
+        directory_registry.values())
+
+    for row_index in range(n_rows):
+        mask_array = mask_band.ReadAsArray(0, row_index, n_cols, 1)
+        #count the number of pixels not nodata
+        total_available_pixels += numpy.sum(mask_array == 1)
+    mask_band = None
+    mask_ds = None
+
+    activity_array = numpy.memmap(
+        pygeoprocessing.geoprocessing.temporary_filename(), dtype=numpy.ubyte,
+        mode='w+', shape=(n_rows * n_cols,))
+    activity_nodata = 255
+    activity_array[:] = activity_nodata
+
+    for year_index in xrange(args['budget_config']['years_to_spend']):
+        LOGGER.info('create a portfolio dataset for year %s', year_index + 1)
+
+        #Make a copy of the floating and activity budget.
+        try:
+            floating_budget = float(args['budget_config']['floating_budget'])
+        except ValueError:
+            # happens in the offchance that the floating_budget is an empty
+            # string.
+            floating_budget = 0.
+
+        #The activity budget is indexed in the same order as activity
+        #list.. also the same order in which activity_indexes were stored
+        #in the heap iterators
+        activity_budget = [
+            args['budget_config']['activity_budget'][activity_name]
+            ['budget_amount'] for activity_name in activity_list]
+
+        #Record the spending
+        report_data_dict = {
+            'year_index': year_index,
+            'floating_budget': floating_budget,
+            }
+        #This makes a dictionary of activity name to activity budget
+        report_data_dict['activity_budget'] = dict([
+                (activity_name,
+                args['budget_config']['activity_budget'][activity_name]['budget_amount']) for
+            activity_name in activity_list])
+        #This makes a dictionary of activity name to 0.0, used for spending recording later
+        report_data_dict['activity_spent'] = dict([
+                (activity_name, 0.0) for activity_name in activity_list])
+        report_data_dict['area_converted'] = dict([
+                (activity_name, 0.0) for activity_name in activity_list])
+
+        #We'll use this as a data structure to keep track of how many pixels
+        #we can spend in each activity
+        max_possible_activity_pixels = [
+            int(budget/cost) for budget, cost in
+            zip(activity_budget, activity_cost)]
+
+        heap_empty = False
+        while (sum(max_possible_activity_pixels) > 0 and
+               total_available_pixels > 0 and not heap_empty):
+            #Assemble the activity iterator by only including those iterators
+            #that have budget on the pixel
+            valid_activity_iterators = []
+
+            for activity_index, pixel_budget in enumerate(
+                    max_possible_activity_pixels):
+                if pixel_budget > 0:
+                    valid_activity_iterators.append(activity_iterators[activity_index])
+
+            if len(valid_activity_iterators) == 0:
+                #activity budget left for any pixels, break
+                break
+
+            activity_iterator = heapq.merge(*valid_activity_iterators)
+
+            #The heap might be empty, if its not, we'll get inside the
+            #for loop and reset it.  This saves us from the tricky case to see if
+            #there are any elements left to generate since we can't easily peek
+            #ahead on the activity_iterator
+            heap_empty = True
+            for _, flat_index, activity_index in activity_iterator:
+                heap_empty = False
+
+                #See if the pixel has already been allocated
+                if activity_array[flat_index] != activity_nodata:
+                    continue
+
+                #Otherwise, allocate the pixel
+                if total_available_pixels % 10000 == 0:
+                    LOGGER.info("year %s activity: allocating pixels for activity %s pixels left %s" % (year_index + 1, activity_index,total_available_pixels))
+                activity_array[flat_index] = activity_index
+                activity_budget[activity_index] -= activity_cost[activity_index]
+
+                #This is complicated index because I set up everything to be
+                #indexed by activity index, but in the report we dump according
+                #to activity_name
+                report_data_dict['activity_spent'][activity_list[activity_index]] += activity_cost[activity_index]
+                #the 10,000 is to convert square meters to Ha
+                report_data_dict['area_converted'][activity_list[activity_index]] += (pixel_size_out ** 2) / 10000.0
+
+                max_possible_activity_pixels[activity_index] -= 1
+                total_available_pixels -= 1
+                assert(activity_budget[activity_index] >= 0)
+                assert(max_possible_activity_pixels[activity_index] >= 0)
+
+                if max_possible_activity_pixels[activity_index] == 0 or total_available_pixels == 0:
+                    #update the iterator
+                    break
+
+        #Now reallocate any remaining activity budget as float and spend through
+        #whatever pixels are left
+        if args['budget_config']['if_left_over'] == 'Proportionally reallocate':
+            floating_budget += sum(activity_budget)
+
+        #We'll need to keep track of which iterators to use by what kinds of
+        #activities we have money left to spend on
+        min_cost = min(activity_cost)
+        heap_empty = False
+        while floating_budget > min_cost and total_available_pixels > 0 and not heap_empty:
+
+            valid_activity_iterators = []
+            #we'll use max_cost as a trigger for when the float budget falls below
+            #to reallocate the heap iterators
+            max_cost = 0.0
+            for activity_index, cost in enumerate(activity_cost):
+                if cost < floating_budget:
+                    valid_activity_iterators.append(
+                        activity_iterators[activity_index])
+                    max_cost = max(cost, max_cost)
+
+            activity_iterator = heapq.merge(*valid_activity_iterators)
+
+            #It's possible all the heap iterators are empty, this guards against it
+            heap_empty = True
+            for value, flat_index, activity_index in activity_iterator:
+                heap_empty = False
+
+                #See if the pixel has already been allocated
+                if activity_array[flat_index] != activity_nodata:
+                    continue
+
+                #Otherwise, allocate the pixel
+                if total_available_pixels % 10000 == 0:
+                    LOGGER.info("year %s float_budget: allocating pixels for activity %s pixels left %s" % (year_index + 1, activity_index,total_available_pixels))
+                activity_array[flat_index] = activity_index
+                floating_budget -= activity_cost[activity_index]
+                report_data_dict['activity_spent'][activity_list[activity_index]] += activity_cost[activity_index]
+                report_data_dict['area_converted'][activity_list[activity_index]] += (pixel_size_out ** 2) / 10000
+
+                total_available_pixels -= 1
+                assert(floating_budget >= 0)
+
+                if max_cost > floating_budget or total_available_pixels == 0:
+                    #update the iterator
+                    break
+
+        LOGGER.info('finishing floating floating_budget %s, total_available_pixels %s heap_empty %s' % (floating_budget, total_available_pixels, heap_empty))
+
+        activity_portfolio_uri = os.path.join(
+            directory_registry['continuous_activity_portfolio'],
+            'activity_portfolio_continuous_year_%s%s.tif' % (year_index + 1, args['results_suffix']))
+        _write_array_to_uri(
+            activity_array, available_mask_uri, activity_nodata,
+            activity_portfolio_uri)
+        pygeoprocessing.geoprocessing.calculate_raster_stats_uri(activity_portfolio_uri)
+        pygeoprocessing.geoprocessing.create_rat_uri(
+            activity_portfolio_uri, id_to_activity_dict, "Activity")
+
+        report_data.append(report_data_dict)
+
+    #Make the stepwise activity budgets
+    #Year 1 will just be year 1 continuous
+    year_1_activity_dataset_uri = os.path.join(
+        directory_registry['yearly_activity_portfolio'],
+        'activity_portfolio_year_1%s.tif' % args['results_suffix'])
+    shutil.copy(
+        os.path.join(
+            directory_registry['continuous_activity_portfolio'],
+            'activity_portfolio_continuous_year_1%s.tif' % args['results_suffix']),
+        year_1_activity_dataset_uri
+        )
+    pygeoprocessing.geoprocessing.create_rat_uri(
+        year_1_activity_dataset_uri, id_to_activity_dict, "Activity")
+
+    #Copy the RAT
+    shutil.copy(
+        os.path.join(
+            directory_registry['continuous_activity_portfolio'],
+            'activity_portfolio_continuous_year_1%s.tif.aux.xml' % args['results_suffix']),
+        os.path.join(
+                directory_registry['yearly_activity_portfolio'],
+                'activity_portfolio_year_1%s.tif.aux.xml' % args['results_suffix']))
+
+    #The rest will be the set difference of the current continuous year to the
+    #previous
+    for year_index in xrange(1, args['budget_config']['years_to_spend']):
+        def _subtract_activity_years(prev_year, cur_year):
+            return numpy.where(prev_year == cur_year, activity_nodata, cur_year)
+            #if prev_year == cur_year:
+            #    return activity_nodata
+            #return cur_year
+
+        activity_portfolio_uri = [
+            os.path.join(
+                directory_registry['continuous_activity_portfolio'],
+                'activity_portfolio_continuous_year_%s%s.tif' % (year_index, args['results_suffix'])),
+            os.path.join(
+                directory_registry['continuous_activity_portfolio'],
+                'activity_portfolio_continuous_year_%s%s.tif' % (year_index + 1, args['results_suffix']))]
+
+        current_activitiy_portfolio_uri = os.path.join(
+            directory_registry['yearly_activity_portfolio'],
+            'activity_portfolio_year_%s%s.tif' % (year_index + 1, args['results_suffix']))
+
+        pygeoprocessing.geoprocessing.vectorize_datasets(
+            activity_portfolio_uri, _subtract_activity_years,
+            current_activitiy_portfolio_uri, gdal.GDT_Byte, activity_nodata,
+            pixel_size_out, "intersection", dataset_to_align_index=0,
+            vectorize_op=False)
+        pygeoprocessing.geoprocessing.create_rat_uri(
+            current_activitiy_portfolio_uri, id_to_activity_dict, "Activity")
+
+    #This writes the activity portfolio
+    activity_portfolio_uri = args['activity_portfolio_uri']
+    _write_array_to_uri(activity_array, available_mask_uri,
+                        activity_nodata, activity_portfolio_uri)
+    pygeoprocessing.geoprocessing.calculate_raster_stats_uri(activity_portfolio_uri)
+    pygeoprocessing.geoprocessing.create_rat_uri(
+        activity_portfolio_uri, id_to_activity_dict, "Activity")
+
+    #This writes a raster lookup id
+    activity_raster_id_json_uri = os.path.join(
+        os.path.dirname(activity_portfolio_uri), 'activity_raster_id.json')
+    activity_raster_id_json_file = open(activity_raster_id_json_uri, 'w')
+    json.dump(activity_raster_lookup, activity_raster_id_json_file, indent=4)
+
+    #get a list of the activities in order of their index
+    #then get a list of the activity uris prepended with "max_transition_"
+    #to pass to vectorize datasets
+    max_transition_activity_list = []
+    for activity_name, activity_dict in sorted(
+            activity_raster_lookup.iteritems(), key=lambda x: x[1]['index']):
+        activity_dir, activity_filename = os.path.split(activity_dict['uri'])
+        max_transition_activity_list.append(
+            os.path.join(activity_dir, 'max_transition_' + activity_filename))
+
+    #Create a maximum transition raster based off the activity_portfolio_total
+    #raster.
+    transition_nodata = -1
+    max_activity_transition_raster_uri = (
+        args['max_transition_activity_portfolio_uri'])
+    def _max_transition_raster(*pixels):
+        """pixels[0] is the activity lookup, then pixels[1]...
+            is the transition lookup"""
+        nodata_mask = pixels[0] == activity_nodata
+        value = numpy.empty(pixels[0].shape, dtype=numpy.int32)
+        for index in range(1, len(pixels)):
+            index_mask = (pixels[0]) == index - 1
+            value[index_mask] = pixels[index][index_mask]
+        return numpy.where(nodata_mask, transition_nodata, value)
+
+    pygeoprocessing.geoprocessing.vectorize_datasets(
+        [activity_portfolio_uri] + max_transition_activity_list,
+        _max_transition_raster, max_activity_transition_raster_uri,
+        gdal.GDT_Int32, transition_nodata, pixel_size_out, "intersection",
+        dataset_to_align_index=0, vectorize_op=False)
+    pygeoprocessing.geoprocessing.create_rat_uri(
+        max_activity_transition_raster_uri, args['transition_dictionary'],
+        "Transition")
+
+    # if only 1 year we don't need the continous outputs
+    # this was an issue identified as a bottlneck in wide scale uptake of RIOS
+    if args['budget_config']['years_to_spend'] == 1:
+        shutil.rmtree(directory_registry['continuous_activity_portfolio'])
+        shutil.rmtree(directory_registry['yearly_activity_portfolio'])
+
+
+def _mask_activity_areas(
+    args, prioritization_raster_uri, activity_name, activity_index,
+    activity_nodata, budget_selection_activity_uri, per_cell_cost, prefer_boost,
+    pixel_size_out):
+
+    prioritization_nodata = pygeoprocessing.geoprocessing.get_nodata_from_uri(
+            prioritization_raster_uri)
+    mask_uri = {
+        'prevent': pygeoprocessing.geoprocessing.temporary_filename(),
+        'prefer': pygeoprocessing.geoprocessing.temporary_filename(),
+        }
+
+    for activity_type in ['prevent', 'prefer']:
+        LOGGER.info('mask out %s shapefile areas for activity %s' % (
+                activity_type, activity_name))
+        _rasterize_activity_action(
+            args['activity_shapefiles'], activity_name, activity_type,
+            args['lulc_uri'], mask_uri[activity_type])
+
+    LOGGER.info('mask out lulc prevented areas for each activity')
+    lucodes_to_allow = set()
+    for lucode, activity_list in args['lulc_activity_potential_map'].iteritems():
+        if activity_name in activity_list:
+            lucodes_to_allow.add(int(lucode))
+    LOGGER.info('activity_name %s allowed lu codes: %s' % (activity_name, str(lucodes_to_allow)))
+    #make sure it's a float for division below
+    per_cell_cost = float(per_cell_cost)
+    def _activity_prevent_prefer(
+            lucode, prevent_mask, prefer_mask, activity_score):
+        """masks out the pixels in the activity that are not allowed
+            given their landcover type or shapefile mask, bumps
+            up pixels that are prefered"""
+
+        #initialize to false
+        valid_mask = numpy.zeros(lucode.shape, dtype=numpy.bool)
+        for allowed_lucode in lucodes_to_allow:
+            valid_mask = valid_mask | (lucode == allowed_lucode)
+        valid_mask = valid_mask & (prevent_mask != 1)
+        valid_mask = valid_mask & (activity_score != prioritization_nodata)
+        return numpy.where(
+            valid_mask,
+            (activity_score + prefer_mask * prefer_boost) / per_cell_cost,
+            activity_nodata)
+
+    pygeoprocessing.geoprocessing.vectorize_datasets(
+        [args['lulc_uri'], mask_uri['prevent'], mask_uri['prefer'],
+         prioritization_raster_uri], _activity_prevent_prefer,
+        budget_selection_activity_uri,
+        gdal.GDT_Float32, activity_nodata, pixel_size_out, "intersection",
+        dataset_to_align_index=0, vectorize_op=False)
+
+
+def _write_array_to_uri(array, base_ds_uri, ds_nodata, ds_uri):
+    """This is a helper function to write a numpy array to a pre-allocated
+        GDAL dataset.
+
+        array - numpy array
+        base_ds_uri - a uri to an existsing dataset that will be used to
+            define the projection and size of the outgoing dataset
+        ds_nodata - the nodata value for the output dataset
+        ds_uri - a uri to a valid dataset whose n_rows/n_cols are the same
+            dimensions as the array
+
+        returns nothing"""
+
+    pygeoprocessing.geoprocessing.new_raster_from_base_uri(
+        base_ds_uri, ds_uri, 'GTiff', ds_nodata,
+        gdal.GDT_Byte)
+    n_rows, n_cols = pygeoprocessing.geoprocessing.get_row_col_from_uri(ds_uri)
+    dataset = gdal.Open(ds_uri, gdal.GA_Update)
+    band = dataset.GetRasterBand(1)
+    #Need to resize array for writing gdal object
+    array.resize((n_rows, n_cols))
+    band.WriteArray(array)
+    #Reflatten it
+    array.resize((n_rows * n_cols,))
+    band = None
+    dataset = None
+
+
+def _rasterize_activity_action(
+        shapefile_uri_list, activity_name, action_type, base_uri, out_uri):
+    """A helper function that will make a mask of all the features in a list
+        of shapefiles that have the requested activty name and action type.
+
+        shapefile_uri_list - a list of shapefile uris which have at least
+            fields 'activity_n' and 'action'
+        activity_name - the name of an activity that might be found in the
+            shapefile 'activity_n' field.
+        action - the name of an action in the 'action' field of the shapefile
+            usually 'prefer' or 'prevent'
+        base_uri - a uri to a datasource that will serve as a geotransform and
+            cell size reference for the output
+        out_uri - the name of the mask output dataset.  it will contain 1 where
+            the features in the shapefile_uri_list have the same activity_name
+            and action_type and 0 everywhere else.
+
+        returns nothing"""
+
+    #Make the mask raster first, in case we don't do anything else
+    pygeoprocessing.geoprocessing.new_raster_from_base_uri(
+        base_uri, out_uri, 'GTiff', 0, gdal.GDT_Byte, fill_value=0)
+
+    #Make sure there are some shapefiles in there, if not we're done
+    if len(shapefile_uri_list) == 0:
+        return
+
+    sample_vector = ogr.Open(shapefile_uri_list[0])
+    sample_layer = sample_vector.GetLayer()
+    sample_srs = sample_layer.GetSpatialRef()
+    sample_layer = None
+    sample_vector = None
+
+    mask_vector_temp_dir = tempfile.mkdtemp()
+    mask_vector_path = os.path.join(mask_vector_temp_dir, 'mask.shp')
+    esri_driver = ogr.GetDriverByName('ESRI Shapefile')
+    mask_vector = esri_driver.CreateDataSource(mask_vector_path)
+    mask_layer = mask_vector.CreateLayer(
+        'mask', sample_srs, geom_type=ogr.wkbPolygon)
+
+    for shapefile_path in shapefile_uri_list:
+        shapefile = ogr.Open(shapefile_path)
+        skipped_previous = False
+        for layer in shapefile:
+            # reset reading just in case, i'm debugging a segfault and
+            # everything is suspicious
+            layer.ResetReading()
+            for feature in layer:
+                shape_activity_name = feature.GetField(
+                    feature.GetFieldIndex('activity_n'))
+                action = feature.GetField(feature.GetFieldIndex('action'))
+
+                # This is where we get to use the column we created above, to
+                # determine if the current feature represents an area where the
+                # activity is prevented and set the value of the field
+                # accordingly.
+                if shape_activity_name == activity_name and action == action_type:
+                    mask_layer.CreateFeature(feature)
+                    skipped_previous = False
+                else:
+                    # Make a note of which activity/action/feature combination
+                    # we're skipping, just for information.
+                    if not skipped_previous:
+                        LOGGER.info(
+                            'SKIPPING %s: %s == %s && %s == %s',
+                            os.path.basename(shapefile_path), activity_name,
+                            shape_activity_name, action, action_type)
+                        skipped_previous = True
+
+    # Just in case anything has not been flushed to disk, do so now.
+    mask_layer.SyncToDisk()
+
+    # Rasterize this layer onto the copied raster.
+    mask_dataset = gdal.Open(out_uri, gdal.GA_Update)
+    gdal.RasterizeLayer(mask_dataset, [1], mask_layer, burn_values=[1])
+
+    #Remove the temporary vector layer from disk
+    mask_layer = None
+    ogr.DataSource.__swig_destroy__(mask_vector)
+    mask_vector = None
+    shutil.rmtree(mask_vector_temp_dir)
+
+
+def _dump_to_table(dictionary, table_uri, key_name, value_name):
+    """A function to take a flat dictionary and dump to a CSV
+        table.
+
+        dictionary - a flat python dictionary of key/value pairs
+        table_uri - the URI of a CSV output table
+        key_name - a string to use for the key headings
+        value_name - a string to use for the value headings
+
+        returns nothing"""
+
+    with open(table_uri, 'wb') as table_file:
+        table_file.write('%s, %s\n' % (key_name, value_name))
+        for key, value in dictionary.iteritems():
+            table_file.write('%s, %s\n' % (key, value))
@@ -0,0 +1,892 @@
+"""Regression and benchmark harness for the IPA portfolio allocation engines.
+
+Builds synthetic LULC, activity score and prefer/prevent inputs at several
+sizes and runs the portfolio selection on them once with the frozen copy of
+the selection in `ipa_baseline`, then once per allocation engine of
+`natcap.rios.rios.calculate_activity_portfolio`.  Wall time and peak RSS are
+reported for each stage of each run.
+
+Each size is run on two sets of inputs.  On inputs whose activity scores
+are all distinct every engine must produce pixel identical portfolios and
+identical report data to the baseline.  On inputs with lots of tied scores
+the engines must be identical to each other; they break ties by flat pixel
+index where the baseline's order depended on its sort, so their differences
+to the baseline are only reported.  The allocation rank each engine writes
+is cut with `natcap.rios.rios.threshold_allocation_rank` and checked against
+the engine's own portfolio.  The fused IPA scoring is run against the staged
+scoring on synthetic factors of each size, and the activity score and max
+transition rasters they write must be identical.
+
+Run from the repository root as:
+    python scripts/ipa_benchmark.py --sizes 256 1024 --workspace bench
+
+With --priority-kernel it instead times the objective transition kernel
+against the calculation it replaced on blocks of each size.
+"""
+
+import os
+import sys
+import time
+import shutil
+import logging
+import argparse
+import csv
+import tempfile
+import contextlib
+
+from osgeo import gdal
+from osgeo import ogr
+from osgeo import osr
+import numpy
+
+import natcap.rios.rios
+import natcap.rios.disk_sort
+import ipa_baseline
+
+LOGGER = logging.getLogger('natcap.rios.ipa_benchmark')
+
+_PIXEL_SIZE = 30.0
+_ORIGIN = (444720.0, 3751320.0)
+_LUCODES = [1, 2, 3, 4]
+_ACTIVITY_NAMES = ['activity_a', 'activity_b', 'activity_c']
+_YEARS_TO_SPEND = 3
+# name of the frozen reference selection in the results
+_BASELINE = 'baseline'
+# the portfolio rasters the engines write that the baseline doesn't
+_IN_SERIES_PORTFOLIO_URIS = ['allocation_year.tif', 'allocation_rank.tif']
+
+
+def _peak_rss_mb():
+    """Returns the peak resident set size of this process in MB, None if it
+        can't be determined on this platform."""
+
+    try:
+        with open('/proc/self/status') as status_file:
+            for line in status_file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.0
+    except IOError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # reported in bytes rather than KB
+        peak_rss /= 1024.0
+    return peak_rss / 1024.0
+
+
+def _reset_peak_rss():
+    """Resets the peak RSS counter where the OS allows it (Linux >= 4.0) so
+        the next reading is the peak of the next stage only."""
+
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs_file:
+            clear_refs_file.write('5')
+    except IOError:
+        pass
+
+
+@contextlib.contextmanager
+def _profile_stages(stage_stats):
+    """Wraps the stages of the portfolio selection to record their wall time
+        and peak RSS into `stage_stats`, a dictionary of stage name to
+        {'time': seconds, 'peak_rss_mb': MB}."""
+
+    def _wrap(stage_name, func):
+        """Returns `func` wrapped to accumulate stats under `stage_name`"""
+        def _profiled(*args, **kwargs):
+            _reset_peak_rss()
+            start_time = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                stats = stage_stats.setdefault(
+                    stage_name, {'time': 0.0, 'peak_rss_mb': None})
+                stats['time'] += time.time() - start_time
+                peak_rss = _peak_rss_mb()
+                if peak_rss is not None:
+                    stats['peak_rss_mb'] = max(stats['peak_rss_mb'], peak_rss)
+        return _profiled
+
+    patches = [
+        (natcap.rios.rios, '_mask_activity_areas', 'mask'),
+        (natcap.rios.rios, '_rasterize_activity_actions', 'mask'),
+        (natcap.rios.disk_sort, 'sort_to_runs', 'sort'),
+        (natcap.rios.rios, '_write_array_to_uri', 'write'),
+        (natcap.rios.rios, '_write_allocation_rasters', 'write'),
+        (ipa_baseline, '_mask_activity_areas', 'mask'),
+        (ipa_baseline, 'sort_to_disk', 'sort'),
+        (ipa_baseline, '_write_array_to_uri', 'write'),
+        ]
+    originals = [
+        (module, attribute, getattr(module, attribute))
+        for module, attribute, _ in patches]
+    original_engines = dict(natcap.rios.rios._ALLOCATION_ENGINES)
+    try:
+        for module, attribute, stage_name in patches:
+            setattr(module, attribute, _wrap(
+                stage_name, getattr(module, attribute)))
+        for engine_name, engine in original_engines.iteritems():
+            natcap.rios.rios._ALLOCATION_ENGINES[engine_name] = _wrap(
+                'allocate', engine)
+        yield
+    finally:
+        for module, attribute, func in originals:
+            setattr(module, attribute, func)
+        natcap.rios.rios._ALLOCATION_ENGINES.update(original_engines)
+
+
+def _spatial_reference():
+    """Returns the projected spatial reference of the synthetic inputs"""
+
+    srs = osr.SpatialReference()
+    srs.SetUTM(11, 1)
+    srs.SetWellKnownGeogCS('NAD27')
+    return srs
+
+
+def _make_raster(raster_uri, array, nodata, datatype):
+    """Writes `array` to a new GeoTIFF on the synthetic grid"""
+
+    n_rows, n_cols = array.shape
+    driver = gdal.GetDriverByName('GTiff')
+    dataset = driver.Create(
+        raster_uri, n_cols, n_rows, 1, datatype,
+        options=['TILED=YES', 'BIGTIFF=IF_SAFER'])
+    dataset.SetGeoTransform(
+        [_ORIGIN[0], _PIXEL_SIZE, 0, _ORIGIN[1], 0, -_PIXEL_SIZE])
+    dataset.SetProjection(_spatial_reference().ExportToWkt())
+    band = dataset.GetRasterBand(1)
+    band.SetNoDataValue(nodata)
+    band.WriteArray(array)
+    band = None
+    dataset = None
+
+
+def _make_activity_shapefile(shapefile_uri, n_rows, n_cols, random_state):
+    """Makes a prefer/prevent shapefile of random rectangles over the grid"""
+
+    driver = ogr.GetDriverByName('ESRI Shapefile')
+    vector = driver.CreateDataSource(shapefile_uri)
+    layer = vector.CreateLayer(
+        'activity_shapes', _spatial_reference(), geom_type=ogr.wkbPolygon)
+    layer.CreateField(ogr.FieldDefn('activity_n', ogr.OFTString))
+    layer.CreateField(ogr.FieldDefn('action', ogr.OFTString))
+    for activity_name in _ACTIVITY_NAMES:
+        for action in ['prefer', 'prevent']:
+            for _ in xrange(3):
+                row, col = random_state.randint(0, n_rows), random_state.randint(
+                    0, n_cols)
+                height = random_state.randint(1, max(2, n_rows // 8))
+                width = random_state.randint(1, max(2, n_cols // 8))
+                min_x = _ORIGIN[0] + col * _PIXEL_SIZE
+                max_y = _ORIGIN[1] - row * _PIXEL_SIZE
+                max_x = min_x + width * _PIXEL_SIZE
+                min_y = max_y - height * _PIXEL_SIZE
+                ring = ogr.Geometry(ogr.wkbLinearRing)
+                for point_x, point_y in [
+                        (min_x, min_y), (max_x, min_y), (max_x, max_y),
+                        (min_x, max_y), (min_x, min_y)]:
+                    ring.AddPoint(point_x, point_y)
+                polygon = ogr.Geometry(ogr.wkbPolygon)
+                polygon.AddGeometry(ring)
+                feature = ogr.Feature(layer.GetLayerDefn())
+                feature.SetField('activity_n', activity_name)
+                feature.SetField('action', action)
+                feature.SetGeometry(polygon)
+                layer.CreateFeature(feature)
+                feature = None
+    layer = None
+    vector = None
+
+
+def make_synthetic_inputs(input_dir, size, seed=0, tied_scores=True):
+    """Builds a synthetic set of portfolio selection inputs.
+
+        input_dir - directory to write the synthetic rasters and shapefile
+        size - the number of rows and columns of the synthetic grid
+        seed - seed for the random number generator
+        tied_scores - if True activity scores are quantized to a handful of
+            values so there are lots of equal scores to exercise tie
+            breaking by flat index.  Otherwise they're distinct even integers
+            that stay distinct once they're boosted by the prefer areas and
+            divided by the pixel cost, for grids up to 1024x1024.
+
+        The second activity reuses the first activity's scores to exercise
+        tie breaking by activity index.
+
+        returns a `calculate_activity_portfolio` args dictionary without
+            the output uris"""
+
+    if not os.path.exists(input_dir):
+        os.makedirs(input_dir)
+    random_state = numpy.random.RandomState(seed)
+
+    lulc_uri = os.path.join(input_dir, 'lulc.tif')
+    lulc_array = random_state.choice(_LUCODES, size=(size, size)).astype(
+        numpy.int32)
+    lulc_array[random_state.rand(size, size) < 0.05] = -1
+    _make_raster(lulc_uri, lulc_array, -1, gdal.GDT_Int32)
+
+    activity_nodata = -1.0
+    activities = {}
+    score_array = None
+    for activity_index, activity_name in enumerate(_ACTIVITY_NAMES):
+        if activity_index != 1:
+            if tied_scores:
+                score_array = (random_state.randint(
+                    0, 16, size=(size, size)) / 15.0).astype(numpy.float32)
+            else:
+                score_array = (2 * random_state.permutation(
+                    size * size).reshape(size, size)).astype(numpy.float32)
+            score_array[random_state.rand(size, size) < 0.1] = activity_nodata
+        activity_uri = os.path.join(input_dir, activity_name + '.tif')
+        _make_raster(
+            activity_uri, score_array, activity_nodata, gdal.GDT_Float32)
+        max_transition_array = random_state.randint(
+            0, 4, size=(size, size)).astype(numpy.int32)
+        _make_raster(
+            os.path.join(input_dir, 'max_transition_' + activity_name + '.tif'),
+            max_transition_array, -1, gdal.GDT_Int32)
+        activities[activity_name] = {
+            'unit_cost': [100.0, 150.0, 100.0][activity_index],
+            'measurement_value': 900.0,
+            'measurement_unit': 'area',
+            'output_id': activity_index,
+            'prioritization_raster_uri': activity_uri,
+            }
+
+    shapefile_uri = os.path.join(input_dir, 'activity_shapes.shp')
+    _make_activity_shapefile(shapefile_uri, size, size, random_state)
+
+    # roughly a fifth of the grid's worth of budget, split between activity
+    # budgets and the floating budget
+    pixel_cost = 100.0 * _PIXEL_SIZE ** 2 / 900.0
+    yearly_budget = size * size * pixel_cost / (5.0 * _YEARS_TO_SPEND)
+    return {
+        'activities': activities,
+        'budget_config': {
+            'years_to_spend': _YEARS_TO_SPEND,
+            'floating_budget': yearly_budget / 2.0,
+            'if_left_over': 'Proportionally reallocate',
+            'activity_budget': dict(
+                (activity_name, {
+                    'budget_amount': yearly_budget / (2.0 * len(activities))})
+                for activity_name in activities),
+            },
+        'lulc_activity_potential_map': {
+            '1': _ACTIVITY_NAMES,
+            '2': _ACTIVITY_NAMES[0:2],
+            '3': _ACTIVITY_NAMES[1:],
+            '4': [],
+            },
+        'activity_shapefiles': [shapefile_uri],
+        'lulc_uri': lulc_uri,
+        'results_suffix': '',
+        'transition_dictionary': {
+            0: 'transition_0', 1: 'transition_1', 2: 'transition_2',
+            3: 'transition_3'},
+        }
+
+
+def _run_engine(base_args, output_dir, allocation_engine):
+    """Runs the portfolio selection with `allocation_engine`, or the frozen
+        `ipa_baseline` selection if it's _BASELINE.
+
+        returns (report_data, stage statistics)"""
+
+    args = dict(base_args)
+    args['activities'] = dict(
+        (name, dict(activity_dict))
+        for name, activity_dict in base_args['activities'].iteritems())
+    args['allocation_engine'] = allocation_engine
+    args['write_allocation_rank'] = True
+    # every engine should pay for its own sort
+    args['persist_sorted_index'] = False
+    args['output_dir'] = output_dir
+    args['activity_portfolio_uri'] = os.path.join(
+        output_dir, 'activity_portfolio_total.tif')
+    args['max_transition_activity_portfolio_uri'] = os.path.join(
+        output_dir, 'max_transition_activity_portfolio.tif')
+    args['activity_lookup_table_uri'] = os.path.join(
+        output_dir, 'activity_raster_id_to_type.csv')
+
+    report_data = []
+    stage_stats = {}
+    _reset_peak_rss()
+    start_time = time.time()
+    with _profile_stages(stage_stats):
+        if allocation_engine == _BASELINE:
+            ipa_baseline.calculate_activity_portfolio(args, report_data)
+        else:
+            natcap.rios.rios.calculate_activity_portfolio(args, report_data)
+    stage_stats['total'] = {
+        'time': time.time() - start_time, 'peak_rss_mb': _peak_rss_mb()}
+    return report_data, stage_stats
+
+
+def _portfolio_uris():
+    """Lists the portfolio rasters that are compared between the engines and
+        the baseline"""
+
+    portfolio_uris = ['activity_portfolio_total.tif']
+    for year_index in xrange(_YEARS_TO_SPEND):
+        portfolio_uris.append(os.path.join(
+            'continuous_activity_portfolios',
+            'activity_portfolio_continuous_year_%s.tif' % (year_index + 1)))
+        portfolio_uris.append(os.path.join(
+            'yearly_activity_portfolios',
+            'activity_portfolio_year_%s.tif' % (year_index + 1)))
+    return portfolio_uris
+
+
+def _read_raster(raster_uri):
+    """Reads a whole single band raster into memory"""
+
+    dataset = gdal.Open(raster_uri)
+    array = dataset.GetRasterBand(1).ReadAsArray()
+    dataset = None
+    return array
+
+
+def compare_engine_outputs(reference_dir, reference_report, test_dir,
+                           test_report, portfolio_uris=None):
+    """Diffs the outputs of two portfolio selection runs.
+
+        portfolio_uris - (optional) the portfolio rasters to compare,
+            relative to the output directories, defaults to
+            `_portfolio_uris()`
+
+        returns a list of strings describing each difference, empty if the
+            runs are identical"""
+
+    if portfolio_uris is None:
+        portfolio_uris = _portfolio_uris()
+    differences = []
+    for portfolio_uri in portfolio_uris:
+        reference_array = _read_raster(
+            os.path.join(reference_dir, portfolio_uri))
+        test_array = _read_raster(os.path.join(test_dir, portfolio_uri))
+        n_different = numpy.count_nonzero(reference_array != test_array)
+        if n_different > 0:
+            differences.append(
+                '%s: %d pixels differ' % (portfolio_uri, n_different))
+
+    if len(reference_report) != len(test_report):
+        differences.append('report_data: %d years vs %d years' % (
+            len(reference_report), len(test_report)))
+    for reference_year, test_year in zip(reference_report, test_report):
+        for key in sorted(reference_year):
+            if reference_year[key] != test_year.get(key):
+                differences.append('report_data year %s %s: %r != %r' % (
+                    reference_year['year_index'] + 1, key,
+                    reference_year[key], test_year.get(key)))
+    return differences
+
+
+def check_allocation_rank(output_dir, report_data):
+    """Checks `natcap.rios.rios.threshold_allocation_rank` against the
+        portfolio selection run it cuts from: at the total cost of the
+        allocation it must give back the total portfolio and what the run
+        spent, and at half of it a part of the total portfolio.
+
+        returns a list of strings describing each difference, empty if the
+            thresholded portfolios are consistent"""
+
+    rank_uri = os.path.join(output_dir, 'allocation_rank.tif')
+    cost_table_uri = os.path.join(output_dir, 'allocation_rank_cost.csv')
+    with open(cost_table_uri, 'rb') as cost_table_file:
+        total_cost = max([0.0] + [
+            float(row['cumulative_cost'])
+            for row in csv.DictReader(cost_table_file)])
+    total_array = _read_raster(
+        os.path.join(output_dir, 'activity_portfolio_total.tif'))
+    report_spent = sum(
+        sum(year_data['activity_spent'].itervalues())
+        for year_data in report_data)
+
+    differences = []
+    threshold_uri = os.path.join(output_dir, 'threshold_total.tif')
+    n_allocated, spent = natcap.rios.rios.threshold_allocation_rank(
+        rank_uri, cost_table_uri, total_cost, threshold_uri)
+    n_different = numpy.count_nonzero(
+        _read_raster(threshold_uri) != total_array)
+    if n_different > 0:
+        differences.append(
+            'threshold at the total cost: %d pixels differ from %s' % (
+                n_different, 'activity_portfolio_total.tif'))
+    if n_allocated != numpy.count_nonzero(total_array != 255):
+        differences.append(
+            'threshold at the total cost: %d pixels allocated, %d in %s' % (
+                n_allocated, numpy.count_nonzero(total_array != 255),
+                'activity_portfolio_total.tif'))
+    if abs(spent - report_spent) > 1e-9 * max(1.0, abs(report_spent)):
+        differences.append(
+            'threshold at the total cost: spent %r, report_data %r' % (
+                spent, report_spent))
+
+    threshold_uri = os.path.join(output_dir, 'threshold_half.tif')
+    natcap.rios.rios.threshold_allocation_rank(
+        rank_uri, cost_table_uri, total_cost / 2.0, threshold_uri)
+    half_array = _read_raster(threshold_uri)
+    n_different = numpy.count_nonzero(
+        (half_array != 255) & (half_array != total_array))
+    if n_different > 0:
+        differences.append(
+            'threshold at half the total cost: %d pixels differ from %s' % (
+                n_different, 'activity_portfolio_total.tif'))
+    return differences
+
+
+def run_benchmark(workspace_dir, sizes, engines=None, seed=0):
+    """Runs the baseline and every allocation engine on synthetic inputs of
+        each size, with distinct and with tied activity scores.
+
+        workspace_dir - directory for the synthetic inputs and outputs
+        sizes - a list of grid sizes (rows and columns) to run
+        engines - the allocation engines to run, defaults to all of them.
+            The first engine is the reference the others are compared to on
+            tied scores.
+        seed - seed for the synthetic inputs
+
+        returns a list of dictionaries, one per size, scores and engine, of
+            the form
+            {'size': n, 'scores': 'distinct' or 'tied', 'engine': name,
+             'stages': {stage: stats}, 'differences': [...],
+             'tie_differences': [...]}
+            where the differences are failures and the tie differences are
+            the differences to the baseline on tied scores"""
+
+    if engines is None:
+        engines = ['legacy'] + sorted(
+            engine for engine in natcap.rios.rios._ALLOCATION_ENGINES
+            if engine != 'legacy')
+
+    results = []
+    for size in sizes:
+        for scores in ['distinct', 'tied']:
+            scores_dir = os.path.join(
+                workspace_dir, 'size_%d' % size, scores)
+            base_args = make_synthetic_inputs(
+                os.path.join(scores_dir, 'inputs'), size, seed=seed,
+                tied_scores=(scores == 'tied'))
+            output_dirs = {}
+            report_data = {}
+            for engine in [_BASELINE] + list(engines):
+                output_dirs[engine] = os.path.join(scores_dir, engine)
+                if os.path.exists(output_dirs[engine]):
+                    shutil.rmtree(output_dirs[engine])
+                LOGGER.info(
+                    'running %s on a %dx%d grid with %s scores', engine, size,
+                    size, scores)
+                report_data[engine], stage_stats = _run_engine(
+                    base_args, output_dirs[engine], engine)
+
+                differences = []
+                tie_differences = []
+                if engine != _BASELINE:
+                    baseline_differences = compare_engine_outputs(
+                        output_dirs[_BASELINE], report_data[_BASELINE],
+                        output_dirs[engine], report_data[engine])
+                    if scores == 'distinct':
+                        differences.extend(baseline_differences)
+                    else:
+                        tie_differences.extend(baseline_differences)
+                if engine not in [_BASELINE, engines[0]]:
+                    differences.extend(compare_engine_outputs(
+                        output_dirs[engines[0]], report_data[engines[0]],
+                        output_dirs[engine], report_data[engine],
+                        portfolio_uris=(
+                            _portfolio_uris() + _IN_SERIES_PORTFOLIO_URIS)))
+                if engine != _BASELINE:
+                    differences.extend(check_allocation_rank(
+                        output_dirs[engine], report_data[engine]))
+                results.append({
+                    'size': size,
+                    'scores': scores,
+                    'engine': engine,
+                    'stages': stage_stats,
+                    'differences': differences,
+                    'tie_differences': tie_differences,
+                    })
+    return results
+
+
+def make_synthetic_scoring_inputs(input_dir, size, seed=0):
+    """Builds a synthetic set of IPA scoring inputs: two objectives of
+        linear and lucode table factors, including the riparian continuity
+        and on-pixel retention factors and an inverted weight, sharing a
+        factor and a table factor, and three transitions.
+
+        input_dir - directory to write the synthetic rasters and table
+        size - the number of rows and columns of the synthetic grid
+        seed - seed for the random number generator
+
+        returns an `execute_30` args dictionary of the scoring arguments
+            without the workspace_dir"""
+
+    if not os.path.exists(input_dir):
+        os.makedirs(input_dir)
+    random_state = numpy.random.RandomState(seed)
+
+    lulc_uri = os.path.join(input_dir, 'lulc.tif')
+    lulc_array = random_state.choice(_LUCODES, size=(size, size)).astype(
+        numpy.int32)
+    lulc_array[random_state.rand(size, size) < 0.05] = -1
+    _make_raster(lulc_uri, lulc_array, -1, gdal.GDT_Int32)
+
+    factor_uris = {}
+    for factor_name in ['slope', 'rainfall', 'riparian', 'retention']:
+        factor_uris[factor_name] = os.path.join(
+            input_dir, factor_name + '.tif')
+        factor_array = (random_state.rand(size, size) * 100.0).astype(
+            numpy.float32)
+        factor_array[random_state.rand(size, size) < 0.05] = -9999.0
+        _make_raster(
+            factor_uris[factor_name], factor_array, -9999.0,
+            gdal.GDT_Float32)
+
+    coefficients_uri = os.path.join(input_dir, 'lulc_coefficients.csv')
+    with open(coefficients_uri, 'wb') as coefficients_file:
+        coefficients_file.write('lucode,sed_exp,rough_rank\n')
+        for lucode in _LUCODES:
+            coefficients_file.write('%d,%f,%f\n' % (
+                lucode, random_state.rand(), random_state.rand()))
+
+    def _linear_factor(factor_name, inverted):
+        """A linearly normalized factor of the synthetic factor raster"""
+        return {
+            'raster_uri': factor_uris[factor_name],
+            'bins': {
+                'type': 'interpolated', 'interpolation': 'linear',
+                'inverted': inverted}}
+
+    def _table_factor(value_field):
+        """A factor looked up by lucode in the coefficients table"""
+        return {
+            'raster_uri': lulc_uri,
+            'bins': {
+                'uri': 'general_lulc_coefficients.csv',
+                'key_field': 'lucode', 'value_field': value_field}}
+
+    return {
+        'lulc_uri': lulc_uri,
+        'lulc_coefficients_table_uri': coefficients_uri,
+        'objectives': {
+            'erosion': {
+                'rios_model_type': 'rios_tier_0',
+                'factors': {
+                    'slope': _linear_factor('slope', False),
+                    'Riparian continuity': _linear_factor('riparian', True),
+                    'On-pixel retention': _linear_factor('retention', False),
+                    'cover': _table_factor('Sed_Exp'),
+                    },
+                'priorities': {
+                    'protection': {
+                        'slope': 0.5, 'Riparian continuity': '~0.3',
+                        'On-pixel retention': 0.2, 'cover': 1.0},
+                    'restoration': {'slope': 1.0, 'cover': '~2'},
+                    },
+                },
+            'flooding': {
+                'rios_model_type': 'rios_tier_0',
+                'factors': {
+                    'slope': _linear_factor('slope', False),
+                    'rainfall': _linear_factor('rainfall', False),
+                    'roughness': _table_factor('Rough_Rank'),
+                    },
+                'priorities': {
+                    'protection': {'rainfall': 1.0},
+                    'restoration': {'slope': 0.5, 'roughness': 0.5},
+                    'agriculture': {'rainfall': 0.3, 'roughness': 1.0},
+                    },
+                },
+            },
+        'priorities': {
+            'protection': {'erosion': 0.6, 'flooding': 0.4},
+            'restoration': {'erosion': 1.0, 'flooding': 0.0},
+            'agriculture': {'flooding': 1.0},
+            },
+        'transition_types': [
+            {'file_name': 'protection', 'transition_type': 'protection'},
+            {'file_name': 'restoration', 'transition_type': 'restoration'},
+            {'file_name': 'agriculture', 'transition_type': 'agriculture'},
+            ],
+        'transition_map': {
+            'protection': {
+                'activity_a': 1, 'activity_b': 0, 'activity_c': 1},
+            'restoration': {
+                'activity_a': 1, 'activity_b': 1, 'activity_c': 0},
+            'agriculture': {
+                'activity_a': 0, 'activity_b': 1, 'activity_c': 0.5},
+            },
+        }
+
+
+def compare_fused_scoring(workspace_dir, size, seed=0):
+    """Runs the staged and the fused IPA scoring on synthetic inputs and
+        diffs the activity score and max transition rasters they write.
+
+        workspace_dir - directory for the synthetic inputs and outputs
+        size - the number of rows and columns of the synthetic grid
+        seed - seed for the synthetic inputs
+
+        returns a dictionary of the form
+            {'size': n, 'times': {'staged': seconds, 'fused': seconds},
+             'differences': [...]}"""
+
+    size_dir = os.path.join(workspace_dir, 'scoring_size_%d' % size)
+    input_dir = os.path.join(size_dir, 'inputs')
+    times = {}
+    activity_dirs = {}
+    for mode in ['staged', 'fused']:
+        # the scoring updates the factors in its args
+        args = make_synthetic_scoring_inputs(input_dir, size, seed=seed)
+        args['workspace_dir'] = os.path.join(size_dir, mode)
+        if os.path.exists(args['workspace_dir']):
+            shutil.rmtree(args['workspace_dir'])
+        args['fused_scoring'] = mode == 'fused'
+        LOGGER.info('running the %s scoring on a %dx%d grid', mode, size, size)
+        start_time = time.time()
+        dir_registry, _, _ = (
+            natcap.rios.rios._calculate_ipa_activity_scores(args, ''))
+        times[mode] = time.time() - start_time
+        activity_dirs[mode] = dir_registry['ipa_activity_dir']
+
+    differences = []
+    score_uris = sorted(
+        filename for filename in os.listdir(activity_dirs['staged'])
+        if filename.endswith('.tif'))
+    fused_uris = sorted(
+        filename for filename in os.listdir(activity_dirs['fused'])
+        if filename.endswith('.tif'))
+    if score_uris != fused_uris:
+        differences.append('activity_scores: %s != %s' % (
+            score_uris, fused_uris))
+    for score_uri in sorted(set(score_uris) & set(fused_uris)):
+        staged_array = _read_raster(
+            os.path.join(activity_dirs['staged'], score_uri))
+        fused_array = _read_raster(
+            os.path.join(activity_dirs['fused'], score_uri))
+        if (staged_array.dtype != fused_array.dtype or
+                staged_array.tostring() != fused_array.tostring()):
+            differences.append('%s: %d pixels differ' % (
+                score_uri, numpy.count_nonzero(
+                    (staged_array != fused_array) &
+                    ~(numpy.isnan(staged_array) & numpy.isnan(fused_array)))))
+    return {'size': size, 'times': times, 'differences': differences}
+
+
+def _reference_priority_op(raster_nodata, weights, out_nodata):
+    """The objective transition kernel `natcap.rios.rios._make_priority_op`
+        replaced, kept as the reference for `benchmark_priority_kernel`"""
+
+    def calculate_priority(*pixels):
+        pixel_sum = numpy.zeros(pixels[0].shape)
+        user_factor_sum = numpy.zeros(pixels[0].shape)
+
+        onpixel_value = numpy.empty(pixels[0].shape)
+        onpixel_value[:] = -1.0
+
+        nodata_mask = numpy.zeros(pixels[0].shape, dtype=bool)
+        riparian_nodata_mask = numpy.zeros(pixels[0].shape, dtype=bool)
+
+        for index in range(len(pixels)):
+            pixel_value_copy = pixels[index].copy()
+            weight, invert, is_riparian, is_onpixel = weights[index]
+
+            raster_nodata_mask = (pixel_value_copy == raster_nodata[index])
+
+            if is_riparian:
+                riparian_nodata_mask = raster_nodata_mask
+            else:
+                nodata_mask = raster_nodata_mask | nodata_mask
+
+            user_factor_sum += numpy.where(raster_nodata_mask, 0, weight)
+
+            if invert:
+                pixel_value_copy = numpy.where(
+                    raster_nodata_mask, raster_nodata[index],
+                    1-pixel_value_copy)
+
+            if is_onpixel:
+                onpixel_value = numpy.where(
+                    raster_nodata_mask, -1.0, pixel_value_copy)
+
+            pixel_sum += numpy.where(
+                raster_nodata_mask, 0, weight * pixel_value_copy)
+
+        user_factor_sum = numpy.where(
+            user_factor_sum == 0.0, 1.0, user_factor_sum)
+
+        pixel_sum += numpy.where(
+            ~nodata_mask & riparian_nodata_mask & (onpixel_value != -1.0),
+            onpixel_value*0.5, 0)
+        user_factor_sum += numpy.where(
+            ~nodata_mask & riparian_nodata_mask & (onpixel_value != -1.0), 0.5,
+            0)
+
+        result = (pixel_sum / user_factor_sum)
+        return numpy.where(nodata_mask, out_nodata, result)
+
+    return calculate_priority
+
+
+def benchmark_priority_kernel(block_size=256, n_blocks=64, seed=0):
+    """Times the objective transition kernel against the calculation it
+        replaced on random float32 factor blocks with nodata, an inverted
+        factor and the riparian and on-pixel factors.
+
+        block_size - the number of rows and columns of a block
+        n_blocks - the number of blocks to time each kernel on
+        seed - seed for the random blocks
+
+        returns a dictionary of the form
+            {'block_size': n, 'n_blocks': n, 'reference_time': seconds,
+             'kernel_time': seconds, 'identical': True/False}"""
+
+    random_state = numpy.random.RandomState(seed)
+    factor_names = [
+        'slope', 'erosivity', 'Riparian continuity', 'On-pixel retention',
+        'soil depth']
+    factor_weights = [0.5, 1.0, 0.3, 0.3, '~0.2']
+    nodata = -9999.0
+    weights = [
+        natcap.rios.rios._priority_weight(factor_name, factor_weight)
+        for factor_name, factor_weight in zip(factor_names, factor_weights)]
+    raster_nodata = [nodata] * len(weights)
+    out_nodata = -1.0
+
+    blocks = []
+    for _ in xrange(n_blocks):
+        factor_blocks = []
+        for _ in weights:
+            block = random_state.rand(block_size, block_size).astype(
+                numpy.float32)
+            block[random_state.rand(block_size, block_size) < 0.05] = nodata
+            factor_blocks.append(block)
+        blocks.append(factor_blocks)
+
+    timings = {}
+    results = {}
+    for kernel_name, make_op in [
+            ('reference', _reference_priority_op),
+            ('kernel', natcap.rios.rios._make_priority_op)]:
+        calculate_priority = make_op(raster_nodata, weights, out_nodata)
+        start_time = time.time()
+        results[kernel_name] = [
+            calculate_priority(*factor_blocks) for factor_blocks in blocks]
+        timings[kernel_name] = time.time() - start_time
+
+    identical = all(
+        reference.dtype == kernel.dtype and
+        reference.tostring() == kernel.tostring()
+        for reference, kernel in zip(results['reference'], results['kernel']))
+    return {
+        'block_size': block_size,
+        'n_blocks': n_blocks,
+        'reference_time': timings['reference'],
+        'kernel_time': timings['kernel'],
+        'identical': identical,
+        }
+
+
+def _format_results(results):
+    """Formats the benchmark results as a text table"""
+
+    stage_names = ['mask', 'sort', 'allocate', 'write', 'total']
+    lines = ['%-8s %-8s %-8s %s %s' % (
+        'size', 'scores', 'engine',
+        ' '.join('%18s' % stage for stage in stage_names), 'result')]
+    for result in results:
+        stage_columns = []
+        for stage_name in stage_names:
+            stats = result['stages'].get(stage_name)
+            if stats is None:
+                stage_columns.append('%18s' % '-')
+                continue
+            peak_rss = stats['peak_rss_mb']
+            stage_columns.append('%8.2fs %7sMB' % (
+                stats['time'],
+                '?' if peak_rss is None else '%.0f' % peak_rss))
+        if result['differences']:
+            status = 'DIFFERENT'
+        elif result['tie_differences']:
+            status = 'ties differ from baseline'
+        else:
+            status = 'identical'
+        lines.append('%-8d %-8s %-8s %s %s' % (
+            result['size'], result['scores'], result['engine'],
+            ' '.join(stage_columns), status))
+        for difference in result['differences']:
+            lines.append('    ' + difference)
+        for difference in result['tie_differences']:
+            lines.append('    tie order vs %s: %s' % (_BASELINE, difference))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    """Command line entry point, returns 0 if every engine matched and the
+        fused scoring matched the staged scoring."""
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument(
+        '--sizes', type=int, nargs='+', default=[128, 512, 1024],
+        help='grid sizes (rows and columns) to benchmark')
+    parser.add_argument(
+        '--engines', nargs='+', default=None,
+        help='allocation engines to run after the baseline, the first is '
+        'the reference on tied scores')
+    parser.add_argument(
+        '--workspace', default=None,
+        help='workspace directory, a temporary one is used if not given')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument(
+        '--priority-kernel', action='store_true',
+        help='only time the objective transition kernel on --sizes blocks')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(
+        level=logging.WARNING, format='%(asctime)s %(name)s %(message)s')
+
+    if args.priority_kernel:
+        all_identical = True
+        for size in args.sizes:
+            result = benchmark_priority_kernel(
+                block_size=size, n_blocks=max(1, 2**22 / (size * size)),
+                seed=args.seed)
+            print '%-8d %6d blocks reference %8.3fs kernel %8.3fs %s' % (
+                size, result['n_blocks'], result['reference_time'],
+                result['kernel_time'],
+                'identical' if result['identical'] else 'DIFFERENT')
+            all_identical = all_identical and result['identical']
+        return 0 if all_identical else 1
+
+    workspace_dir = args.workspace
+    if workspace_dir is None:
+        workspace_dir = tempfile.mkdtemp(prefix='ipa_benchmark_')
+    results = run_benchmark(
+        workspace_dir, args.sizes, engines=args.engines, seed=args.seed)
+    print _format_results(results)
+    scoring_results = [
+        compare_fused_scoring(workspace_dir, size, seed=args.seed)
+        for size in args.sizes]
+    for result in scoring_results:
+        print '%-8d staged scoring %8.2fs fused scoring %8.2fs %s' % (
+            result['size'], result['times']['staged'],
+            result['times']['fused'],
+            'identical' if not result['differences'] else 'DIFFERENT')
+        for difference in result['differences']:
+            print '    ' + difference
+    if args.workspace is None:
+        shutil.rmtree(workspace_dir)
+    if any(result['differences'] for result in results + scoring_results):
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
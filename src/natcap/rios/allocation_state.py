@@ -0,0 +1,175 @@
+"""RIOS's portfolio allocation state: which pixels are taken, by which
+activity and in which year, kept in a tiled layout so pixels that are close
+on the map are close in memory."""
+
+import os
+import logging
+
+import numpy
+import pygeoprocessing
+
+LOGGER = logging.getLogger('natcap.rios.allocation_state')
+
+# width and height in pixels of the tiles the state is laid out in
+_TILE_SIZE = 256
+
+
+def _smallest_uint_dtype(max_value):
+    """Returns the narrowest unsigned numpy integer dtype that holds
+        0..max_value"""
+    for dtype in [numpy.uint8, numpy.uint16, numpy.uint32]:
+        if max_value <= numpy.iinfo(dtype).max:
+            return dtype
+    return numpy.uint64
+
+
+class AllocationState(object):
+    """The activity allocated to each pixel of a raster and the year it was
+    allocated in.
+
+    Whether a pixel is taken is a bit in a packed bitmap held in memory, one
+    eighth of a byte per pixel, which is all an allocation has to read.  The
+    activity index and year of each pixel are packed into a single code that
+    is only written during the allocation, to a memory mapped file that's
+    read back when the portfolio is written out.  The code takes one byte
+    per pixel as long as there are fewer than 255 activity and year
+    combinations.  Both are laid out tile by tile rather than row by row."""
+
+    def __init__(self, n_rows, n_cols, n_activities, n_years,
+                 tile_size=_TILE_SIZE):
+        """Parameters:
+            n_rows (int): number of rows in the raster
+            n_cols (int): number of columns in the raster
+            n_activities (int): number of activities that can be allocated
+            n_years (int): number of years pixels can be allocated in
+            tile_size (int): width and height in pixels of a tile"""
+
+        self.n_rows = n_rows
+        self.n_cols = n_cols
+        self.n_activities = n_activities
+        self.tile_size = tile_size
+        self.n_tile_rows = -(-n_rows // tile_size)
+        self.n_tile_cols = -(-n_cols // tile_size)
+        n_tiled_pixels = (
+            self.n_tile_rows * self.n_tile_cols * tile_size * tile_size)
+        self._taken = numpy.zeros((-(-n_tiled_pixels // 8),), dtype=numpy.uint8)
+        #the year index * n_activities + activity index + 1 of each pixel, 0
+        #while it's unallocated, so a fresh file is already in its initial
+        #state
+        code_dtype = _smallest_uint_dtype(n_activities * n_years)
+        #the year index + 1 as read back, 0 for unallocated pixels
+        self.year_dtype = _smallest_uint_dtype(n_years)
+        self._code_path = pygeoprocessing.geoprocessing.temporary_filename()
+        self._codes = numpy.memmap(
+            self._code_path, dtype=code_dtype, mode='w+',
+            shape=(n_tiled_pixels,))
+
+    def _tiled_index(self, flat_index):
+        """Returns the tiled layout position of row major flat indexes"""
+        if isinstance(flat_index, numpy.ndarray):
+            flat_index = flat_index.astype(numpy.int64)
+        row, col = divmod(flat_index, self.n_cols)
+        tile_row, pixel_row = divmod(row, self.tile_size)
+        tile_col, pixel_col = divmod(col, self.tile_size)
+        return (
+            (tile_row * self.n_tile_cols + tile_col) * self.tile_size +
+            pixel_row) * self.tile_size + pixel_col
+
+    def available(self, flat_index):
+        """Checks whether pixels are unallocated.
+
+        Parameters:
+            flat_index (int or numpy.array): row major pixel indexes
+
+        Returns:
+            True where the pixel is unallocated, a bool or a boolean array
+            parallel to `flat_index`"""
+
+        tiled_index = self._tiled_index(flat_index)
+        return (self._taken[tiled_index >> 3] >> (tiled_index & 7)) & 1 == 0
+
+    def allocate(self, flat_index, activity_index, year_index):
+        """Allocates pixels to activities.
+
+        Parameters:
+            flat_index (int or numpy.array): row major indexes of distinct
+                unallocated pixels
+            activity_index (int or numpy.array): the activity index of each
+                pixel in `flat_index`
+            year_index (int): the index of the budget year the pixels are
+                allocated in
+
+        Returns:
+            None"""
+
+        tiled_index = self._tiled_index(flat_index)
+        self._codes[tiled_index] = (
+            numpy.asarray(activity_index) + year_index * self.n_activities + 1)
+        if not isinstance(tiled_index, numpy.ndarray):
+            self._taken[tiled_index >> 3] |= 1 << (tiled_index & 7)
+            return
+        if tiled_index.size == 0:
+            return
+        #several pixels can share a byte of the bitmap, their bits are
+        #or'ed together before the byte is updated
+        tiled_index = numpy.sort(tiled_index)
+        byte_index = tiled_index >> 3
+        bits = (1 << (tiled_index & 7)).astype(numpy.uint8)
+        byte_starts = numpy.flatnonzero(numpy.concatenate((
+            [True], byte_index[1:] != byte_index[:-1])))
+        self._taken[byte_index[byte_starts]] |= numpy.bitwise_or.reduceat(
+            bits, byte_starts)
+
+    def _read_tiled_rows(self, tiled_array, row_start, row_stop):
+        """Reads a range of rows of a tiled array back in row major order.
+
+        Returns:
+            a (row_stop - row_start, n_cols) array"""
+
+        tile_pixels = self.tile_size * self.tile_size
+        row_blocks = []
+        for tile_row in xrange(
+                row_start // self.tile_size,
+                -(-row_stop // self.tile_size)):
+            tile_row_start = tile_row * self.n_tile_cols * tile_pixels
+            tiles = tiled_array[
+                tile_row_start:tile_row_start + self.n_tile_cols * tile_pixels]
+            rows = tiles.reshape(
+                self.n_tile_cols, self.tile_size, self.tile_size).transpose(
+                    1, 0, 2).reshape(
+                        self.tile_size, self.n_tile_cols * self.tile_size)
+            first_row = tile_row * self.tile_size
+            row_blocks.append(rows[
+                max(row_start, first_row) - first_row:
+                min(row_stop, first_row + self.tile_size) - first_row,
+                0:self.n_cols])
+        return numpy.concatenate(row_blocks)
+
+    def read_rows(self, row_start, row_stop, nodata):
+        """Reads the allocated activity indexes and years of a range of rows.
+
+        Parameters:
+            row_start (int): the first row to read
+            row_stop (int): the row after the last row to read
+            nodata (int): the activity index of unallocated pixels
+
+        Returns:
+            a tuple of (row_stop - row_start, n_cols) arrays of the uint8
+            activity indexes and the `year_dtype` year index + 1 of each
+            pixel's allocation, 0 where it's unallocated"""
+
+        code_rows = self._read_tiled_rows(
+            self._codes, row_start, row_stop).astype(numpy.int64)
+        #shifting the codes by n_activities - 1 maps unallocated pixels to
+        #year 0 without a separate pass
+        code_rows += self.n_activities - 1
+        year_rows, activity_rows = divmod(code_rows, self.n_activities)
+        activity_rows = activity_rows.astype(numpy.uint8)
+        activity_rows[year_rows == 0] = nodata
+        return activity_rows, year_rows.astype(self.year_dtype)
+
+    def close(self):
+        """Releases the memory mapped code file and removes it"""
+        self._codes = None
+        if os.path.exists(self._code_path):
+            os.remove(self._code_path)
@@ -1,156 +1,634 @@
 """RIOS's disk based pixel sorting routine"""
 
 import tempfile
-import struct
-import heapq
 import atexit
 import os
+import json
+import shutil
+import hashlib
+import logging
 
 import numpy
 import pygeoprocessing
 
+try:
+    import psutil
+except ImportError:
+    psutil = None
 
-def sort_to_disk(
-        dataset_uri, dataset_index, score_weight=1.0,
-        cache_element_size=2**17):
-    """Sorts the non-nodata pixels in the dataset on disk and returns
-    an iterable in sorted order.
+LOGGER = logging.getLogger('natcap.rios.disk_sort')
+
+# total number of records held in memory across all runs while merging
+# the sorted runs of a single dataset back together
+_MERGE_BUFFER_SIZE = 2**22
+# smallest number of records read from a run at once
+_MIN_RUN_READ_SIZE = 2**10
+# fraction of the currently available memory a single sort may use when no
+# explicit memory budget is given
+_MEMORY_FRACTION = 0.25
+# used when the available memory can't be determined on this platform
+_DEFAULT_MEMORY_BUDGET = 2**30
+# bytes per pixel of the temporaries made from each block while sorting: the
+# block as read and scaled (up to 8 bytes each), the float32 scores and their
+# flattened copy, the flat indexes (up to 8 bytes) and the valid mask
+_BLOCK_BYTES_PER_PIXEL = 8 + 8 + 4 + 4 + 8 + 1
+# version of the persisted sorted index format, bump this whenever the
+# records or the header change so old indexes are rebuilt
+SORTED_INDEX_VERSION = 1
+# record type of the arrays returned by BatchMerge
+MERGE_DTYPE = numpy.dtype([
+    ('score', numpy.float32), ('index', numpy.int64), ('dataset', numpy.int32)])
+
+
+def record_dtype(n_elements):
+    """Builds the structured dtype used to store sorted (score, index) pairs.
 
     Parameters:
-        dataset_uri (string): a path to a floating point GDAL dataset
-        score_weight (float): a number to multiply all values by, which can be
-            used to reverse the order of the iteration if negative.
-        cache_element_size (int): approximate number of single elements to hold
-            in memory before flushing to disk.  Due to the internal blocksize
-            of the input raster, it is possible this cache could go over
-            this value by that size before the cache is flushed.
+        n_elements (int): total number of pixels in the raster, used to pick
+            the smallest integer type that can hold a flat index.
+
+    Returns:
+        a numpy.dtype with a float32 'score' and an int32/int64 'index'
+        field."""
+
+    if n_elements < 2**31:
+        index_type = numpy.int32
+    else:
+        index_type = numpy.int64
+    return numpy.dtype([('score', numpy.float32), ('index', index_type)])
+
+
+def available_memory():
+    """Returns the number of bytes of physical memory currently available,
+    or None if it can't be determined on this platform."""
+
+    if psutil is not None:
+        return psutil.virtual_memory().available
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def default_memory_budget():
+    """Returns the number of bytes sorts may use when they aren't given a
+    memory budget: a fraction of the currently available memory."""
+
+    memory_budget = available_memory()
+    if memory_budget is None:
+        return _DEFAULT_MEMORY_BUDGET
+    return int(memory_budget * _MEMORY_FRACTION)
+
+
+def sort_bytes_per_record(dtype):
+    """Returns the peak number of bytes a sort holds per record: the cached
+    records, their concatenated copy, lexsort's int64 permutation and the
+    sorted copy are all alive at once.
+
+    Parameters:
+        dtype (numpy.dtype): record dtype, see `record_dtype`"""
+
+    return 3 * dtype.itemsize + 8
+
+
+def sort_records(records):
+    """Sorts a (score, index) record array by score, then by index.
+
+    Parameters:
+        records (numpy.array): a record array of `record_dtype`
+
+    Returns:
+        a new record array in increasing (score, index) order."""
+
+    return records[numpy.lexsort((records['index'], records['score']))]
+
+
+def count_not_greater(records, bound_score, bound_index):
+    """Counts the leading records that are <= (bound_score, bound_index).
+
+    Parameters:
+        records (numpy.array): a record array in increasing (score, index)
+            order.
+        bound_score (float): score component of the bounding key
+        bound_index (int): index component of the bounding key
 
     Returns:
-        an iterable that produces (value * score_weight, flat_index) in
-        decreasing sorted order by value * score_weight"""
-
-    def _read_score_index_from_disk(
-            score_file_name, index_file_name, buffer_size=1024):
-        """Generator to yield a float/int value from the given filenames.
-        reads a buffer of `buffer_size` big before to avoid keeping the
-        file open between generations."""
-
-        score_buffer = ''
-        index_buffer = ''
-        file_offset = 0
-        buffer_offset = 1  # initialize to 1 to trigger the first load
+        number of records at the start of `records` whose (score, index)
+        key is lexicographically less than or equal to the bound."""
+
+    scores = records['score']
+    left_index = numpy.searchsorted(scores, bound_score, side='left')
+    right_index = numpy.searchsorted(scores, bound_score, side='right')
+    return left_index + numpy.searchsorted(
+        records['index'][left_index:right_index], bound_index, side='right')
+
+
+class SortedRuns(object):
+    """A set of sorted (score, flat_index) runs stored back to back in a
+    single binary file of `record_dtype` records, or a single sorted run held
+    in memory.
+
+    Each run is individually sorted by (score, flat_index); `iterbatches`
+    merges them into a single stream."""
+
+    def __init__(self, run_path, dtype, run_bounds, records=None):
+        """Parameters:
+            run_path (string): path to the binary file holding the runs, None
+                if the runs are held in memory
+            dtype (numpy.dtype): record dtype of the runs, see `record_dtype`
+            run_bounds (list): list of (start, stop) record offsets of each
+                run in `run_path` or `records`
+            records (numpy.array): if not None, a sorted in memory record
+                array to use instead of `run_path`"""
+
+        self.run_path = run_path
+        self.dtype = dtype
+        self.run_bounds = run_bounds
+        self.records = records
+        self.n_elements = sum(stop - start for start, stop in run_bounds)
+        # bytes of records held in memory for as long as the runs are
+        self.nbytes = records.nbytes if records is not None else 0
+
+    def iterbatches(self, merge_buffer_size=_MERGE_BUFFER_SIZE):
+        """Merges the sorted runs and yields them in batches.
+
+        Parameters:
+            merge_buffer_size (int): approximate number of records to hold in
+                memory across all the runs during the merge.
+
+        Returns:
+            an iterable of record arrays, each sorted in increasing
+            (score, index) order and each following on from the last."""
+
+        if self.n_elements == 0:
+            return
+        if self.records is not None:
+            # a single run that's already in memory doesn't need merging
+            for start, stop in self.run_bounds:
+                for batch_start in xrange(start, stop, merge_buffer_size):
+                    yield self.records[
+                        batch_start:min(batch_start + merge_buffer_size, stop)]
+            return
+        records = numpy.memmap(self.run_path, dtype=self.dtype, mode='r')
+        run_offsets = [
+            [start, stop] for start, stop in self.run_bounds if stop > start]
+        read_size = max(
+            _MIN_RUN_READ_SIZE, merge_buffer_size // len(run_offsets))
+        buffers = [records[0:0]] * len(run_offsets)
+
         while True:
-            if buffer_offset >= len(score_buffer):
-                score_file = open(score_file_name, 'rb')
-                index_file = open(index_file_name, 'rb')
-                score_file.seek(file_offset)
-                index_file.seek(file_offset)
-
-                score_buffer = score_file.read(buffer_size)
-                index_buffer = index_file.read(buffer_size)
-                score_file.close()
-                index_file.close()
-
-                file_offset += buffer_size
-                buffer_offset = 0
-            packed_score = score_buffer[buffer_offset:buffer_offset+4]
-            packed_index = index_buffer[buffer_offset:buffer_offset+4]
-            buffer_offset += 4
-            if not packed_score:
+            # refill any run buffers that were drained on the last pass
+            for run_index, (start, stop) in enumerate(run_offsets):
+                if buffers[run_index].size == 0 and start < stop:
+                    read_stop = min(start + read_size, stop)
+                    buffers[run_index] = numpy.array(records[start:read_stop])
+                    run_offsets[run_index][0] = read_stop
+            active_runs = [
+                run_index for run_index, run_buffer in enumerate(buffers)
+                if run_buffer.size > 0]
+            if len(active_runs) == 0:
                 break
-            yield (struct.unpack('f', packed_score)[0],
-                   struct.unpack('i', packed_index)[0]) + (dataset_index,)
+            if len(active_runs) == 1:
+                batch = buffers[active_runs[0]]
+                buffers[active_runs[0]] = records[0:0]
+                yield batch
+                continue
+
+            # Everything <= the smallest buffered tail is guaranteed to be
+            # ahead of anything that's still on disk, so it's safe to emit.
+            bound_score, bound_index = min(
+                (buffers[run_index]['score'][-1],
+                 buffers[run_index]['index'][-1])
+                for run_index in active_runs)
+            batch_list = []
+            for run_index in active_runs:
+                n_safe = count_not_greater(
+                    buffers[run_index], bound_score, bound_index)
+                batch_list.append(buffers[run_index][0:n_safe])
+                buffers[run_index] = buffers[run_index][n_safe:]
+            yield sort_records(numpy.concatenate(batch_list))
+        records = None
+
+
+class BatchMerge(object):
+    """A vectorized k-way merge over several SortedRuns.
 
-    def _sort_cache_to_iterator(index_cache, score_cache):
-        """Flushes the current cache to a heap and returns it
+    Records come back as `MERGE_DTYPE` arrays ordered by (score, index,
+    dataset), the same order `heapq.merge` gives over the tuples generated
+    by `sort_to_disk`.  Every dataset keeps its own read position, so a
+    dataset can be left out of (or put back into) the merge without
+    disturbing the others."""
+
+    def __init__(
+            self, sorted_runs_list, merge_buffer_size=_MERGE_BUFFER_SIZE):
+        """Parameters:
+            sorted_runs_list (list): a list of SortedRuns objects, a record's
+                'dataset' value is the position of its SortedRuns in this
+                list.
+            merge_buffer_size (int): approximate number of records to hold in
+                memory across all the datasets."""
+
+        self.n_datasets = len(sorted_runs_list)
+        dataset_buffer_size = max(
+            _MIN_RUN_READ_SIZE,
+            merge_buffer_size // max(1, self.n_datasets))
+        self._fill_size = max(1, dataset_buffer_size // 2)
+        self._streams = [
+            sorted_runs.iterbatches(merge_buffer_size=dataset_buffer_size)
+            for sorted_runs in sorted_runs_list]
+        self._buffers = [
+            numpy.empty((0,), dtype=sorted_runs.dtype)
+            for sorted_runs in sorted_runs_list]
+        self._exhausted = [False] * self.n_datasets
+
+    def _fill(self, dataset_index):
+        """Tops up the buffer of `dataset_index` from its run stream.
+
+        Returns:
+            True if the dataset has any records left, False otherwise."""
+
+        dataset_buffer = self._buffers[dataset_index]
+        if (dataset_buffer.size < self._fill_size and
+                not self._exhausted[dataset_index]):
+            buffer_list = [dataset_buffer]
+            buffer_size = dataset_buffer.size
+            while buffer_size < self._fill_size:
+                try:
+                    batch = next(self._streams[dataset_index])
+                except StopIteration:
+                    self._exhausted[dataset_index] = True
+                    break
+                buffer_list.append(batch)
+                buffer_size += batch.size
+            self._buffers[dataset_index] = numpy.concatenate(buffer_list)
+        return self._buffers[dataset_index].size > 0
+
+    def peek(self, dataset_list, n_records):
+        """Looks ahead at the merge of the datasets in `dataset_list`.
 
         Parameters:
-            index_cache (1d numpy.array): contains flat indexes to the
-                score pixels `score_cache`
-            score_cache (1d numpy.array): contains score pixels
+            dataset_list (list): indexes of the datasets to include
+            n_records (int): maximum number of records to return
 
         Returns:
-            Iterable to visit scores/indexes in increasing score order."""
-
-        # sort the whole bunch to disk
-        sort_index = score_cache.argsort()
-        score_cache = score_cache[sort_index]
-        index_cache = index_cache[sort_index]
-
-        #Dump all the scores and indexes to disk
-        score_file = tempfile.NamedTemporaryFile(delete=False)
-        score_file.write(struct.pack('%sf' % score_cache.size, *score_cache))
-        index_file = tempfile.NamedTemporaryFile(delete=False)
-        index_file.write(struct.pack('%si' % index_cache.size, *index_cache))
-
-        index_cache = None
-        score_cache = None
-        sort_index = None
-
-        #Get the filename and register a command to delete it after the
-        #interpreter exits
-        score_file_name = score_file.name
-        score_file.close()
-        index_file_name = index_file.name
-        index_file.close()
-
-        def _remove_file(path):
-            """Function to remove a file and handle exceptions to
-                register in atexit."""
-            try:
-                os.remove(path)
-            except OSError:
-                # This happens if the file didn't exist, okay because
-                # maybe we deleted it in a method
-                pass
-        atexit.register(_remove_file, score_file_name)
-        atexit.register(_remove_file, index_file_name)
-        return _read_score_index_from_disk(score_file_name, index_file_name)
+            a `MERGE_DTYPE` array of at most `n_records` records in merged
+            order.  It is empty only when all the datasets in `dataset_list`
+            are exhausted.  Nothing is consumed until `advance` is called."""
+
+        dataset_list = [
+            dataset_index for dataset_index in sorted(set(dataset_list))
+            if self._fill(dataset_index)]
+        if len(dataset_list) == 0:
+            return numpy.empty((0,), dtype=MERGE_DTYPE)
+
+        # Everything <= the smallest buffered tail is guaranteed to be ahead
+        # of anything that's still on disk, so it's safe to merge.
+        bound_score, bound_index, bound_dataset = min(
+            (self._buffers[dataset_index]['score'][-1],
+             self._buffers[dataset_index]['index'][-1], dataset_index)
+            for dataset_index in dataset_list)
+
+        candidate_list = []
+        for dataset_index in dataset_list:
+            dataset_buffer = self._buffers[dataset_index]
+            n_safe = count_not_greater(
+                dataset_buffer, bound_score, bound_index)
+            if (dataset_index > bound_dataset and n_safe > 0 and
+                    dataset_buffer['score'][n_safe-1] == bound_score and
+                    dataset_buffer['index'][n_safe-1] == bound_index):
+                # same pixel and score as the bound, but this dataset sorts
+                # after it
+                n_safe -= 1
+            n_safe = min(n_safe, n_records)
+            candidates = numpy.empty((n_safe,), dtype=MERGE_DTYPE)
+            candidates['score'] = dataset_buffer['score'][0:n_safe]
+            candidates['index'] = dataset_buffer['index'][0:n_safe]
+            candidates['dataset'] = dataset_index
+            candidate_list.append(candidates)
+
+        candidates = numpy.concatenate(candidate_list)
+        if len(candidate_list) > 1:
+            candidates = candidates[numpy.lexsort((
+                candidates['dataset'], candidates['index'],
+                candidates['score']))]
+        return candidates[0:n_records]
+
+    def advance(self, records):
+        """Consumes records previously returned by `peek`.
+
+        Parameters:
+            records (numpy.array): a leading slice of the last array returned
+                by `peek`
+
+        Returns:
+            None"""
+
+        if records.size == 0:
+            return
+        n_consumed = numpy.bincount(
+            records['dataset'], minlength=self.n_datasets)
+        for dataset_index in numpy.nonzero(n_consumed)[0]:
+            self._buffers[dataset_index] = (
+                self._buffers[dataset_index][n_consumed[dataset_index]:])
+
+    def next(self, dataset_list, n_records):
+        """Consumes and returns the next records in the merge of the
+        datasets in `dataset_list`, see `peek` for parameters."""
+
+        records = self.peek(dataset_list, n_records)
+        self.advance(records)
+        return records
+
+    def skip(self, dataset_index):
+        """Discards the next record of a single dataset, if there is one.
+
+        Returns:
+            None"""
+
+        if self._fill(dataset_index):
+            self._buffers[dataset_index] = self._buffers[dataset_index][1:]
+
+
+def raster_content_hash(dataset_uri):
+    """Hashes the size, nodata value and pixel values of a raster.
+
+    Parameters:
+        dataset_uri (string): a path to a GDAL dataset
+
+    Returns:
+        a hex digest string that changes whenever the pixel values do."""
+
+    hasher = hashlib.sha1()
+    hasher.update(repr((
+        pygeoprocessing.get_row_col_from_uri(dataset_uri),
+        pygeoprocessing.get_nodata_from_uri(dataset_uri))))
+    for block_data, block in pygeoprocessing.iterblocks(dataset_uri):
+        hasher.update(repr((
+            block_data['xoff'], block_data['yoff'], block_data['win_xsize'],
+            block_data['win_ysize'], block.dtype.str)))
+        hasher.update(numpy.ascontiguousarray(block).tostring())
+    return hasher.hexdigest()
+
+
+def _sorted_index_uris(index_uri):
+    """Returns the (header, records) paths of the sorted index `index_uri`"""
+    return index_uri + '.json', index_uri + '.bin'
+
+
+def load_sorted_index(index_uri, content_hash, score_weight):
+    """Loads a sorted index previously saved by `save_sorted_index`.
+
+    Parameters:
+        index_uri (string): base path of the index files
+        content_hash (string): `raster_content_hash` of the raster the index
+            should have been sorted from
+        score_weight (float): the score weight the index should have been
+            sorted with
+
+    Returns:
+        a SortedRuns object over the saved records, or None if there's no
+        index or it doesn't match the version, content hash or score weight."""
+
+    header_uri, records_uri = _sorted_index_uris(index_uri)
+    try:
+        with open(header_uri, 'r') as header_file:
+            header = json.load(header_file)
+    except (IOError, ValueError):
+        return None
+    if (header.get('version') != SORTED_INDEX_VERSION or
+            header.get('content_hash') != content_hash or
+            header.get('score_weight') != score_weight or
+            not os.path.exists(records_uri)):
+        return None
+    dtype = numpy.dtype([
+        (str(name), str(type_string)) for name, type_string in header['dtype']])
+    run_bounds = [(start, stop) for start, stop in header['run_bounds']]
+    if os.path.getsize(records_uri) != (
+            sum(stop - start for start, stop in run_bounds) * dtype.itemsize):
+        return None
+    return SortedRuns(records_uri, dtype, run_bounds)
+
+
+def save_sorted_index(sorted_runs, index_uri, content_hash, score_weight):
+    """Saves sorted runs as a named, versioned index so a later sort of the
+    same raster can be skipped with `load_sorted_index`.
+
+    Parameters:
+        sorted_runs (SortedRuns): the runs to save, if they're in a temporary
+            run file the file is moved into the index.
+        index_uri (string): base path of the index files, a '.bin' records
+            file and a '.json' header are written.
+        content_hash (string): `raster_content_hash` of the sorted raster
+        score_weight (float): the score weight the runs were sorted with
+
+    Returns:
+        a SortedRuns object equivalent to `sorted_runs` that's backed by the
+        index."""
+
+    header_uri, records_uri = _sorted_index_uris(index_uri)
+    # the header is written last, so an index that's only partly written is
+    # never trusted
+    _remove_file(header_uri)
+    if sorted_runs.records is not None:
+        sorted_runs.records.tofile(records_uri)
+        saved_runs = sorted_runs
+    else:
+        _remove_file(records_uri)
+        shutil.move(sorted_runs.run_path, records_uri)
+        saved_runs = SortedRuns(
+            records_uri, sorted_runs.dtype, sorted_runs.run_bounds)
+    with open(header_uri, 'w') as header_file:
+        json.dump({
+            'version': SORTED_INDEX_VERSION,
+            'content_hash': content_hash,
+            'score_weight': score_weight,
+            'dtype': sorted_runs.dtype.descr,
+            'run_bounds': sorted_runs.run_bounds,
+            }, header_file, indent=4)
+    return saved_runs
+
+
+def _remove_file(path):
+    """Function to remove a file and handle exceptions to
+        register in atexit."""
+    try:
+        os.remove(path)
+    except OSError:
+        # This happens if the file didn't exist, okay because
+        # maybe we deleted it in a method
+        pass
+
+
+def sort_to_runs(
+        dataset_uri, score_weight=1.0, cache_element_size=None,
+        memory_budget=None, index_uri=None):
+    """Sorts the non-nodata pixels in the dataset into sorted runs.
+
+    If the whole raster can be sorted within the memory budget it's sorted
+    in a single pass in memory and nothing is written to disk.  Otherwise
+    runs as large as the memory budget allows are sorted to a file on disk.
+
+    Parameters:
+        dataset_uri (string): a path to a floating point GDAL dataset
+        score_weight (float): a number to multiply all values by, which can be
+            used to reverse the order of the iteration if negative.
+        cache_element_size (int): if not None, always sort to disk in runs of
+            approximately this many elements, ignoring `memory_budget`.  Due
+            to the internal blocksize of the input raster, it is possible this
+            cache could go over this value by that size before the cache is
+            flushed.
+        memory_budget (int): number of bytes the sort may use, defaults to
+            `default_memory_budget()`.  Callers that keep several in memory
+            sorts alive should take the `nbytes` of the earlier ones out of
+            the budget of the next.
+        index_uri (string): if not None, the base path of a persistent sorted
+            index for this raster.  If the index matches the raster's content
+            it's used instead of sorting, otherwise the raster is sorted and
+            the index is (re)written.
+
+    Returns:
+        a SortedRuns object whose records are (value * score_weight,
+        flat_index)."""
+
+    if index_uri is not None:
+        content_hash = raster_content_hash(dataset_uri)
+        sorted_runs = load_sorted_index(index_uri, content_hash, score_weight)
+        if sorted_runs is not None:
+            LOGGER.info('reusing sorted index %s', index_uri)
+            return sorted_runs
+        sorted_runs = sort_to_runs(
+            dataset_uri, score_weight=score_weight,
+            cache_element_size=cache_element_size,
+            memory_budget=memory_budget)
+        return save_sorted_index(
+            sorted_runs, index_uri, content_hash, score_weight)
 
     # scale the nodata so they can be filtered out in the sort later
     nodata = pygeoprocessing.get_nodata_from_uri(dataset_uri) * score_weight
 
-    # This will be a list of file iterators we'll pass to heap.merge
-    iters = []
+    n_rows, n_cols = pygeoprocessing.get_row_col_from_uri(dataset_uri)
+    dtype = record_dtype(n_rows * n_cols)
+
+    in_memory = False
+    size_cache_from_budget = cache_element_size is None
+    if size_cache_from_budget and memory_budget is None:
+        memory_budget = default_memory_budget()
 
-    _, n_cols = pygeoprocessing.get_row_col_from_uri(dataset_uri)
+    run_file = None
+    run_bounds = []
+    cache_list = []
+    cache_size = 0
+
+    def _flush_cache_to_run():
+        """Sorts the current cache and appends it as a run to `run_file`"""
+        records = sort_records(numpy.concatenate(cache_list))
+        records.tofile(run_file)
+        run_start = run_bounds[-1][1] if run_bounds else 0
+        run_bounds.append((run_start, run_start + records.size))
 
-    index_cache = numpy.empty((0,), dtype=numpy.int32)
-    score_cache = numpy.empty((0,), dtype=numpy.float32)
     for scores_data, scores_block in pygeoprocessing.iterblocks(dataset_uri):
+        if size_cache_from_budget:
+            # the budget has to hold the temporaries of a block on top of
+            # the cache, the first block is as large as any of them
+            size_cache_from_budget = False
+            cache_element_size = max(
+                _MIN_RUN_READ_SIZE,
+                (memory_budget - scores_block.size * _BLOCK_BYTES_PER_PIXEL)
+                // sort_bytes_per_record(dtype))
+            in_memory = n_rows * n_cols <= cache_element_size
+
         # flatten and scale the results
-        scores_block = scores_block.flatten() * score_weight
+        scores_block = (scores_block * score_weight).astype(
+            numpy.float32).flatten()
 
-        col_coords, row_coords = numpy.meshgrid(
-            xrange(scores_data['xoff'], scores_data['xoff'] +
-                   scores_data['win_xsize']),
-            xrange(scores_data['yoff'], scores_data['yoff'] +
-                   scores_data['win_ysize']))
+        flat_indexes = (
+            numpy.arange(
+                scores_data['yoff'],
+                scores_data['yoff'] + scores_data['win_ysize'],
+                dtype=dtype['index'])[:, numpy.newaxis] * n_cols +
+            numpy.arange(
+                scores_data['xoff'],
+                scores_data['xoff'] + scores_data['win_xsize'],
+                dtype=dtype['index'])).ravel()
 
-        flat_indexes = (col_coords + row_coords * n_cols).flatten()
+        # remove nodata values
+        valid_mask = scores_block != nodata
+        records = numpy.empty(numpy.count_nonzero(valid_mask), dtype=dtype)
+        records['score'] = scores_block[valid_mask]
+        records['index'] = flat_indexes[valid_mask]
+        cache_list.append(records)
+        cache_size += records.size
 
-        sort_index = scores_block.argsort()
-        sorted_scores = scores_block[sort_index]
-        sorted_indexes = flat_indexes[sort_index]
+        # check if we need to flush the cache
+        if not in_memory and cache_size >= cache_element_size:
+            if run_file is None:
+                run_file = tempfile.NamedTemporaryFile(delete=False)
+                #register a command to delete the runs after the interpreter
+                #exits
+                atexit.register(_remove_file, run_file.name)
+            _flush_cache_to_run()
+            cache_list = []
+            cache_size = 0
 
-        # search for nodata values are so we can splice them out
-        left_index = numpy.searchsorted(sorted_scores, nodata, side='left')
-        right_index = numpy.searchsorted(
-            sorted_scores, nodata, side='right')
+    if run_file is None:
+        # everything fit in the cache, sort it without touching the disk
+        if cache_size > 0:
+            records = sort_records(numpy.concatenate(cache_list))
+        else:
+            records = numpy.empty((0,), dtype=dtype)
+        return SortedRuns(None, dtype, [(0, records.size)], records=records)
 
-        # remove nodata values and sort in decreasing order
-        score_cache = numpy.concatenate(
-            (score_cache, sorted_scores[0:left_index],
-             sorted_scores[right_index::]))
-        index_cache = numpy.concatenate(
-            (index_cache, sorted_indexes[0:left_index],
-             sorted_indexes[right_index::]))
+    if cache_size > 0:
+        _flush_cache_to_run()
+    run_file.close()
 
-        # check if we need to flush the cache
-        if index_cache.size >= cache_element_size:
-            iters.append(_sort_cache_to_iterator(index_cache, score_cache))
-            index_cache = numpy.empty((0,), dtype=numpy.int32)
-            score_cache = numpy.empty((0,), dtype=numpy.float32)
+    return SortedRuns(run_file.name, dtype, run_bounds)
+
+
+def sort_to_disk(
+        dataset_uri, dataset_index, score_weight=1.0,
+        cache_element_size=None, memory_budget=None, index_uri=None):
+    """Sorts the non-nodata pixels in the dataset on disk and returns
+    an iterable in sorted order.
+
+    Parameters:
+        dataset_uri (string): a path to a floating point GDAL dataset
+        dataset_index (int): a value appended to every tuple generated by the
+            iterable, used to identify which dataset a pixel came from
+        score_weight (float): a number to multiply all values by, which can be
+            used to reverse the order of the iteration if negative.
+        cache_element_size (int): if not None, the approximate number of
+            elements to hold in memory before flushing to disk, see
+            `sort_to_runs`.
+        memory_budget (int): number of bytes the sort may use, see
+            `sort_to_runs`.
+        index_uri (string): base path of a persistent sorted index to reuse
+            or write, see `sort_to_runs`.
+
+    Returns:
+        an iterable that produces (value * score_weight, flat_index,
+        dataset_index) in increasing sorted order by value * score_weight,
+        ties broken by flat_index"""
+
+    sorted_runs = sort_to_runs(
+        dataset_uri, score_weight=score_weight,
+        cache_element_size=cache_element_size, memory_budget=memory_budget,
+        index_uri=index_uri)
+    return iterate_records(sorted_runs, dataset_index)
+
+
+def iterate_records(sorted_runs, dataset_index):
+    """Unpacks the merged batches of `sorted_runs` into tuples.
+
+    Parameters:
+        sorted_runs (SortedRuns): the runs to iterate over
+        dataset_index (int): a value appended to every tuple generated
+
+    Returns:
+        an iterable that produces (score, flat_index, dataset_index) in
+        increasing (score, flat_index) order"""
 
-    iters.append(_sort_cache_to_iterator(index_cache, score_cache))
-    return heapq.merge(*iters)
+    for batch in sorted_runs.iterbatches():
+        for score, flat_index in zip(
+                batch['score'].tolist(), batch['index'].tolist()):
+            yield (score, flat_index, dataset_index)
@@ -0,0 +1,238 @@
+"""RIOS's block based raster processing: aligns a set of rasters once and
+streams their blocks together so several outputs come from one read."""
+
+import os
+import logging
+import itertools
+import multiprocessing.pool
+
+import numpy
+from osgeo import gdal
+import pygeoprocessing
+
+LOGGER = logging.getLogger('natcap.rios.raster_engine')
+
+
+def align_rasters(
+        dataset_uri_list, pixel_size, dataset_to_align_index=0,
+        bounding_box_mode='intersection'):
+    """Aligns a list of rasters to a common grid.
+
+    Parameters:
+        dataset_uri_list - a list of uris to GDAL rasters
+        pixel_size - the output pixel size
+        dataset_to_align_index - the index of the raster in
+            `dataset_uri_list` whose upper left corner the outputs snap to,
+            None or negative to not snap
+        bounding_box_mode - 'intersection' (default) or 'union' of the
+            raster bounding boxes
+
+    Returns:
+        a list of uris to temporary aligned rasters parallel to
+        `dataset_uri_list`, the caller is responsible for removing them"""
+
+    aligned_uri_list = [
+        pygeoprocessing.geoprocessing.temporary_filename()
+        for _ in dataset_uri_list]
+    pygeoprocessing.geoprocessing.align_dataset_list(
+        dataset_uri_list, aligned_uri_list,
+        ['nearest'] * len(dataset_uri_list), pixel_size, bounding_box_mode,
+        -1 if dataset_to_align_index is None else dataset_to_align_index)
+    return aligned_uri_list
+
+
+def iterate_aligned_blocks(aligned_uri_list):
+    """Iterates over the blocks of a list of aligned rasters.
+
+    Parameters:
+        aligned_uri_list - a list of uris to rasters with the same size and
+            geotransform, such as the result of `align_rasters`
+
+    Returns:
+        a generator of (block_offset, block_list) where block_offset is a
+        dictionary with the keys 'xoff', 'yoff', 'win_xsize' and
+        'win_ysize' and block_list has the block of each raster in
+        `aligned_uri_list` order"""
+
+    datasets = [gdal.Open(uri) for uri in aligned_uri_list]
+    bands = [dataset.GetRasterBand(1) for dataset in datasets]
+    for block_offset, first_block in pygeoprocessing.iterblocks(
+            aligned_uri_list[0]):
+        block_list = [first_block] + [
+            band.ReadAsArray(**block_offset) for band in bands[1:]]
+        yield block_offset, block_list
+    bands = None
+    datasets = None
+
+
+def valid_value_range(dataset_uri, nodata):
+    """Finds the exact range of a raster's valid values in one pass over its
+        blocks.
+
+    Parameters:
+        dataset_uri - a uri to a GDAL raster
+        nodata - the raster's nodata value, pixels that are nodata or NaN
+            aren't valid
+
+    Returns:
+        a (min, max) tuple of the valid values, (None, None) if there are
+        none"""
+
+    value_min = None
+    value_max = None
+    for _, block in pygeoprocessing.iterblocks(dataset_uri):
+        valid_values = block[(block != nodata) & ~numpy.isnan(block)]
+        if valid_values.size == 0:
+            continue
+        block_min = valid_values.min()
+        block_max = valid_values.max()
+        if value_min is None or block_min < value_min:
+            value_min = block_min
+        if value_max is None or block_max > value_max:
+            value_max = block_max
+    if value_min is None:
+        return None, None
+    return value_min.item(), value_max.item()
+
+
+def vectorize_datasets(
+        dataset_uri_list, dataset_pixel_op, dataset_out_uri, datatype_out,
+        nodata_out, pixel_size_out, bounding_box_mode,
+        dataset_to_align_index=None, n_workers=None):
+    """A drop in for `pygeoprocessing.geoprocessing.vectorize_datasets` with
+        vectorize_op=False that can calculate the blocks in parallel.
+
+    Parameters:
+        n_workers - the number of threads to calculate blocks with.  None or
+            1 (default) calls pygeoprocessing directly.
+
+        The other parameters are the same as pygeoprocessing's.
+
+    Returns:
+        nothing"""
+
+    if n_workers is None or n_workers <= 1:
+        pygeoprocessing.geoprocessing.vectorize_datasets(
+            dataset_uri_list, dataset_pixel_op, dataset_out_uri,
+            datatype_out, nodata_out, pixel_size_out, bounding_box_mode,
+            dataset_to_align_index=dataset_to_align_index,
+            vectorize_op=False)
+        return
+
+    def _single_output_op(*blocks):
+        return [dataset_pixel_op(*blocks)]
+
+    multi_output_block_op(
+        dataset_uri_list, _single_output_op,
+        [(dataset_out_uri, datatype_out, nodata_out)], pixel_size_out,
+        dataset_to_align_index=dataset_to_align_index,
+        bounding_box_mode=bounding_box_mode, n_workers=n_workers)
+
+
+def multi_output_block_op(
+        dataset_uri_list, block_op, output_list, pixel_size,
+        dataset_to_align_index=0, bounding_box_mode='intersection',
+        n_workers=None):
+    """Calculates several output rasters in a single pass over the aligned
+        blocks of the input rasters.
+
+    Parameters:
+        dataset_uri_list - a list of uris to GDAL rasters
+        block_op - a function that takes one array per raster in
+            `dataset_uri_list` and returns a list of arrays, one per output
+        output_list - a list of (uri, gdal datatype, nodata) tuples
+            describing the output rasters
+        pixel_size - the output pixel size
+        dataset_to_align_index - the index of the raster in
+            `dataset_uri_list` whose upper left corner the outputs snap to,
+            None or negative to not snap
+        bounding_box_mode - 'intersection' (default) or 'union' of the
+            raster bounding boxes
+        n_workers - the number of threads to run `block_op` in, None or 1
+            (default) runs it in the calling thread.  `block_op` has to be
+            thread safe; numpy releases the GIL for most of the work on
+            large arrays.
+
+    Returns:
+        nothing"""
+
+    aligned_uri_list = align_rasters(
+        dataset_uri_list, pixel_size,
+        dataset_to_align_index=dataset_to_align_index,
+        bounding_box_mode=bounding_box_mode)
+    try:
+        aligned_block_op(
+            aligned_uri_list, block_op, output_list, n_workers=n_workers)
+    finally:
+        for aligned_uri in aligned_uri_list:
+            if os.path.exists(aligned_uri):
+                os.remove(aligned_uri)
+
+
+def aligned_block_op(aligned_uri_list, block_op, output_list, n_workers=None):
+    """Calculates several output rasters in a single pass over the blocks of
+        rasters that are already aligned.
+
+    Parameters:
+        aligned_uri_list - a list of uris to rasters with the same size and
+            geotransform, such as the result of `align_rasters`
+        block_op - a function that takes one array per raster in
+            `aligned_uri_list` and returns a list of arrays, one per output
+        output_list - a list of (uri, gdal datatype, nodata) tuples
+            describing the output rasters, which get the grid of
+            `aligned_uri_list` and their statistics calculated
+        n_workers - the number of threads to run `block_op` in, see
+            `multi_output_block_op`
+
+    Returns:
+        nothing"""
+
+    if n_workers is not None and n_workers > 1:
+        worker_pool = multiprocessing.pool.ThreadPool(n_workers)
+    else:
+        worker_pool = None
+    try:
+        for output_uri, datatype, nodata in output_list:
+            pygeoprocessing.geoprocessing.new_raster_from_base_uri(
+                aligned_uri_list[0], output_uri, 'GTiff', nodata, datatype)
+        output_datasets = [
+            gdal.Open(output_uri, gdal.GA_Update)
+            for output_uri, _, _ in output_list]
+        output_bands = [
+            dataset.GetRasterBand(1) for dataset in output_datasets]
+
+        def _calculate_block(block_data):
+            block_offset, block_list = block_data
+            return block_offset, block_op(*block_list)
+
+        block_iterator = iterate_aligned_blocks(aligned_uri_list)
+        while True:
+            #GDAL reads and writes stay in this thread, only a bounded
+            #number of blocks is in flight in the pool at once
+            if worker_pool is not None:
+                block_batch = list(
+                    itertools.islice(block_iterator, 2 * n_workers))
+                calculated_blocks = worker_pool.map(
+                    _calculate_block, block_batch)
+            else:
+                block_batch = list(itertools.islice(block_iterator, 1))
+                calculated_blocks = map(_calculate_block, block_batch)
+            if len(block_batch) == 0:
+                break
+            for block_offset, output_blocks in calculated_blocks:
+                for output_band, output_block in zip(
+                        output_bands, output_blocks):
+                    output_band.WriteArray(
+                        output_block, xoff=block_offset['xoff'],
+                        yoff=block_offset['yoff'])
+
+        output_bands = None
+        output_datasets = None
+    finally:
+        if worker_pool is not None:
+            worker_pool.close()
+            worker_pool.join()
+
+    #the same as pygeoprocessing's vectorize_datasets does for its output
+    for output_uri, _, _ in output_list:
+        pygeoprocessing.geoprocessing.calculate_raster_stats_uri(output_uri)
@@ -4,17 +4,23 @@ import webbrowser
 import logging
 import os
 import json
+import csv
 import shutil
 import heapq
 import datetime
-import tempfile
+import threading
+import uuid
+import collections
 
 from osgeo import gdal
 from osgeo import ogr
 from osgeo import osr
 import numpy
 
+import natcap.rios.allocation_state
 import natcap.rios.disk_sort
+import natcap.rios.raster_engine
+import natcap.rios.stage_scheduler
 import pygeoprocessing
 
 LOGGER = logging.getLogger('natcap.rios.ipa')
@@ -57,6 +63,49 @@ def execute_30(**args):
                  ...: ...}
             results_suffix - a string suffix to append to each of the output
                 files to differentate them between runs.
+            persist_sorted_index - (optional) if True the sorted activity
+                scores are kept in the activity_scores directory and reused
+                by later runs that only change the budget.  Each run then
+                reads every prioritization raster once more to hash it, and
+                the indexes take 8 bytes per valid pixel per activity (12 on
+                rasters of more than 2**31 pixels) until they're deleted.
+                Defaults to False.
+            write_allocation_rank - (optional) if True the allocation order
+                and its cumulative cost are written with the activity
+                portfolios so portfolios for other budgets can be cut out with
+                threshold_allocation_rank.
+            fused_scoring - (optional) if True the normalized factors,
+                objective transitions, global transitions and activity scores
+                are calculated in a single pass over the aligned inputs and
+                only the activity score and max transition rasters are
+                written.  Defaults to False.
+            fused_scoring_intermediates - (optional) a list of the
+                intermediates to also write in the fused pass, any of
+                'normalized_factors', 'objective_transitions' and
+                'global_transitions'.
+            n_workers - (optional) the number of threads to calculate the
+                blocks of each raster stage with.  Defaults to 1.
+            n_stage_workers - (optional) the number of independent raster
+                stages (normalized factors, transitions, activity scores and
+                activity masks) to calculate at once.  Defaults to 1.
+            stage_memory_limit - (optional) a limit in bytes on the estimated
+                memory of the raster stages running at once.
+            stage_cache - (optional) if True (default) the fingerprint of the
+                inputs and parameters of each normalized factor, objective
+                transition, global transition and activity score raster is
+                kept in the directory file registry with the modified time
+                and size of the raster, and stages whose fingerprint and
+                rasters haven't changed since the last run are skipped.
+            factor_cache_dir - (optional) a directory to keep the normalized
+                factors in instead of deleting them.  They are named after
+                their source raster, bins and LULC so the same normalization
+                is shared by the objectives and runs that use this directory.
+                The ranges of linear normalizations are kept next to them,
+                the fused pass only reads and records the ranges.
+            factor_cache_size_limit - (optional) the number of bytes the
+                normalized factors in factor_cache_dir can add up to, the
+                least recently used ones are removed after a run that goes
+                over it.  Defaults to no limit.
 
 
             objective dictionary:
@@ -78,20 +127,114 @@ def execute_30(**args):
     else:
         results_suffix = ''
 
+    dir_registry, file_registry, transition_dictionary = (
+        _calculate_ipa_activity_scores(args, results_suffix))
+    if dir_registry is None:
+        return
 
+    budget_args = _build_budget_args(
+        args, args['budget_config'], dir_registry, file_registry,
+        transition_dictionary, results_suffix)
 
-    LOGGER.info('ensuring that the optional objectives have non-empty factors')
-    _update_args_for_optional_parameters(args['objectives'])
+    LOGGER.info('Starting portfolio Selection')
+    LOGGER.debug("budget_args %s", str(budget_args))
+    report_data = []
+    calculate_activity_portfolio(budget_args, report_data)
+    LOGGER.info('Finished portfolio selection')
 
-    LOGGER.info('Updating references to the general LULC coefficients table')
-    _update_args_for_general_lulc_table_refs(
-        args['objectives'], args['lulc_coefficients_table_uri'],
-        args['lulc_uri'])
+    _create_ipa_report(
+        args['budget_config'], budget_args, report_data, dir_registry,
+        file_registry, results_suffix)
+    if args['open_html_on_completion']:
+        webbrowser.open(file_registry['ipa_report_uri'])
 
-    LOGGER.info('Starting Water Funds Prioritizer')
+    LOGGER.info('Finished Water Funds Prioritizer')
+    LOGGER.info(r'   ____               U  ___ u  ____     ')
+    LOGGER.info(r'U |  _"\ u     ___     \/"_ \/ / __"| u  ')
+    LOGGER.info(r' \| |_) |/    |_"_|    | | | |<\___ \/   ')
+    LOGGER.info(r'  |  _ <       | | .-,_| |_| | u___) |   ')
+    LOGGER.info(r'  |_| \_\    U/| |\u\_)-\___/  |____/>>  ')
+    LOGGER.info(r'  //   \\_.-,_|___|_,-.  \\     )(  (__) ')
+    LOGGER.info(r' (__)  (__)\_)-' '-(_/  (__)   (__)      ')
+
+
+def execute_budget_sweep(args, budget_configs):
+    """Runs the investment portfolio adviser for several budget scenarios.
+        The objectives, transition and activity scores are calculated once
+        and the activity scores are masked and sorted once; only the
+        portfolio selection is repeated for each scenario.
+
+        args - the same dictionary as execute_30.  args['budget_config'] is
+            not used.
+        budget_configs - a dictionary mapping scenario names to budget
+            configuration dictionaries of the same form as
+            args['budget_config'].  The outputs of a scenario are written to
+            activity_portfolios/<scenario name> with '_<scenario name>'
+            appended to the results suffix, and each scenario has its own
+            report and directory file registry.
+
+        returns a dictionary mapping each scenario name to the list of yearly
+            report data produced by its portfolio selection."""
+
+    if 'results_suffix' in args:
+        results_suffix = '_' + args['results_suffix']
+    else:
+        results_suffix = ''
+
+    dir_registry, file_registry, transition_dictionary = (
+        _calculate_ipa_activity_scores(args, results_suffix))
+    if dir_registry is None:
+        return
+
+    portfolio_data = None
+    sweep_report_data = {}
+    for scenario_name in sorted(budget_configs):
+        LOGGER.info('Starting portfolio selection for %s', scenario_name)
+        scenario_suffix = results_suffix + '_' + scenario_name
+        scenario_dir_registry, scenario_file_registry = _build_ipa_registries(
+            args, scenario_suffix, portfolio_subdir=scenario_name)
+        scenario_file_registry['transition_types_uri'] = (
+            file_registry['transition_types_uri'])
+        _write_ipa_registries(scenario_dir_registry, scenario_file_registry)
+
+        budget_args = _build_budget_args(
+            args, budget_configs[scenario_name], scenario_dir_registry,
+            scenario_file_registry, transition_dictionary, results_suffix,
+            portfolio_suffix=scenario_suffix)
+
+        if portfolio_data is None:
+            #the masked and sorted activity scores don't depend on the
+            #budget so they are shared by every scenario
+            portfolio_data = _prepare_activity_portfolio(budget_args)
+        report_data = []
+        _select_activity_portfolio(budget_args, portfolio_data, report_data)
+
+        _create_ipa_report(
+            budget_configs[scenario_name], budget_args, report_data,
+            scenario_dir_registry, scenario_file_registry, scenario_suffix)
+        sweep_report_data[scenario_name] = report_data
+
+    LOGGER.info('Finished budget sweep')
+    return sweep_report_data
+
+
+def _build_ipa_registries(args, results_suffix, portfolio_subdir=None):
+    """Builds the directory and file registries of an IPA run and creates the
+        IPA workspace.
+
+        args - the execute_30 argument dictionary.
+        results_suffix - a string appended to the output file names.
+        portfolio_subdir - (optional) a subdirectory of activity_portfolios
+            to write the portfolio outputs into.
+
+        returns a (dir_registry, file_registry) tuple"""
 
-    #make the file registry
     IPA_WORKSPACE = '1_investment_portfolio_adviser_workspace'
+    activity_portfolio_dir = os.path.join(
+        args['workspace_dir'], IPA_WORKSPACE, 'activity_portfolios')
+    if portfolio_subdir is not None:
+        activity_portfolio_dir = os.path.join(
+            activity_portfolio_dir, portfolio_subdir)
     dir_registry = {
         'ipa_workspace': os.path.join(args['workspace_dir'], IPA_WORKSPACE),
         'objective_subdir': 'objectives',
@@ -101,8 +244,7 @@ def execute_30(**args):
             args['workspace_dir'], IPA_WORKSPACE, 'transition_scores'),
         'ipa_activity_dir': os.path.join(
             args['workspace_dir'], IPA_WORKSPACE, 'activity_scores'),
-        'ipa_activity_portfolio_dir': os.path.join(
-            args['workspace_dir'], IPA_WORKSPACE, 'activity_portfolios'),
+        'ipa_activity_portfolio_dir': activity_portfolio_dir,
         'ipa_report_dir': os.path.join(
             args['workspace_dir'], IPA_WORKSPACE, 'html_report%s' % results_suffix),
         }
@@ -128,16 +270,67 @@ def execute_30(**args):
             'activity_raster_id_to_type%s.csv' % results_suffix),
         'lulc_uri': args['lulc_uri'],
         }
+    return dir_registry, file_registry
 
-    #Save the directory and file registry files to a directory
+
+def _write_ipa_registries(dir_registry, file_registry):
+    """Saves the directory and file registries to the json file at
+        file_registry['directory_file_registry'], keeping the stage
+        fingerprints already in it
+
+        returns nothing"""
+
+    registry_data = {
+        'dir_registry': dir_registry,
+        'file_registry': file_registry
+        }
+    #keep the stage fingerprints of earlier runs, see StageCache
+    if os.path.exists(file_registry['directory_file_registry']):
+        with open(file_registry['directory_file_registry'], 'r') as (
+                directory_file_registry_file):
+            try:
+                registry_data['stage_fingerprints'] = json.load(
+                    directory_file_registry_file)['stage_fingerprints']
+            except (ValueError, KeyError):
+                pass
     directory_file_registry_file = open(
         file_registry['directory_file_registry'], 'w')
-    json.dump({
-            'dir_registry': dir_registry,
-            'file_registry': file_registry
-            }, directory_file_registry_file, indent=4)
+    json.dump(registry_data, directory_file_registry_file, indent=4)
     directory_file_registry_file.close()
 
+
+#The version of the cached stages and of the rasters they write, part of the
+#stage fingerprints.  Bump it when a cached stage writes something different
+#from the same inputs so the rasters of earlier versions aren't reused.
+_STAGE_CACHE_VERSION = 2
+
+
+def _calculate_ipa_activity_scores(args, results_suffix):
+    """Runs the budget independent part of the IPA: the objective, transition
+        and activity scores.
+
+        args - the execute_30 argument dictionary.
+        results_suffix - a string appended to the output file names.
+
+        returns a (dir_registry, file_registry, transition_dictionary) tuple
+            or (None, None, None) if there are no objectives"""
+
+    LOGGER.info('ensuring that the optional objectives have non-empty factors')
+    _update_args_for_optional_parameters(args['objectives'])
+
+    LOGGER.info('Updating references to the general LULC coefficients table')
+    _update_args_for_general_lulc_table_refs(
+        args['objectives'], args['lulc_coefficients_table_uri'],
+        args['lulc_uri'])
+
+    LOGGER.info('Starting Water Funds Prioritizer')
+
+    #make the file registry
+    dir_registry, file_registry = _build_ipa_registries(args, results_suffix)
+
+    #Save the directory and file registry files to a directory
+    _write_ipa_registries(dir_registry, file_registry)
+
     #This is the list of transitions hard coded in the .json object
     transition_list = args['transition_types']
 
@@ -154,7 +347,41 @@ def execute_30(**args):
 
     if 'objectives' not in args:
         LOGGER.error('No objectives found.  Exiting')
-        return
+        return None, None, None
+
+    if args.get('fused_scoring', False):
+        LOGGER.info('calculating activity scores in a single fused pass')
+        _calculate_fused_activity_scores(
+            args, dir_registry, file_registry, transition_dictionary,
+            results_suffix)
+        return dir_registry, file_registry, transition_dictionary
+
+    #Independent rasters are calculated concurrently, each stage waits for
+    #the stages that write the rasters it reads
+    #and stages whose inputs haven't changed since the last run are skipped,
+    #without the cache the stages only forget the fingerprints they overwrite
+    stage_cache = natcap.rios.stage_scheduler.StageCache(
+        file_registry['directory_file_registry'],
+        version=_STAGE_CACHE_VERSION)
+    scheduler = natcap.rios.stage_scheduler.StageScheduler(
+        n_workers=args.get('n_stage_workers'),
+        memory_limit=args.get('stage_memory_limit'),
+        stage_cache=stage_cache,
+        skip_up_to_date=args.get('stage_cache', True))
+
+    if args.get('factor_cache_dir'):
+        factor_cache = natcap.rios.stage_scheduler.FileCache(
+            args['factor_cache_dir'],
+            size_limit=args.get('factor_cache_size_limit'))
+    else:
+        factor_cache = None
+    factor_uris = set()
+    #objectives often share factors, each is only normalized once
+    normalized_uris = {}
+    normalized_dirs = []
+    #the table factors of all the objectives are reclassified together
+    table_factors = []
+    prioritize_args_list = []
 
     LOGGER.info('Looping through objectives to sort and prioritize')
     for objective_name, objective_dict in args['objectives'].iteritems():
@@ -170,8 +397,15 @@ def execute_30(**args):
                     'factors': objective_dict['factors'],
                     'results_suffix': results_suffix,
                     'lulc_uri': file_registry['lulc_uri'],
+                    'factor_cache': factor_cache,
+                    'normalized_uris': normalized_uris,
+                    'table_factors': table_factors,
+                    'n_workers': args.get('n_workers'),
                     }
-                _normalize_rasters(normalize_args)
+                objective_factor_uris = _normalize_rasters(
+                    normalize_args, scheduler=scheduler)
+                factor_uris.update(objective_factor_uris.values())
+                normalized_dirs.append(normalize_args['output_dir'])
 
                 prioritize_args = {
                     'input_dir': normalize_args['output_dir'],
@@ -181,15 +415,32 @@ def execute_30(**args):
                         objective_name,
                         dir_registry['objective_transition_subdir']),
                     'priorities': objective_dict['priorities'],
+                    'factor_uris': objective_factor_uris,
                     'results_suffix': results_suffix,
                     'cell_size': \
                         pygeoprocessing.geoprocessing.get_cell_size_from_uri(
-                            file_registry['lulc_uri'])
+                            file_registry['lulc_uri']),
+                    'n_workers': args.get('n_workers'),
                     }
-                _create_objective_transition_scores(prioritize_args)
-                # the normalized output directory is deleted as a request to
-                # improve the uptake of RIOS
-                shutil.rmtree(normalize_args['output_dir'])
+                prioritize_args_list.append(prioritize_args)
+
+    _add_table_factor_tasks(
+        table_factors, scheduler, n_workers=args.get('n_workers'))
+    for prioritize_args in prioritize_args_list:
+        _create_objective_transition_scores(
+            prioritize_args, scheduler=scheduler)
+
+    # the normalized output directories are deleted as a request to improve
+    # the uptake of RIOS, unless the factors are cached.  They're removed
+    # once every objective's transitions are done since a factor normalized
+    # in one objective's directory can be used by the others.
+    if factor_cache is None:
+        for normalized_dir in normalized_dirs:
+            scheduler.add_task(
+                shutil.rmtree, args=(normalized_dir,),
+                writes=[
+                    uri for uri in factor_uris
+                    if os.path.dirname(uri) == normalized_dir])
 
     LOGGER.info('calculating ipa transition scores')
     transition_args = {
@@ -200,9 +451,10 @@ def execute_30(**args):
         'objective_weights': args['priorities'],
         'results_suffix': results_suffix,
         'cell_size': pygeoprocessing.geoprocessing.get_cell_size_from_uri(
-            args['lulc_uri'])
+            args['lulc_uri']),
+        'n_workers': args.get('n_workers'),
         }
-    calculate_global_transitions(transition_args)
+    calculate_global_transitions(transition_args, scheduler=scheduler)
     LOGGER.info('Converting transitions to activities')
 
     activity_score_args = {
@@ -212,23 +464,321 @@ def execute_30(**args):
         'results_suffix': results_suffix,
         'transition_dictionary': transition_dictionary,
         'cell_size': pygeoprocessing.geoprocessing.get_cell_size_from_uri(
-            args['lulc_uri'])
+            args['lulc_uri']),
+        'n_workers': args.get('n_workers'),
         }
 
-    calculate_activity_scores(activity_score_args)
+    calculate_activity_scores(activity_score_args, scheduler=scheduler)
+    scheduler.run()
+    if factor_cache is not None:
+        factor_cache.evict(factor_uris)
+    return dir_registry, file_registry, transition_dictionary
+
+
+def _calculate_fused_activity_scores(
+        args, dir_registry, file_registry, transition_dictionary,
+        results_suffix):
+    """Calculates the activity score and max transition rasters in a single
+        pass over the aligned blocks of the LULC and factor rasters.  The
+        normalized factors, objective transitions and global transitions of a
+        block are only held in memory, each is rounded to float32 as if it
+        had been written out so the scores match the staged calculation.
+
+        args - the execute_30 argument dictionary.  The intermediates named in
+            args['fused_scoring_intermediates'] ('normalized_factors',
+            'objective_transitions' and/or 'global_transitions') are also
+            written where the staged calculation would write them.
+        dir_registry - the directory registry of the run.
+        file_registry - the file registry of the run.
+        transition_dictionary - the transition types dictionary.
+        results_suffix - a string appended to the output file names.
+
+        returns nothing"""
+
+    intermediates = set(args.get('fused_scoring_intermediates', []))
+    input_uri_list = [file_registry['lulc_uri']]
+    output_list = []
+
+    def _input_index(uri):
+        """Index of `uri` in the block pass inputs, adding it if needed"""
+        if uri not in input_uri_list:
+            input_uri_list.append(uri)
+        return input_uri_list.index(uri)
+
+    def _output_index(uri, datatype, nodata):
+        """Adds an output to the block pass and returns its index"""
+        pygeoprocessing.geoprocessing.create_directories(
+            [os.path.dirname(uri)])
+        output_list.append((uri, datatype, nodata))
+        return len(output_list) - 1
+
+    #Each step computes a block value from the input blocks or from values
+    #of earlier steps, and each written value is (value key, output index)
+    factor_steps = []
+    disk_steps = []
+    objective_steps = []
+    global_steps = []
+    written_values = []
+    value_nodata = {}
+    objective_factor_keys = {}
+
+    #the normalization ranges are shared with the staged calculation through
+    #its factor cache
+    if args.get('factor_cache_dir'):
+        factor_cache = natcap.rios.stage_scheduler.FileCache(
+            args['factor_cache_dir'],
+            size_limit=args.get('factor_cache_size_limit'))
+    else:
+        factor_cache = None
+    cached_uris = set()
+
+    for objective_name, objective_dict in args['objectives'].iteritems():
+        if (objective_dict['rios_model_type'] != 'rios_tier_0' or
+                'factors' not in objective_dict):
+            continue
+        objective_dir = os.path.join(
+            dir_registry['ipa_workspace'], dir_registry['objective_subdir'],
+            objective_name)
+
+        for factor_name, factor in objective_dict['factors'].iteritems():
+            #objectives often share factors, each is only normalized once
+            factor_key = ('factor', _factor_normalization_key(
+                file_registry['lulc_uri'], factor))
+            objective_factor_keys[(objective_name, factor_name)] = factor_key
+            #see _normalize_factor and _map_raster_to_table
+            factor_nodata = -9999 if 'type' in factor['bins'] else -1.0
+            if 'normalized_factors' in intermediates:
+                written_values.append((factor_key, _output_index(
+                    os.path.join(
+                        objective_dir, dir_registry['normalized_subdir'],
+                        factor_name + '%s.tif' % results_suffix),
+                    gdal.GDT_Float32, factor_nodata)))
+            if factor_key in value_nodata:
+                continue
+
+            if 'type' in factor['bins']:
+                #factors with a bins raster are normalized from the general
+                #LULC, see _normalize_rasters
+                if 'raster_uri' in factor['bins']:
+                    raster_uri = file_registry['lulc_uri']
+                else:
+                    raster_uri = factor['raster_uri']
+                if factor['bins']['interpolation'] != 'linear':
+                    raise Exception(
+                        "unknown interp_type %s" %
+                        factor['bins']['interpolation'])
+                #the same range as _normalize_raster, from the raster
+                #aligned to the LULC on its own, unless it's recorded with
+                #the factor in the factor cache
+                raster_nodata = (
+                    pygeoprocessing.geoprocessing.get_nodata_from_uri(
+                        raster_uri))
+                range_uri = None
+                if factor_cache is not None:
+                    factor_cache_uri = _factor_cache_uri(
+                        factor_cache, file_registry['lulc_uri'], factor)
+                    cached_uris.add(factor_cache_uri)
+                    range_uri = _normalization_range_uri(factor_cache_uri)
+                raster_range = _read_normalization_range(
+                    range_uri, raster_uri, file_registry['lulc_uri'])
+                if raster_range is None:
+                    aligned_uri_list = (
+                        natcap.rios.raster_engine.align_rasters(
+                            [raster_uri, file_registry['lulc_uri']],
+                            pygeoprocessing.geoprocessing.get_cell_size_from_uri(
+                                file_registry['lulc_uri']),
+                            dataset_to_align_index=1))
+                    try:
+                        raster_range = _normalization_range(
+                            aligned_uri_list[0], raster_nodata)
+                    finally:
+                        for aligned_uri in aligned_uri_list:
+                            if os.path.exists(aligned_uri):
+                                os.remove(aligned_uri)
+                    _write_normalization_range(
+                        range_uri, raster_uri, file_registry['lulc_uri'],
+                        raster_range)
+                raster_min, raster_max = raster_range
+                value_nodata[factor_key] = factor_nodata
+                normalize = _make_linear_normalization(
+                    raster_nodata, value_nodata[factor_key], raster_min,
+                    raster_max, factor['bins']['inverted'])
+            elif 'key_field' in factor['bins']:
+                raster_uri = factor['bins']['raster_uri']
+                value_nodata[factor_key] = factor_nodata
+                normalize = _make_reclassify_op(
+                    _table_value_map(factor['bins'], value_nodata[factor_key]))
+            else:
+                raise Exception("Unknown normalization routine")
+            factor_steps.append(
+                (factor_key, _input_index(str(raster_uri)), normalize))
+
+        for transition_name, factors in (
+                objective_dict['priorities'].iteritems()):
+            transition_key = ('objective', objective_name, transition_name)
+            factor_keys = [
+                objective_factor_keys[(objective_name, factor_name)]
+                for factor_name in factors]
+            weights = [
+                _priority_weight(factor_name, factor_weight)
+                for factor_name, factor_weight in factors.iteritems()]
+            value_nodata[transition_key] = -1.0
+            objective_steps.append((transition_key, factor_keys, _make_priority_op(
+                [value_nodata[key] for key in factor_keys], weights,
+                value_nodata[transition_key])))
+
+            if 'objective_transitions' in intermediates:
+                written_values.append((transition_key, _output_index(
+                    os.path.join(
+                        objective_dir,
+                        dir_registry['objective_transition_subdir'],
+                        transition_name + '%s.tif' % results_suffix),
+                    gdal.GDT_Float32, value_nodata[transition_key])))
+
+    for transition_basename, objective_weights_dict in (
+            args['priorities'].iteritems()):
+        objective_basenames, objective_weights = zip(
+            *objective_weights_dict.items())
+        objective_keys = []
+        for objective_basename in objective_basenames:
+            objective_key = (
+                'objective', objective_basename, transition_basename)
+            if objective_key not in value_nodata:
+                #objective transitions that aren't calculated from factors
+                #are read from where the staged calculation expects them
+                objective_uri = os.path.join(
+                    dir_registry['ipa_workspace'],
+                    dir_registry['objective_subdir'], objective_basename,
+                    dir_registry['objective_transition_subdir'],
+                    transition_basename + '%s.tif' % results_suffix)
+                value_nodata[objective_key] = (
+                    pygeoprocessing.geoprocessing.get_nodata_from_uri(
+                        objective_uri))
+                disk_steps.append(
+                    (objective_key, _input_index(objective_uri)))
+            objective_keys.append(objective_key)
+
+        global_key = ('global', transition_basename)
+        value_nodata[global_key] = -1.0
+        global_steps.append((global_key, objective_keys, (
+            _make_weighted_transition_average(
+                [value_nodata[key] for key in objective_keys],
+                objective_weights, value_nodata[global_key]))))
+
+        if 'global_transitions' in intermediates:
+            written_values.append((global_key, _output_index(
+                os.path.join(
+                    dir_registry['ipa_transition_dir'],
+                    transition_basename + '%s.tif' % results_suffix),
+                gdal.GDT_Float32, value_nodata[global_key])))
+
+    #transitions in raster_value order, see calculate_activity_scores
+    transition_basenames = [x[0] for x in sorted(
+        transition_dictionary.items(), key=lambda x: x[1]['raster_value'])]
+    activity_basenames = (
+        args['transition_map'][transition_basenames[0]].keys())
+    transition_nodata = -1
+    activity_scores = _make_activity_scores_op([
+        [args['transition_map'][x][activity_basename]
+         for x in transition_basenames]
+        for activity_basename in activity_basenames], transition_nodata)
+    #the output index of each score and max transition, in the
+    #activity_scores result order
+    activity_indexes = []
+    for activity_basename in activity_basenames:
+        activity_indexes.append(_output_index(
+            os.path.join(
+                dir_registry['ipa_activity_dir'],
+                activity_basename + '%s.tif' % results_suffix),
+            gdal.GDT_Float32, -1.0))
+        activity_indexes.append(_output_index(
+            os.path.join(
+                dir_registry['ipa_activity_dir'],
+                'max_transition_%s%s.tif' % (
+                    activity_basename, results_suffix)),
+            gdal.GDT_Int32, transition_nodata))
+
+    def _fused_activity_scores(*blocks):
+        """Runs the whole scoring chain on one block of the inputs"""
+        values = {}
+        for factor_key, input_index, normalize in factor_steps:
+            values[factor_key] = normalize(
+                blocks[input_index]).astype(numpy.float32)
+        for objective_key, input_index in disk_steps:
+            values[objective_key] = blocks[input_index]
+        for transition_key, factor_keys, calculate_priority in (
+                objective_steps):
+            values[transition_key] = calculate_priority(
+                *[values[key] for key in factor_keys]).astype(numpy.float32)
+        for global_key, objective_keys, weighted_average in global_steps:
+            values[global_key] = weighted_average(
+                *[values[key] for key in objective_keys]).astype(
+                    numpy.float32)
+
+        output_blocks = [None] * len(output_list)
+        for value_key, output_index in written_values:
+            output_blocks[output_index] = values[value_key]
+        transition_blocks = [
+            values[('global', transition_basename)]
+            for transition_basename in transition_basenames]
+        for output_index, output_block in zip(
+                activity_indexes, activity_scores(*transition_blocks)):
+            output_blocks[output_index] = output_block
+        return output_blocks
+
+    #the staged rasters this overwrites can't be reused by a staged run
+    natcap.rios.stage_scheduler.StageCache(
+        file_registry['directory_file_registry']).forget(
+            [output_uri for output_uri, _, _ in output_list])
+    natcap.rios.raster_engine.multi_output_block_op(
+        input_uri_list, _fused_activity_scores, output_list,
+        pygeoprocessing.geoprocessing.get_cell_size_from_uri(
+            file_registry['lulc_uri']), n_workers=args.get('n_workers'))
+    if factor_cache is not None:
+        factor_cache.evict(cached_uris)
+
+
+def _build_budget_args(
+        args, budget_config, dir_registry, file_registry,
+        transition_dictionary, results_suffix, portfolio_suffix=None):
+    """Builds the calculate_activity_portfolio arguments of an IPA run.
+
+        args - the execute_30 argument dictionary.
+        budget_config - the budget configuration dictionary to use.
+        dir_registry - the directory registry of the run.
+        file_registry - the file registry of the run.
+        transition_dictionary - the transition types dictionary.
+        results_suffix - the suffix of the activity score rasters.
+        portfolio_suffix - (optional) the suffix of the portfolio outputs,
+            defaults to results_suffix.
+
+        returns a dictionary of calculate_activity_portfolio arguments"""
+
+    if portfolio_suffix is None:
+        portfolio_suffix = results_suffix
 
     LOGGER.info('Building arguments for budget prioritization')
     budget_args = {
-        'budget_config': args['budget_config'],
+        'budget_config': budget_config,
         'lulc_activity_potential_map': args['lulc_activity_potential_map'],
         'lulc_uri': file_registry['lulc_uri'],
         'activity_shapefiles': args['activity_shapefiles'],
-        'results_suffix': results_suffix
+        'results_suffix': portfolio_suffix
         }
 
     if 'allocation_config' in args:
         budget_args['allocation_config'] = args['allocation_config']
 
+    if 'persist_sorted_index' in args:
+        budget_args['persist_sorted_index'] = args['persist_sorted_index']
+
+    if 'write_allocation_rank' in args:
+        budget_args['write_allocation_rank'] = args['write_allocation_rank']
+
+    for optional_key in ['n_workers', 'n_stage_workers', 'stage_memory_limit']:
+        if optional_key in args:
+            budget_args[optional_key] = args[optional_key]
+
     budget_args['activities'] = {}
 
     counter = 0
@@ -254,11 +804,23 @@ def execute_30(**args):
         [(d['raster_value'], d['type']) for d in
          transition_dictionary.values()])
 
-    LOGGER.info('Starting portfolio Selection')
-    LOGGER.debug("budget_args %s", str(budget_args))
-    report_data = []
-    calculate_activity_portfolio(budget_args, report_data)
-    LOGGER.info('Finished portfolio selection')
+    return budget_args
+
+
+def _create_ipa_report(
+        budget_config, budget_args, report_data, dir_registry, file_registry,
+        results_suffix):
+    """Writes the html report of a portfolio selection.
+
+        budget_config - the budget configuration dictionary of the selection.
+        budget_args - the calculate_activity_portfolio arguments.
+        report_data - the report data list filled in by
+            calculate_activity_portfolio.
+        dir_registry - the directory registry of the run.
+        file_registry - the file registry of the run.
+        results_suffix - a string appended to the output file names.
+
+        returns nothing"""
 
     LOGGER.info('create report')
     generate_report_data = {
@@ -266,7 +828,7 @@ def execute_30(**args):
         'budget': [],
         'activities': budget_args['activities'],
         }
-    for year_index in xrange(args['budget_config']['years_to_spend']):
+    for year_index in xrange(budget_config['years_to_spend']):
         year_budget = {
             'year_index': year_index,
             'floating_budget': report_data[year_index]['floating_budget'],
@@ -280,17 +842,6 @@ def execute_30(**args):
 
     generate_report_data['ipa_report_uri'] = file_registry['ipa_report_uri']
     _generate_report(dir_registry['ipa_report_dir'], generate_report_data)
-    if args['open_html_on_completion']:
-        webbrowser.open(file_registry['ipa_report_uri'])
-
-    LOGGER.info('Finished Water Funds Prioritizer')
-    LOGGER.info(r'   ____               U  ___ u  ____     ')
-    LOGGER.info(r'U |  _"\ u     ___     \/"_ \/ / __"| u  ')
-    LOGGER.info(r' \| |_) |/    |_"_|    | | | |<\___ \/   ')
-    LOGGER.info(r'  |  _ <       | | .-,_| |_| | u___) |   ')
-    LOGGER.info(r'  |_| \_\    U/| |\u\_)-\___/  |____/>>  ')
-    LOGGER.info(r'  //   \\_.-,_|___|_,-.  \\     )(  (__) ')
-    LOGGER.info(r' (__)  (__)\_)-' '-(_/  (__)   (__)      ')
 
 
 def _update_args_for_optional_parameters(objectives):
@@ -339,7 +890,7 @@ def _update_args_for_general_lulc_table_refs(
                 pass
 
 
-def calculate_global_transitions(args):
+def calculate_global_transitions(args, scheduler=None):
     """This function calculates the weighted average of the objective level
         transitions.
 
@@ -357,14 +908,42 @@ def calculate_global_transitions(args):
                            ...}
                       ...}
         args['results_suffix'] - a suffix to append to each output filename
+        args['n_workers'] - (optional) the number of threads to calculate
+            raster blocks with
+        scheduler - (optional) a `stage_scheduler.StageScheduler` to add the
+            transitions to instead of calculating them now
 
         returns nothing"""
 
     pygeoprocessing.geoprocessing.create_directories([args['output_dir']])
 
+    run_now = scheduler is None
+    if run_now:
+        scheduler = natcap.rios.stage_scheduler.StageScheduler()
     for transition_basename, objective_weights_dict in args['objective_weights'].iteritems():
-        _calculate_global_transition(
-            args, transition_basename, objective_weights_dict)
+        scheduler.add_task(
+            _calculate_global_transition,
+            args=(args, transition_basename, objective_weights_dict),
+            reads=_objective_transition_uris(
+                args, transition_basename, objective_weights_dict.keys()),
+            cache_key={
+                'objective_weights': objective_weights_dict,
+                'cell_size': args['cell_size']},
+            writes=[os.path.join(
+                args['output_dir'],
+                transition_basename + '%s.tif' % args['results_suffix'])],
+            memory=_stage_memory(args, len(objective_weights_dict) + 1),
+            name='global transition %s' % transition_basename)
+    if run_now:
+        scheduler.run()
+
+
+def _objective_transition_uris(args, transition_basename, objective_basenames):
+    """returns the uris of a transition's objective level rasters"""
+
+    return [os.path.join(
+            args['input_dir'], x, args['objective_subdirectory'],
+            transition_basename + '%s.tif' % args['results_suffix']) for x in objective_basenames]
 
 
 def _calculate_global_transition(args, transition_basename, objective_weights_dict):
@@ -373,18 +952,40 @@ def _calculate_global_transition(args, transition_basename, objective_weights_di
         *objective_weights_dict.items())
 
     #Now map them to explicit URIs so we can call vectorize datasets on them
-    objective_uris = [os.path.join(
-            args['input_dir'], x, args['objective_subdirectory'],
-            transition_basename + '%s.tif' % args['results_suffix']) for x in objective_basenames]
+    objective_uris = _objective_transition_uris(
+        args, transition_basename, objective_basenames)
 
     objective_nodata = [pygeoprocessing.geoprocessing.get_nodata_from_uri(x) for x in objective_uris]
     transition_nodata = -1.0
+    _weighted_transition_average = _make_weighted_transition_average(
+        objective_nodata, objective_weights, transition_nodata)
+
+    #Boilerplate for vectorize_datasets
+    transition_out_uri = os.path.join(
+        args['output_dir'],
+        transition_basename + '%s.tif' % args['results_suffix'])
+    natcap.rios.raster_engine.vectorize_datasets(
+        objective_uris, _weighted_transition_average, transition_out_uri,
+        gdal.GDT_Float32, transition_nodata, args['cell_size'], "intersection",
+        n_workers=args.get('n_workers'))
+
+
+def _make_weighted_transition_average(
+        objective_nodata, objective_weights, transition_nodata):
+    """Makes the function that averages objective transition scores into a
+        global transition score.
+
+        objective_nodata - the nodata value of each objective's transition
+        objective_weights - the weight of each objective's transition
+        transition_nodata - the nodata value of the result
+
+        returns a function of one array per objective"""
 
     #define this function in scope so it uses objective_weights
     def _weighted_transition_average(*pixels):
         """A function for vectorize_datasets to average pixels"""
         weight = numpy.zeros(pixels[0].shape, dtype=numpy.float32)
-        nodata_mask = numpy.zeros(pixels[0].shape, dtype=numpy.bool)
+        nodata_mask = numpy.zeros(pixels[0].shape, dtype=bool)
         for index, (value, nodata) in enumerate(zip(pixels, objective_nodata)):
             nodata_mask = nodata_mask | (value == nodata)
             weight += value * objective_weights[index]
@@ -396,18 +997,10 @@ def _calculate_global_transition(args, transition_basename, objective_weights_di
         # return nodata_mask
         return numpy.where(
             ~nodata_mask, weight / objective_weight_sum, transition_nodata)
-
-    #Boilerplate for vectorize_datasets
-    transition_out_uri = os.path.join(
-        args['output_dir'],
-        transition_basename + '%s.tif' % args['results_suffix'])
-    pygeoprocessing.geoprocessing.vectorize_datasets(
-        objective_uris, _weighted_transition_average, transition_out_uri,
-        gdal.GDT_Float32, transition_nodata, args['cell_size'], "intersection",
-        vectorize_op=False)
+    return _weighted_transition_average
 
 
-def calculate_activity_scores(args):
+def calculate_activity_scores(args, scheduler=None):
     """Calculates the IPA activity scores by averaging the global transition
         scores that are relevant to each activity
 
@@ -423,6 +1016,10 @@ def calculate_activity_scores(args):
         args['transition_dictionary'] - a mapping of
             { 'transition_name_0': {'raster_value': id, ...}, ...}
             (the transition names are the same as in args['activity_weights'])
+        args['n_workers'] - (optional) the number of threads to calculate
+            raster blocks with
+        scheduler - (optional) a `stage_scheduler.StageScheduler` to add the
+            activities to instead of calculating them now
 
         returns nothing"""
 
@@ -442,58 +1039,169 @@ def calculate_activity_scores(args):
         for x in transition_basenames]
     activity_basenames = args['activity_weights'][transition_basenames[0]].keys()
 
+    run_now = scheduler is None
+    if run_now:
+        scheduler = natcap.rios.stage_scheduler.StageScheduler()
+    #every activity comes from the same read of the transitions
+    writes = []
     for activity_basename in activity_basenames:
-        _calculate_activity_score(
-            activity_basename, transition_basenames, transition_uris, args,
-            args['cell_size'])
+        writes.extend(_activity_score_uris(args, activity_basename))
+    scheduler.add_task(
+        _calculate_activity_scores,
+        args=(activity_basenames, transition_basenames, transition_uris,
+              args, args['cell_size']),
+        reads=transition_uris,
+        cache_key={
+            'activity_weights': [
+                [args['activity_weights'][x][activity_basename]
+                 for x in transition_basenames]
+                for activity_basename in activity_basenames],
+            'cell_size': args['cell_size']},
+        writes=writes,
+        memory=_stage_memory(
+            args, len(transition_uris) + 2 * len(activity_basenames)),
+        name='activity scores')
+    if run_now:
+        scheduler.run()
+
+
+def _activity_score_uris(args, activity_basename):
+    """returns the [activity score, max transition] raster uris of an
+        activity of `calculate_activity_scores`"""
+
+    return [
+        os.path.join(args['output_dir'], activity_basename + '%s.tif' %
+            args['results_suffix']),
+        os.path.join(args['output_dir'], 'max_transition_%s%s.tif' %
+            (activity_basename, args['results_suffix']))]
+
+
+def _calculate_activity_scores(
+        activity_basenames, transition_basenames, transition_uris, args,
+        cell_size):
+    """Calculates the score and max transition rasters of every activity of
+        `calculate_activity_scores` in one pass over the transitions"""
 
+    transition_nodata = -1
+    activity_nodata = -1.0
+    activity_scores = _make_activity_scores_op([
+        [args['activity_weights'][x][activity_basename]
+         for x in transition_basenames]
+        for activity_basename in activity_basenames], transition_nodata)
 
-def _calculate_activity_score(
-    activity_basename, transition_basenames, transition_uris, args, cell_size):
-    activity_weights = [
-        args['activity_weights'][x][activity_basename]
-        for x in transition_basenames]
-
-    def _weighted_activity_average(*pixels):
-        weight = numpy.zeros(pixels[0].shape)
+    output_list = []
+    for activity_basename in activity_basenames:
+        activity_out_uri, transition_activity_out_uri = (
+            _activity_score_uris(args, activity_basename))
+        output_list.append(
+            (activity_out_uri, gdal.GDT_Float32, activity_nodata))
+        output_list.append(
+            (transition_activity_out_uri, gdal.GDT_Int32, transition_nodata))
+    natcap.rios.raster_engine.multi_output_block_op(
+        transition_uris, activity_scores, output_list, cell_size,
+        dataset_to_align_index=None, n_workers=args.get('n_workers'))
+
+
+def _make_activity_scores_op(activity_weights_list, transition_nodata):
+    """Makes the function that turns the global transition scores into the
+        score and max transition index of several activities in one pass.
+
+        activity_weights_list - a list of the weight of each transition for
+            each activity
+        transition_nodata - the nodata value of the max transition index
+
+        returns a function of one array per transition that returns a list
+            of score, max transition index, score, ... arrays with two per
+            activity"""
+
+    activity_weight_sums = [
+        sum(activity_weights) for activity_weights in activity_weights_list]
+
+    def _activity_scores(*pixels):
+        """Calculates the weighted average of the transitions of each
+            activity and the index of its transition with the largest
+            weighted value, which is nodata if that value isn't positive.
+            The transitions are weighted one at a time and each weighted
+            transition updates the score and running argmax of every
+            activity that gives it that weight before the next is
+            calculated, so one weighted transition is held at a time.  The
+            running argmax keeps the first of equal values like
+            numpy.argmax."""
+
+        scores = [
+            numpy.zeros(pixels[0].shape) for _ in activity_weights_list]
+        max_indexes = [
+            numpy.zeros(pixels[0].shape, dtype=numpy.int32)
+            for _ in activity_weights_list]
+        max_values = [None] * len(activity_weights_list)
+        max_value_types = [
+            numpy.result_type(*[
+                numpy.result_type(value, weight)
+                for value, weight in zip(pixels, activity_weights)])
+            for activity_weights in activity_weights_list]
+        update_mask = numpy.empty(pixels[0].shape, dtype=bool)
         for index, value in enumerate(pixels):
-            weight += value * activity_weights[index]
-        return weight / sum(activity_weights)
-
-    #Boilerplate for vectorize_datasets
-    activity_out_uri = os.path.join(
-        args['output_dir'], activity_basename + '%s.tif' %
-        args['results_suffix'])
-    activity_nodata = -1.0
-    pygeoprocessing.geoprocessing.vectorize_datasets(
-        transition_uris, _weighted_activity_average, activity_out_uri,
-        gdal.GDT_Float32, activity_nodata, cell_size, "intersection",
-        vectorize_op=False)
-
-    #Make a max transition raster for a particular activity
-    transition_activity_out_uri = os.path.join(
-        args['output_dir'], 'max_transition_%s%s.tif' %
-        (activity_basename, args['results_suffix']))
-    transition_nodata = -1
-    def _max_transition_activity(*pixels):
-        """This calculates the maximum weighted activity
-            occuring on a pixel.  If the value is 0.0 we consider it
-            nodata."""
-        #Weight all the incoming pixels
-        weighted_pixels = numpy.array([
-            value * activity_weights[index] for index, value in
-            enumerate(pixels)])
-
-        #Now find the max indexes
-        max_index = numpy.argmax(weighted_pixels, axis=0)
-        indices = numpy.indices(max_index.shape)
-        max_value = weighted_pixels[max_index, indices[0] ,indices[1]]
-        return numpy.where(max_value > 0, max_index, transition_nodata)
-
-    pygeoprocessing.geoprocessing.vectorize_datasets(
-        transition_uris, _max_transition_activity, transition_activity_out_uri,
-        gdal.GDT_Int32, transition_nodata, cell_size, "intersection",
-        vectorize_op=False)
+            #activity indexes by the weight they give this transition
+            weight_activities = collections.OrderedDict()
+            for activity_index, activity_weights in enumerate(
+                    activity_weights_list):
+                weight = activity_weights[index]
+                weight_activities.setdefault(
+                    (type(weight), weight), []).append(activity_index)
+            for (_, weight), activity_indexes in (
+                    weight_activities.iteritems()):
+                weighted_value = value * weight
+                for activity_index in activity_indexes:
+                    scores[activity_index] += weighted_value
+                    if max_values[activity_index] is None:
+                        max_values[activity_index] = weighted_value.astype(
+                            max_value_types[activity_index])
+                        continue
+                    numpy.greater(
+                        weighted_value, max_values[activity_index],
+                        out=update_mask)
+                    numpy.copyto(
+                        max_values[activity_index], weighted_value,
+                        where=update_mask)
+                    numpy.copyto(
+                        max_indexes[activity_index], index, where=update_mask)
+                del weighted_value
+
+        result_list = []
+        for activity_weights, activity_weight_sum, score, max_value, (
+                max_index) in zip(
+                    activity_weights_list, activity_weight_sums, scores,
+                    max_values, max_indexes):
+            score /= activity_weight_sum
+
+            #argmax stops at the first NaN and a NaN max isn't positive,
+            #since a NaN makes the score NaN only those pixels need to be
+            #checked
+            valid_mask = max_value > 0
+            nan_mask = numpy.isnan(score)
+            if nan_mask.any():
+                for index, value in enumerate(pixels):
+                    valid_mask[nan_mask] &= ~numpy.isnan(
+                        value[nan_mask] * activity_weights[index])
+            result_list.append(score)
+            result_list.append(
+                numpy.where(valid_mask, max_index, transition_nodata))
+        return result_list
+
+    return _activity_scores
+
+
+#A rough size of the block a raster stage holds per raster, see
+#_stage_memory
+_STAGE_BLOCK_BYTES = 2**20 * 8
+
+
+def _stage_memory(args, n_rasters):
+    """Estimates the peak memory of a raster stage over n_rasters rasters
+        calculated with args['n_workers'] threads, for the stage scheduler's
+        memory limit"""
+
+    return n_rasters * _STAGE_BLOCK_BYTES * max(1, args.get('n_workers') or 1)
 
 
 def calculate_activity_portfolio(args, report_data=None):
@@ -534,6 +1242,25 @@ def calculate_activity_portfolio(args, report_data=None):
             to.
         args['transition_dictionary'] - a python dictionary that maps transition ids
             to transition names
+        args['allocation_engine'] - (optional) 'batch' (default) to allocate
+            pixels in vectorized blocks or 'legacy' to allocate them one at
+            a time.  Both give identical portfolios.
+        args['persist_sorted_index'] - (optional) if True the sorted
+            activity scores are saved next to each prioritization raster as
+            '*_sorted_index.bin/.json' and reused by later runs whose
+            prioritization rasters haven't changed.  Defaults to False.
+        args['write_allocation_rank'] - (optional) if True the order in which
+            the pixels were allocated is written to
+            'allocation_rank<suffix>.tif' in args['output_dir'], with the
+            cumulative cost of that order in 'allocation_rank_cost<suffix>.csv'.
+            See `threshold_allocation_rank` to cut a portfolio for a
+            different budget out of them.  Defaults to False.
+        args['n_workers'] - (optional) the number of threads to calculate
+            the blocks of each raster stage with.  Defaults to 1.
+        args['n_stage_workers'] - (optional) the number of activities to mask
+            at once.  Defaults to 1.
+        args['stage_memory_limit'] - (optional) a limit in bytes on the
+            estimated memory of the activity masks calculated at once.
 
         report_data - (optional) an input list that when output has the form
            [{
@@ -557,7 +1284,108 @@ def calculate_activity_portfolio(args, report_data=None):
     if report_data == None:
         report_data = []
 
-    pygeoprocessing.geoprocessing.create_directories([args['output_dir']])
+    portfolio_data = _prepare_activity_portfolio(args)
+    _select_activity_portfolio(args, portfolio_data, report_data)
+
+
+def threshold_allocation_rank(
+        allocation_rank_uri, allocation_cost_table_uri, budget, out_uri,
+        n_workers=None):
+    """Makes the activity portfolio of the pixels a portfolio selection
+        allocated before it had spent `budget`, from the outputs of
+        calculate_activity_portfolio with args['write_allocation_rank'].  The
+        allocation order doesn't depend on the budget, so this is the
+        portfolio a run with the same inputs would pick if its allocation
+        stopped at `budget`; per activity and per year budget limits of the
+        original run are kept as they were.
+
+        allocation_rank_uri - a uri to an 'allocation_rank' raster
+        allocation_cost_table_uri - a uri to the matching
+            'allocation_rank_cost' table
+        budget - the total amount to spend
+        out_uri - a uri to the activity portfolio raster to write, its
+            values are activity ids and 255 is unallocated
+        n_workers - (optional) the number of threads to calculate raster
+            blocks with
+
+        returns a tuple of (number of pixels allocated, amount spent)"""
+
+    first_rank = []
+    last_rank = []
+    activity_id = []
+    unit_cost = []
+    cumulative_cost = []
+    id_to_activity_dict = {}
+    with open(allocation_cost_table_uri, 'rb') as table_file:
+        for row in csv.DictReader(table_file):
+            first_rank.append(int(row['first_rank']))
+            last_rank.append(int(row['last_rank']))
+            activity_id.append(int(row['activity_id']))
+            unit_cost.append(float(row['unit_cost']))
+            cumulative_cost.append(float(row['cumulative_cost']))
+            id_to_activity_dict[int(row['activity_id'])] = (
+                row['activity_type'])
+
+    #find the last rank whose cumulative cost fits in the budget
+    max_rank = 0
+    spent = 0.0
+    for segment_index in xrange(len(first_rank)):
+        if cumulative_cost[segment_index] <= budget:
+            max_rank = last_rank[segment_index]
+            spent = cumulative_cost[segment_index]
+            continue
+        n_pixels = min(
+            int((budget - spent) / unit_cost[segment_index]),
+            last_rank[segment_index] - first_rank[segment_index] + 1)
+        max_rank = first_rank[segment_index] + n_pixels - 1
+        spent = _accumulate_repeated(
+            numpy.add, spent, unit_cost[segment_index], n_pixels)
+        break
+
+    first_rank = numpy.array(first_rank, dtype=numpy.int64)
+    activity_id = numpy.array(activity_id, dtype=numpy.ubyte)
+    rank_nodata = 0
+    activity_nodata = 255
+
+    def _threshold_rank(rank):
+        """Looks up the activity of the ranks up to max_rank"""
+        if max_rank == 0:
+            return numpy.empty(rank.shape, dtype=numpy.ubyte) + activity_nodata
+        segment_index = numpy.searchsorted(first_rank, rank, side='right') - 1
+        return numpy.where(
+            (rank == rank_nodata) | (rank > max_rank), activity_nodata,
+            activity_id[numpy.maximum(segment_index, 0)])
+
+    natcap.rios.raster_engine.vectorize_datasets(
+        [allocation_rank_uri], _threshold_rank, out_uri, gdal.GDT_Byte,
+        activity_nodata,
+        pygeoprocessing.geoprocessing.get_cell_size_from_uri(
+            allocation_rank_uri), "intersection", n_workers=n_workers)
+    pygeoprocessing.geoprocessing.create_rat_uri(
+        out_uri, id_to_activity_dict, "Activity")
+    return max_rank, spent
+
+
+def _prepare_activity_portfolio(args):
+    """Does the budget independent part of the portfolio selection: masks the
+        activity scores with the prefer/prevent and landcover restrictions,
+        sorts them and counts the available pixels.
+
+        args - the same arguments as `calculate_activity_portfolio`, only
+            'activities', 'lulc_activity_potential_map',
+            'activity_shapefiles', 'lulc_uri' and 'persist_sorted_index'
+            are used.
+
+        returns a dictionary of the form
+            {'activity_list': activity names in activity index order,
+             'activity_cost': per pixel costs indexed by activity index,
+             'sorted_runs': list of disk_sort.SortedRuns of the negated
+                prioritization scores indexed by activity index,
+             'activity_raster_lookup': activity name to index/uri,
+             'id_to_activity_dict': activity index to activity name,
+             'pixel_size_out': the cell size of the landcover,
+             'available_mask_uri': a raster on the portfolio grid,
+             'total_available_pixels': pixels with at least one activity}"""
 
     budget_selection_activity_uris = {}
 
@@ -570,18 +1398,12 @@ def calculate_activity_portfolio(args, report_data=None):
     min_activity_cost = min([x['unit_cost'] for x in args['activities'].itervalues()])
     prefer_boost = min_activity_cost + 1.0
 
-    #These will be used for heapq.merge iterators later
-    activity_iterators = {}
     activity_list = sorted(args['activities'].keys())
 
     id_to_activity_dict = {}
     for index, activity_name in enumerate(activity_list):
         id_to_activity_dict[index] = activity_name
 
-    _dump_to_table(
-        id_to_activity_dict, args['activity_lookup_table_uri'], 'activity_id',
-        'activity_type')
-
     #This will become a list of per activity costs indexed by
     #activity_index
     activity_cost = []
@@ -597,6 +1419,34 @@ def calculate_activity_portfolio(args, report_data=None):
 
     pixel_size_out = pygeoprocessing.geoprocessing.get_cell_size_from_uri(
         args['lulc_uri'])
+    #the prefer/prevent areas are rasterized independently of each other
+    scheduler = natcap.rios.stage_scheduler.StageScheduler(
+        n_workers=args.get('n_stage_workers'),
+        memory_limit=args.get('stage_memory_limit'))
+
+    #the prefer/prevent areas of all the activities come from one pass over
+    #the shapefiles per `_ACTIVITIES_PER_ACTION_MASK` activities, each pass
+    #also holds an in memory raster with a byte band per activity and action
+    #that is at most a byte per pixel per band when the masks don't compress
+    action_mask_uris = []
+    n_rows, n_cols = pygeoprocessing.geoprocessing.get_row_col_from_uri(
+        args['lulc_uri'])
+    for mask_start in xrange(
+            0, len(activity_list), _ACTIVITIES_PER_ACTION_MASK):
+        action_mask_uris.append(
+            pygeoprocessing.geoprocessing.temporary_filename())
+        scheduler.add_task(
+            _rasterize_activity_actions,
+            args=(args['activity_shapefiles'],
+                  activity_list[
+                      mask_start:mask_start + _ACTIVITIES_PER_ACTION_MASK],
+                  args['lulc_uri'], action_mask_uris[-1]),
+            reads=args['activity_shapefiles'], writes=[action_mask_uris[-1]],
+            memory=_stage_memory(args, 2) + n_rows * n_cols * len(
+                _ACTIVITY_ACTIONS) * len(activity_list[
+                    mask_start:mask_start + _ACTIVITIES_PER_ACTION_MASK]),
+            name='rasterize prefer/prevent areas')
+
     for activity_index, activity_name in enumerate(activity_list):
         activity_dict = args['activities'][activity_name]
         activity_raster_lookup[activity_name] = {
@@ -613,43 +1463,106 @@ def calculate_activity_portfolio(args, report_data=None):
             * pixel_size_out ** 2)
         activity_cost.append(per_cell_cost)
 
-        _mask_activity_areas(
-            args, activity_dict['prioritization_raster_uri'],
-            activity_name, activity_index, activity_nodata,
-            budget_selection_activity_uris[activity_name], per_cell_cost,
-            prefer_boost, pixel_size_out)
-
+    #all the activities are masked in one pass over the landcover, which
+    #also counts how many pixels TOTAL we have available for setting
+    available_mask_uri = pygeoprocessing.geoprocessing.temporary_filename()
+    mask_task_id = scheduler.add_task(
+        _mask_activity_areas,
+        args=(args, activity_list, activity_nodata,
+              budget_selection_activity_uris, activity_cost, prefer_boost,
+              pixel_size_out, action_mask_uris, available_mask_uri),
+        reads=action_mask_uris,
+        writes=budget_selection_activity_uris.values() + [available_mask_uri],
+        memory=_stage_memory(
+            args, 2 + len(action_mask_uris) + 2 * len(activity_list)),
+        name='mask activities')
+    total_available_pixels = scheduler.run()[mask_task_id]
+    for action_mask_uri in action_mask_uris:
+        os.remove(action_mask_uri)
+
+    #The sorted scores can be saved next to the prioritization rasters so
+    #a later run with the same scores, but different budgets, can skip
+    #the sort
+    sorted_index_uris = {}
+    for activity_name in activity_list:
+        if args.get('persist_sorted_index', False):
+            sorted_index_uris[activity_name] = (
+                os.path.splitext(budget_selection_activity_uris[activity_name])[0]
+                + '_sorted_index')
+        else:
+            sorted_index_uris[activity_name] = None
 
     LOGGER.info('sort the prefer/prevent/activity score to disk')
-    for activity_index, activity_name in enumerate(activity_list):
-        #Creating the activity iterators here, sorting by highest to lowest.
-        activity_iterators[activity_index] = natcap.rios.disk_sort.sort_to_disk(
+    #Sorting by highest to lowest score, indexed by activity index.  The
+    #sorts share one memory budget since the runs sorted in memory are kept
+    #for the whole allocation
+    memory_budget = natcap.rios.disk_sort.default_memory_budget()
+    sorted_runs = []
+    for activity_name in activity_list:
+        sorted_runs.append(natcap.rios.disk_sort.sort_to_runs(
             budget_selection_activity_uris[activity_name],
-            activity_index, score_weight=-1.0)
+            score_weight=-1.0, memory_budget=memory_budget,
+            index_uri=sorted_index_uris[activity_name]))
+        memory_budget = max(0, memory_budget - sorted_runs[-1].nbytes)
+
+    return {
+        'activity_list': activity_list,
+        'activity_cost': activity_cost,
+        'sorted_runs': sorted_runs,
+        'activity_raster_lookup': activity_raster_lookup,
+        'id_to_activity_dict': id_to_activity_dict,
+        'pixel_size_out': pixel_size_out,
+        'available_mask_uri': available_mask_uri,
+        'total_available_pixels': total_available_pixels,
+        }
 
-    #This section counts how many pixels TOTAL we have available for setting
-    total_available_pixels = 0
-    available_mask_uri = pygeoprocessing.geoprocessing.temporary_filename()
-    def _mask_maker(*activity_score):
-        """Used to make an activity mask"""
-        nodata_mask = numpy.empty(activity_score[0].shape, dtype=numpy.bool)
-        nodata_mask[:] = True
-        for score in activity_score:
-            nodata_mask = nodata_mask & (score == activity_nodata)
-        return numpy.where(nodata_mask, activity_nodata, 1)
-        #if all(activity_nodata == score for score in activity_score):
-        #    return activity_nodata
-        #return 1
-    pygeoprocessing.geoprocessing.vectorize_datasets(
-        budget_selection_activity_uris.values(), _mask_maker,
-        available_mask_uri, gdal.GDT_Byte, activity_nodata, pixel_size_out,
-        "intersection", dataset_to_align_index=0, vectorize_op=False)
-    mask_ds = gdal.Open(available_mask_uri)
-    mask_band = mask_ds.GetRasterBand(1)
 
+def _select_activity_portfolio(args, portfolio_data, report_data):
+    """Does the budget dependent part of the portfolio selection: allocates
+        the budget over the sorted activity scores year by year and writes the
+        portfolio rasters.
+
+        args - the same arguments as `calculate_activity_portfolio`
+        portfolio_data - the result of `_prepare_activity_portfolio`, which
+            can be shared by any number of calls with different budgets
+        report_data - a list to append the yearly spending to, see
+            `calculate_activity_portfolio`
+
+        returns nothing"""
+
+    allocation_engine = args.get('allocation_engine', 'batch')
+    if allocation_engine not in _ALLOCATION_ENGINES:
+        raise ValueError(
+            "unknown allocation_engine %s; should be one of %s" % (
+                allocation_engine, sorted(_ALLOCATION_ENGINES)))
+
+    activity_list = portfolio_data['activity_list']
+    activity_cost = portfolio_data['activity_cost']
+    activity_raster_lookup = portfolio_data['activity_raster_lookup']
+    id_to_activity_dict = portfolio_data['id_to_activity_dict']
+    pixel_size_out = portfolio_data['pixel_size_out']
+    available_mask_uri = portfolio_data['available_mask_uri']
+    total_available_pixels = portfolio_data['total_available_pixels']
     n_rows, n_cols = pygeoprocessing.geoprocessing.get_row_col_from_uri(
         available_mask_uri)
 
+    pygeoprocessing.geoprocessing.create_directories([args['output_dir']])
+    _dump_to_table(
+        id_to_activity_dict, args['activity_lookup_table_uri'], 'activity_id',
+        'activity_type')
+
+    #Each selection gets its own read position in the sorted runs
+    if allocation_engine == 'legacy':
+        activity_streams = dict(
+            (activity_index, natcap.rios.disk_sort.iterate_records(
+                sorted_runs, activity_index))
+            for activity_index, sorted_runs in enumerate(
+                portfolio_data['sorted_runs']))
+    else:
+        #The merge's dataset index is the activity index
+        activity_streams = natcap.rios.disk_sort.BatchMerge(
+            portfolio_data['sorted_runs'])
+
     #Make a consistent directory registry.
     directory_registry = {
         'continuous_activity_portfolio': os.path.join(
@@ -662,18 +1575,24 @@ def calculate_activity_portfolio(args, report_data=None):
     pygeoprocessing.geoprocessing.create_directories(
         directory_registry.values())
 
-    for row_index in range(n_rows):
-        mask_array = mask_band.ReadAsArray(0, row_index, n_cols, 1)
-        #count the number of pixels not nodata
-        total_available_pixels += numpy.sum(mask_array == 1)
-    mask_band = None
-    mask_ds = None
-
-    activity_array = numpy.memmap(
-        pygeoprocessing.geoprocessing.temporary_filename(), dtype=numpy.ubyte,
-        mode='w+', shape=(n_rows * n_cols,))
+    allocation_state = natcap.rios.allocation_state.AllocationState(
+        n_rows, n_cols, len(activity_list),
+        args['budget_config']['years_to_spend'],
+        tile_size=_PORTFOLIO_BLOCK_SIZE)
     activity_nodata = 255
-    activity_array[:] = activity_nodata
+
+    if args.get('write_allocation_rank', False):
+        #rank 0 is unallocated, the first allocated pixel is rank 1, a fresh
+        #file is already all 0
+        allocation_rank_array = numpy.memmap(
+            pygeoprocessing.geoprocessing.temporary_filename(),
+            dtype=numpy.uint32, mode='w+', shape=(n_rows * n_cols,))
+        allocation_order = []
+        allocation_segments = []
+        last_rank = 0
+        cumulative_cost = 0.0
+    else:
+        allocation_order = None
 
     for year_index in xrange(args['budget_config']['years_to_spend']):
         LOGGER.info('create a portfolio dataset for year %s', year_index + 1)
@@ -709,184 +1628,85 @@ def calculate_activity_portfolio(args, report_data=None):
         report_data_dict['area_converted'] = dict([
                 (activity_name, 0.0) for activity_name in activity_list])
 
-        #We'll use this as a data structure to keep track of how many pixels
-        #we can spend in each activity
-        max_possible_activity_pixels = [
-            int(budget/cost) for budget, cost in
-            zip(activity_budget, activity_cost)]
-
-        heap_empty = False
-        while (sum(max_possible_activity_pixels) > 0 and
-               total_available_pixels > 0 and not heap_empty):
-            #Assemble the activity iterator by only including those iterators
-            #that have budget on the pixel
-            valid_activity_iterators = []
-
-            for activity_index, pixel_budget in enumerate(
-                    max_possible_activity_pixels):
-                if pixel_budget > 0:
-                    valid_activity_iterators.append(activity_iterators[activity_index])
-
-            if len(valid_activity_iterators) == 0:
-                #activity budget left for any pixels, break
-                break
-
-            activity_iterator = heapq.merge(*valid_activity_iterators)
-
-            #The heap might be empty, if its not, we'll get inside the
-            #for loop and reset it.  This saves us from the tricky case to see if
-            #there are any elements left to generate since we can't easily peek
-            #ahead on the activity_iterator
-            heap_empty = True
-            for _, flat_index, activity_index in activity_iterator:
-                heap_empty = False
-
-                #See if the pixel has already been allocated
-                if activity_array[flat_index] != activity_nodata:
-                    continue
-
-                #Otherwise, allocate the pixel
-                if total_available_pixels % 10000 == 0:
-                    LOGGER.info("year %s activity: allocating pixels for activity %s pixels left %s" % (year_index + 1, activity_index,total_available_pixels))
-                activity_array[flat_index] = activity_index
-                activity_budget[activity_index] -= activity_cost[activity_index]
-
-                #This is complicated index because I set up everything to be
-                #indexed by activity index, but in the report we dump according
-                #to activity_name
-                report_data_dict['activity_spent'][activity_list[activity_index]] += activity_cost[activity_index]
-                #the 10,000 is to convert square meters to Ha
-                report_data_dict['area_converted'][activity_list[activity_index]] += (pixel_size_out ** 2) / 10000.0
-
-                max_possible_activity_pixels[activity_index] -= 1
-                total_available_pixels -= 1
-                assert(activity_budget[activity_index] >= 0)
-                assert(max_possible_activity_pixels[activity_index] >= 0)
-
-                if max_possible_activity_pixels[activity_index] == 0 or total_available_pixels == 0:
-                    #update the iterator
-                    break
-
-        #Now reallocate any remaining activity budget as float and spend through
-        #whatever pixels are left
-        if args['budget_config']['if_left_over'] == 'Proportionally reallocate':
-            floating_budget += sum(activity_budget)
-
-        #We'll need to keep track of which iterators to use by what kinds of
-        #activities we have money left to spend on
-        min_cost = min(activity_cost)
-        heap_empty = False
-        while floating_budget > min_cost and total_available_pixels > 0 and not heap_empty:
-
-            valid_activity_iterators = []
-            #we'll use max_cost as a trigger for when the float budget falls below
-            #to reallocate the heap iterators
-            max_cost = 0.0
-            for activity_index, cost in enumerate(activity_cost):
-                if cost < floating_budget:
-                    valid_activity_iterators.append(
-                        activity_iterators[activity_index])
-                    max_cost = max(cost, max_cost)
-
-            activity_iterator = heapq.merge(*valid_activity_iterators)
-
-            #It's possible all the heap iterators are empty, this guards against it
-            heap_empty = True
-            for value, flat_index, activity_index in activity_iterator:
-                heap_empty = False
-
-                #See if the pixel has already been allocated
-                if activity_array[flat_index] != activity_nodata:
-                    continue
-
-                #Otherwise, allocate the pixel
-                if total_available_pixels % 10000 == 0:
-                    LOGGER.info("year %s float_budget: allocating pixels for activity %s pixels left %s" % (year_index + 1, activity_index,total_available_pixels))
-                activity_array[flat_index] = activity_index
-                floating_budget -= activity_cost[activity_index]
-                report_data_dict['activity_spent'][activity_list[activity_index]] += activity_cost[activity_index]
-                report_data_dict['area_converted'][activity_list[activity_index]] += (pixel_size_out ** 2) / 10000
-
-                total_available_pixels -= 1
-                assert(floating_budget >= 0)
-
-                if max_cost > floating_budget or total_available_pixels == 0:
-                    #update the iterator
-                    break
+        allocate_year = _ALLOCATION_ENGINES[allocation_engine]
+        floating_budget, total_available_pixels, heap_empty = allocate_year(
+            activity_streams, allocation_state, activity_list,
+            activity_cost, activity_budget, floating_budget,
+            args['budget_config']['if_left_over'], total_available_pixels,
+            pixel_size_out, report_data_dict, year_index,
+            allocation_order=allocation_order)
+
+        if allocation_order is not None:
+            last_rank, cumulative_cost = _rank_allocation_order(
+                allocation_order, allocation_rank_array, last_rank,
+                cumulative_cost, activity_cost, year_index,
+                allocation_segments)
+            del allocation_order[:]
 
         LOGGER.info('finishing floating floating_budget %s, total_available_pixels %s heap_empty %s' % (floating_budget, total_available_pixels, heap_empty))
 
-        activity_portfolio_uri = os.path.join(
-            directory_registry['continuous_activity_portfolio'],
-            'activity_portfolio_continuous_year_%s%s.tif' % (year_index + 1, args['results_suffix']))
-        _write_array_to_uri(
-            activity_array, available_mask_uri, activity_nodata,
-            activity_portfolio_uri)
-        pygeoprocessing.geoprocessing.calculate_raster_stats_uri(activity_portfolio_uri)
-        pygeoprocessing.geoprocessing.create_rat_uri(
-            activity_portfolio_uri, id_to_activity_dict, "Activity")
-
         report_data.append(report_data_dict)
 
-    #Make the stepwise activity budgets
-    #Year 1 will just be year 1 continuous
-    year_1_activity_dataset_uri = os.path.join(
-        directory_registry['yearly_activity_portfolio'],
-        'activity_portfolio_year_1%s.tif' % args['results_suffix'])
-    shutil.copy(
-        os.path.join(
-            directory_registry['continuous_activity_portfolio'],
-            'activity_portfolio_continuous_year_1%s.tif' % args['results_suffix']),
-        year_1_activity_dataset_uri
-        )
-    pygeoprocessing.geoprocessing.create_rat_uri(
-        year_1_activity_dataset_uri, id_to_activity_dict, "Activity")
-
-    #Copy the RAT
-    shutil.copy(
-        os.path.join(
-            directory_registry['continuous_activity_portfolio'],
-            'activity_portfolio_continuous_year_1%s.tif.aux.xml' % args['results_suffix']),
-        os.path.join(
-                directory_registry['yearly_activity_portfolio'],
-                'activity_portfolio_year_1%s.tif.aux.xml' % args['results_suffix']))
-
-    #The rest will be the set difference of the current continuous year to the
-    #previous
-    for year_index in xrange(1, args['budget_config']['years_to_spend']):
-        def _subtract_activity_years(prev_year, cur_year):
-            return numpy.where(prev_year == cur_year, activity_nodata, cur_year)
-            #if prev_year == cur_year:
-            #    return activity_nodata
-            #return cur_year
-
-        activity_portfolio_uri = [
+    #The continuous portfolios are the pixels allocated up to and including
+    #each year, the yearly ones the pixels allocated in that year and the
+    #activity portfolio all of them, written in one pass over the allocation
+    #along with the year each pixel was allocated in.  If only 1 year we
+    #don't need the continous or yearly outputs.
+    years_to_spend = args['budget_config']['years_to_spend']
+    activity_outputs = []
+    allocation_year_uri = None
+    if years_to_spend > 1:
+        allocation_year_uri = os.path.join(
+            args['output_dir'],
+            'allocation_year%s.tif' % args['results_suffix'])
+    for year_index in xrange(years_to_spend if years_to_spend > 1 else 0):
+        activity_outputs.append((
             os.path.join(
                 directory_registry['continuous_activity_portfolio'],
-                'activity_portfolio_continuous_year_%s%s.tif' % (year_index, args['results_suffix'])),
+                'activity_portfolio_continuous_year_%s%s.tif' % (
+                    year_index + 1, args['results_suffix'])),
+            0, year_index))
+        activity_outputs.append((
             os.path.join(
-                directory_registry['continuous_activity_portfolio'],
-                'activity_portfolio_continuous_year_%s%s.tif' % (year_index + 1, args['results_suffix']))]
-
-        current_activitiy_portfolio_uri = os.path.join(
-            directory_registry['yearly_activity_portfolio'],
-            'activity_portfolio_year_%s%s.tif' % (year_index + 1, args['results_suffix']))
-
-        pygeoprocessing.geoprocessing.vectorize_datasets(
-            activity_portfolio_uri, _subtract_activity_years,
-            current_activitiy_portfolio_uri, gdal.GDT_Byte, activity_nodata,
-            pixel_size_out, "intersection", dataset_to_align_index=0,
-            vectorize_op=False)
+                directory_registry['yearly_activity_portfolio'],
+                'activity_portfolio_year_%s%s.tif' % (
+                    year_index + 1, args['results_suffix'])),
+            year_index, year_index))
+    activity_portfolio_uri = args['activity_portfolio_uri']
+    activity_outputs.append(
+        (activity_portfolio_uri, 0, years_to_spend - 1))
+    _write_allocation_rasters(
+        allocation_state, available_mask_uri, activity_nodata,
+        activity_outputs, allocation_year_uri)
+    allocation_state.close()
+    for output_uri, _, _ in activity_outputs:
+        pygeoprocessing.geoprocessing.calculate_raster_stats_uri(output_uri)
         pygeoprocessing.geoprocessing.create_rat_uri(
-            current_activitiy_portfolio_uri, id_to_activity_dict, "Activity")
+            output_uri, id_to_activity_dict, "Activity")
 
-    #This writes the activity portfolio
-    activity_portfolio_uri = args['activity_portfolio_uri']
-    _write_array_to_uri(activity_array, available_mask_uri,
-                        activity_nodata, activity_portfolio_uri)
-    pygeoprocessing.geoprocessing.calculate_raster_stats_uri(activity_portfolio_uri)
-    pygeoprocessing.geoprocessing.create_rat_uri(
-        activity_portfolio_uri, id_to_activity_dict, "Activity")
+    if allocation_order is not None:
+        LOGGER.info('writing the allocation rank and cost table')
+        _write_array_to_uri(
+            allocation_rank_array, available_mask_uri, 0,
+            os.path.join(
+                args['output_dir'],
+                'allocation_rank%s.tif' % args['results_suffix']),
+            datatype=gdal.GDT_UInt32)
+        with open(os.path.join(
+                args['output_dir'], 'allocation_rank_cost%s.csv' %
+                args['results_suffix']), 'wb') as table_file:
+            table_writer = csv.writer(table_file)
+            table_writer.writerow([
+                'year', 'first_rank', 'last_rank', 'activity_id',
+                'activity_type', 'unit_cost', 'cumulative_cost'])
+            #costs are written with repr so they read back exactly
+            for segment in allocation_segments:
+                table_writer.writerow([
+                    segment['year'], segment['first_rank'],
+                    segment['last_rank'], segment['activity_id'],
+                    activity_list[segment['activity_id']],
+                    repr(segment['unit_cost']),
+                    repr(segment['cumulative_cost'])])
 
     #This writes a raster lookup id
     activity_raster_id_json_uri = os.path.join(
@@ -919,21 +1739,428 @@ def calculate_activity_portfolio(args, report_data=None):
             value[index_mask] = pixels[index][index_mask]
         return numpy.where(nodata_mask, transition_nodata, value)
 
-    pygeoprocessing.geoprocessing.vectorize_datasets(
+    natcap.rios.raster_engine.vectorize_datasets(
         [activity_portfolio_uri] + max_transition_activity_list,
         _max_transition_raster, max_activity_transition_raster_uri,
         gdal.GDT_Int32, transition_nodata, pixel_size_out, "intersection",
-        dataset_to_align_index=0, vectorize_op=False)
+        dataset_to_align_index=0, n_workers=args.get('n_workers'))
     pygeoprocessing.geoprocessing.create_rat_uri(
         max_activity_transition_raster_uri, args['transition_dictionary'],
         "Transition")
 
     # if only 1 year we don't need the continous outputs
     # this was an issue identified as a bottlneck in wide scale uptake of RIOS
-    if args['budget_config']['years_to_spend'] == 1:
+    if years_to_spend == 1:
         shutil.rmtree(directory_registry['continuous_activity_portfolio'])
         shutil.rmtree(directory_registry['yearly_activity_portfolio'])
 
+
+def _rank_allocation_order(
+        allocation_order, allocation_rank_array, last_rank, cumulative_cost,
+        activity_cost, year_index, allocation_segments):
+    """Numbers the pixels of a year's allocation order after `last_rank`
+        and summarizes them as runs of the same activity.
+
+        allocation_order - the (flat indexes, activity indexes) list filled in
+            by an allocation engine
+        allocation_rank_array - a flat array of allocation ranks, updated in
+            place
+        last_rank - the rank of the last pixel allocated in earlier years
+        cumulative_cost - the cost of all the pixels up to `last_rank`
+        activity_cost - a list of per pixel costs indexed by activity index
+        year_index - the index of the budget year
+        allocation_segments - a list that a dictionary is appended to for each
+            run of pixels allocated to the same activity with the keys 'year',
+            'first_rank', 'last_rank', 'activity_id', 'unit_cost' and
+            'cumulative_cost' (the cost up to and including 'last_rank')
+
+        returns a tuple of (last_rank, cumulative_cost) after this year"""
+
+    if len(allocation_order) == 0:
+        return last_rank, cumulative_cost
+
+    flat_index = numpy.concatenate(
+        [numpy.atleast_1d(indexes) for indexes, _ in allocation_order])
+    activity_index = numpy.concatenate(
+        [numpy.atleast_1d(activities) for _, activities in allocation_order])
+    allocation_rank_array[flat_index] = numpy.arange(
+        last_rank + 1, last_rank + 1 + flat_index.size)
+
+    run_starts = numpy.concatenate((
+        [0], numpy.nonzero(numpy.diff(activity_index))[0] + 1))
+    run_ends = numpy.concatenate((run_starts[1:], [activity_index.size]))
+    for run_start, run_end in zip(run_starts, run_ends):
+        run_activity = int(activity_index[run_start])
+        cumulative_cost = _accumulate_repeated(
+            numpy.add, cumulative_cost, activity_cost[run_activity],
+            run_end - run_start)
+        allocation_segments.append({
+            'year': year_index + 1,
+            'first_rank': last_rank + 1 + run_start,
+            'last_rank': last_rank + run_end,
+            'activity_id': run_activity,
+            'unit_cost': activity_cost[run_activity],
+            'cumulative_cost': cumulative_cost,
+            })
+    return last_rank + flat_index.size, cumulative_cost
+
+
+def _allocate_year_legacy(
+        activity_iterators, allocation_state, activity_list,
+        activity_cost, activity_budget, floating_budget, if_left_over,
+        total_available_pixels, pixel_size_out, report_data_dict, year_index,
+        allocation_order=None):
+    """Allocates one year of activity and floating budget one pixel at a time
+        by merging the `disk_sort.sort_to_disk` iterators with `heapq.merge`.
+
+        activity_iterators - a dictionary of activity index to the sorted
+            (score, flat_index, activity_index) iterator for that activity
+        allocation_state - an `allocation_state.AllocationState` of the
+            activity index allocated to each pixel.  Updated in place.
+        activity_list - the activity names in activity index order
+        activity_cost - a list of per pixel costs indexed by activity index
+        activity_budget - a list of activity budgets indexed by activity
+            index.  Updated in place.
+        floating_budget - the floating budget for the year
+        if_left_over - 'Report remainder' or 'Proportionally reallocate'
+        total_available_pixels - the number of pixels still available
+        pixel_size_out - the pixel size of the rasters in meters
+        report_data_dict - the report dictionary for this year, its
+            'activity_spent' and 'area_converted' entries are updated in place
+        year_index - the index of the budget year, used for logging
+        allocation_order - (optional) a list that a (flat indexes, activity
+            indexes) pair is appended to for each allocation, in the order the
+            pixels are allocated
+
+        returns a tuple of (floating_budget, total_available_pixels,
+            heap_empty) as left at the end of the year"""
+
+    #We'll use this as a data structure to keep track of how many pixels
+    #we can spend in each activity
+    max_possible_activity_pixels = [
+        int(budget/cost) for budget, cost in
+        zip(activity_budget, activity_cost)]
+
+    heap_empty = False
+    while (sum(max_possible_activity_pixels) > 0 and
+           total_available_pixels > 0 and not heap_empty):
+        #Assemble the activity iterator by only including those iterators
+        #that have budget on the pixel
+        valid_activity_iterators = []
+
+        for activity_index, pixel_budget in enumerate(
+                max_possible_activity_pixels):
+            if pixel_budget > 0:
+                valid_activity_iterators.append(activity_iterators[activity_index])
+
+        if len(valid_activity_iterators) == 0:
+            #activity budget left for any pixels, break
+            break
+
+        activity_iterator = heapq.merge(*valid_activity_iterators)
+
+        #The heap might be empty, if its not, we'll get inside the
+        #for loop and reset it.  This saves us from the tricky case to see if
+        #there are any elements left to generate since we can't easily peek
+        #ahead on the activity_iterator
+        heap_empty = True
+        for _, flat_index, activity_index in activity_iterator:
+            heap_empty = False
+
+            #See if the pixel has already been allocated
+            if not allocation_state.available(flat_index):
+                continue
+
+            #Otherwise, allocate the pixel
+            if total_available_pixels % 10000 == 0:
+                LOGGER.info("year %s activity: allocating pixels for activity %s pixels left %s" % (year_index + 1, activity_index,total_available_pixels))
+            allocation_state.allocate(flat_index, activity_index, year_index)
+            if allocation_order is not None:
+                allocation_order.append((flat_index, activity_index))
+            activity_budget[activity_index] -= activity_cost[activity_index]
+
+            #This is complicated index because I set up everything to be
+            #indexed by activity index, but in the report we dump according
+            #to activity_name
+            report_data_dict['activity_spent'][activity_list[activity_index]] += activity_cost[activity_index]
+            #the 10,000 is to convert square meters to Ha
+            report_data_dict['area_converted'][activity_list[activity_index]] += (pixel_size_out ** 2) / 10000.0
+
+            max_possible_activity_pixels[activity_index] -= 1
+            total_available_pixels -= 1
+            assert(activity_budget[activity_index] >= 0)
+            assert(max_possible_activity_pixels[activity_index] >= 0)
+
+            if max_possible_activity_pixels[activity_index] == 0 or total_available_pixels == 0:
+                #update the iterator
+                break
+
+    #Now reallocate any remaining activity budget as float and spend through
+    #whatever pixels are left
+    if if_left_over == 'Proportionally reallocate':
+        floating_budget += sum(activity_budget)
+
+    #We'll need to keep track of which iterators to use by what kinds of
+    #activities we have money left to spend on
+    min_cost = min(activity_cost)
+    heap_empty = False
+    while floating_budget > min_cost and total_available_pixels > 0 and not heap_empty:
+
+        valid_activity_iterators = []
+        #we'll use max_cost as a trigger for when the float budget falls below
+        #to reallocate the heap iterators
+        max_cost = 0.0
+        for activity_index, cost in enumerate(activity_cost):
+            if cost < floating_budget:
+                valid_activity_iterators.append(
+                    activity_iterators[activity_index])
+                max_cost = max(cost, max_cost)
+
+        activity_iterator = heapq.merge(*valid_activity_iterators)
+
+        #It's possible all the heap iterators are empty, this guards against it
+        heap_empty = True
+        for value, flat_index, activity_index in activity_iterator:
+            heap_empty = False
+
+            #See if the pixel has already been allocated
+            if not allocation_state.available(flat_index):
+                continue
+
+            #Otherwise, allocate the pixel
+            if total_available_pixels % 10000 == 0:
+                LOGGER.info("year %s float_budget: allocating pixels for activity %s pixels left %s" % (year_index + 1, activity_index,total_available_pixels))
+            allocation_state.allocate(flat_index, activity_index, year_index)
+            if allocation_order is not None:
+                allocation_order.append((flat_index, activity_index))
+            floating_budget -= activity_cost[activity_index]
+            report_data_dict['activity_spent'][activity_list[activity_index]] += activity_cost[activity_index]
+            report_data_dict['area_converted'][activity_list[activity_index]] += (pixel_size_out ** 2) / 10000
+
+            total_available_pixels -= 1
+            assert(floating_budget >= 0)
+
+            if max_cost > floating_budget or total_available_pixels == 0:
+                #update the iterator
+                break
+
+    return floating_budget, total_available_pixels, heap_empty
+
+
+def _allocate_year_batch(
+        activity_merge, allocation_state, activity_list,
+        activity_cost, activity_budget, floating_budget, if_left_over,
+        total_available_pixels, pixel_size_out, report_data_dict, year_index,
+        allocation_order=None, block_size=2**16):
+    """Allocates one year of activity and floating budget in blocks of
+        merged candidates.  This gives the same result as
+        `_allocate_year_legacy`, including the candidate that each
+        `heapq.merge` rebuild drops from the head of every other activity
+        iterator.
+
+        activity_merge - a `disk_sort.BatchMerge` over the sorted activity
+            scores whose dataset index is the activity index
+        block_size - the maximum number of merged candidates to process at
+            once
+
+        All the other parameters and the return value are the same as
+        `_allocate_year_legacy`."""
+
+    activity_cost_array = numpy.array(activity_cost, dtype=numpy.float64)
+    pixel_area_ha = (pixel_size_out ** 2) / 10000.0
+
+    def _allocate_block(candidates, max_allocations):
+        """Allocates the unallocated candidates in `candidates`, stopping
+            early at the allocation whose position is returned by
+            `max_allocations` on the allocated activity indexes.
+
+            returns (allocated activity indexes, True if stopped early)"""
+        flat_index = candidates['index']
+        activity_index = candidates['dataset']
+
+        #A pixel can only be allocated the first time it appears, later
+        #appearances in the block are for pixels that are allocated by then
+        _, first_index = numpy.unique(flat_index, return_index=True)
+        allocate_mask = numpy.zeros(flat_index.shape, dtype=bool)
+        allocate_mask[first_index] = True
+        allocate_mask &= allocation_state.available(flat_index)
+        allocate_index = numpy.nonzero(allocate_mask)[0]
+
+        stop_index = max_allocations(activity_index[allocate_index])
+        stopped = stop_index is not None
+        if stopped:
+            allocate_index = allocate_index[0:stop_index+1]
+            activity_merge.advance(candidates[0:allocate_index[-1]+1])
+        else:
+            activity_merge.advance(candidates)
+
+        allocated_activities = activity_index[allocate_index]
+        allocation_state.allocate(
+            flat_index[allocate_index], allocated_activities, year_index)
+        if allocation_order is not None:
+            allocation_order.append(
+                (flat_index[allocate_index], allocated_activities))
+
+        #Spending is accumulated sequentially so the floating point totals
+        #match a pixel by pixel allocation exactly
+        n_allocated = numpy.bincount(
+            allocated_activities, minlength=len(activity_list))
+        for index in numpy.nonzero(n_allocated)[0]:
+            activity_name = activity_list[index]
+            report_data_dict['activity_spent'][activity_name] = (
+                _accumulate_repeated(
+                    numpy.add, report_data_dict['activity_spent'][activity_name],
+                    activity_cost[index], n_allocated[index]))
+            report_data_dict['area_converted'][activity_name] = (
+                _accumulate_repeated(
+                    numpy.add, report_data_dict['area_converted'][activity_name],
+                    pixel_area_ha, n_allocated[index]))
+        return allocated_activities, stopped
+
+    def _skip_merge_heads(valid_activities, last_activity):
+        """Drops the head of every activity but `last_activity` the same way
+            a discarded `heapq.merge` does."""
+        for activity_index in valid_activities:
+            if activity_index != last_activity:
+                activity_merge.skip(activity_index)
+
+    #We'll use this as a data structure to keep track of how many pixels
+    #we can spend in each activity
+    max_possible_activity_pixels = [
+        int(budget/cost) for budget, cost in
+        zip(activity_budget, activity_cost)]
+
+    heap_empty = False
+    while (sum(max_possible_activity_pixels) > 0 and
+           total_available_pixels > 0 and not heap_empty):
+        valid_activities = [
+            activity_index for activity_index, pixel_budget in enumerate(
+                max_possible_activity_pixels) if pixel_budget > 0]
+
+        if len(valid_activities) == 0:
+            #activity budget left for any pixels, break
+            break
+
+        def _max_activity_allocations(allocated_activities):
+            """Finds the allocation that exhausts an activity's pixel budget
+                or the available pixels, None if there isn't one"""
+            stop_index = None
+            if allocated_activities.size >= total_available_pixels:
+                stop_index = total_available_pixels - 1
+            for activity_index in valid_activities:
+                activity_allocations = numpy.nonzero(
+                    allocated_activities == activity_index)[0]
+                pixel_budget = max_possible_activity_pixels[activity_index]
+                if activity_allocations.size >= pixel_budget:
+                    stop_index = min(
+                        activity_allocations[pixel_budget-1],
+                        stop_index if stop_index is not None else
+                        allocated_activities.size)
+            return stop_index
+
+        heap_empty = True
+        while True:
+            candidates = activity_merge.peek(valid_activities, block_size)
+            if candidates.size == 0:
+                break
+            heap_empty = False
+
+            allocated_activities, stopped = _allocate_block(
+                candidates, _max_activity_allocations)
+            n_allocated = numpy.bincount(
+                allocated_activities, minlength=len(activity_list))
+            for activity_index in numpy.nonzero(n_allocated)[0]:
+                activity_budget[activity_index] = _accumulate_repeated(
+                    numpy.subtract, activity_budget[activity_index],
+                    activity_cost[activity_index], n_allocated[activity_index])
+                max_possible_activity_pixels[activity_index] -= (
+                    n_allocated[activity_index])
+            total_available_pixels -= allocated_activities.size
+            LOGGER.info(
+                "year %s activity: allocated %s pixels, pixels left %s",
+                year_index + 1, allocated_activities.size,
+                total_available_pixels)
+
+            if stopped:
+                _skip_merge_heads(valid_activities, allocated_activities[-1])
+                break
+
+    #Now reallocate any remaining activity budget as float and spend through
+    #whatever pixels are left
+    if if_left_over == 'Proportionally reallocate':
+        floating_budget += sum(activity_budget)
+
+    min_cost = min(activity_cost)
+    heap_empty = False
+    while (floating_budget > min_cost and total_available_pixels > 0 and
+           not heap_empty):
+        valid_activities = []
+        #we'll use max_cost as a trigger for when the float budget falls below
+        #to reallocate the merge
+        max_cost = 0.0
+        for activity_index, cost in enumerate(activity_cost):
+            if cost < floating_budget:
+                valid_activities.append(activity_index)
+                max_cost = max(cost, max_cost)
+
+        def _max_floating_allocations(allocated_activities):
+            """Finds the allocation that drops the floating budget below
+                max_cost or exhausts the available pixels, None if there
+                isn't one"""
+            if allocated_activities.size == 0:
+                return None
+            remaining_budget = numpy.subtract.accumulate(numpy.concatenate((
+                [floating_budget],
+                activity_cost_array[allocated_activities])))[1:]
+            stop_mask = max_cost > remaining_budget
+            stop_mask[total_available_pixels-1:] = True
+            stop_index = numpy.argmax(stop_mask)
+            if not stop_mask[stop_index]:
+                return None
+            return stop_index
+
+        heap_empty = True
+        while True:
+            candidates = activity_merge.peek(valid_activities, block_size)
+            if candidates.size == 0:
+                break
+            heap_empty = False
+
+            allocated_activities, stopped = _allocate_block(
+                candidates, _max_floating_allocations)
+            floating_budget = float(numpy.subtract.accumulate(
+                numpy.concatenate((
+                    [floating_budget],
+                    activity_cost_array[allocated_activities])))[-1])
+            total_available_pixels -= allocated_activities.size
+            LOGGER.info(
+                "year %s float_budget: allocated %s pixels, pixels left %s",
+                year_index + 1, allocated_activities.size,
+                total_available_pixels)
+
+            if stopped:
+                _skip_merge_heads(valid_activities, allocated_activities[-1])
+                break
+
+    return floating_budget, total_available_pixels, heap_empty
+
+
+def _accumulate_repeated(ufunc, value, step, n_steps):
+    """Applies `value = ufunc(value, step)` `n_steps` times, in order, so the
+        floating point result is the same as doing it in a python loop.
+
+        returns the resulting python float"""
+
+    return float(ufunc.accumulate(
+        numpy.concatenate(([value], numpy.repeat(step, n_steps))))[-1])
+
+
+_ALLOCATION_ENGINES = {
+    'legacy': _allocate_year_legacy,
+    'batch': _allocate_year_batch,
+    }
+
+
 def _make_distance_kernel(max_distance):
     kernel_size = int(numpy.round(max_distance * 2 + 1))
     distance_kernel = numpy.empty((kernel_size, kernel_size), dtype=numpy.float)
@@ -945,171 +2172,418 @@ def _make_distance_kernel(max_distance):
 
 
 def _mask_activity_areas(
-    args, prioritization_raster_uri, activity_name, activity_index,
-    activity_nodata, budget_selection_activity_uri, per_cell_cost, prefer_boost,
-    pixel_size_out):
-
-    prioritization_nodata = pygeoprocessing.geoprocessing.get_nodata_from_uri(
-            prioritization_raster_uri)
-    mask_uri = {
-        'prevent': pygeoprocessing.geoprocessing.temporary_filename(),
-        'prefer': pygeoprocessing.geoprocessing.temporary_filename(),
-        }
-
-    for activity_type in ['prevent', 'prefer']:
-        LOGGER.info('mask out %s shapefile areas for activity %s' % (
-                activity_type, activity_name))
-        _rasterize_activity_action(
-            args['activity_shapefiles'], activity_name, activity_type,
-            args['lulc_uri'], mask_uri[activity_type])
+    args, activity_list, activity_nodata, budget_selection_activity_uris,
+    activity_cost, prefer_boost, pixel_size_out, action_mask_uris,
+    available_mask_uri):
+    """Masks every activity's scores with its prefer/prevent shapefile areas
+        and allowed landcovers in a single pass over the landcover, and
+        counts the pixels that are left for at least one activity.
+
+        args - the same arguments as `_prepare_activity_portfolio`
+        activity_list - the activity names in activity index order
+        activity_nodata - the nodata value of the masked scores
+        budget_selection_activity_uris - activity name to the uri of its
+            masked scores
+        activity_cost - per pixel costs indexed by activity index
+        prefer_boost - the amount added to the scores of prefered pixels
+        pixel_size_out - the cell size of the masked scores
+        action_mask_uris - the `_rasterize_activity_actions` rasters of
+            activity_list in groups of `_ACTIVITIES_PER_ACTION_MASK`
+        available_mask_uri - the uri of a Byte raster that's 1 where any
+            activity's masked score is valid and activity_nodata elsewhere
+
+        returns the number of pixels where any activity's masked score is
+            valid"""
 
     LOGGER.info('mask out lulc prevented areas for each activity')
-    lucodes_to_allow = set()
-    for lucode, activity_list in args['lulc_activity_potential_map'].iteritems():
-        if activity_name in activity_list:
-            lucodes_to_allow.add(int(lucode))
-    LOGGER.info('activity_name %s allowed lu codes: %s' % (activity_name, str(lucodes_to_allow)))
-    #make sure it's a float for division below
-    per_cell_cost = float(per_cell_cost)
-    def _activity_prevent_prefer(
-            lucode, prevent_mask, prefer_mask, activity_score):
-        """masks out the pixels in the activity that are not allowed
+    for activity_name in activity_list:
+        LOGGER.info('activity_name %s allowed lu codes: %s' % (
+            activity_name, str(sorted(set(
+                int(lucode) for lucode, lucode_activities in
+                args['lulc_activity_potential_map'].iteritems()
+                if activity_name in lucode_activities)))))
+    allowed_lucode_op = _make_allowed_lucode_op(
+        args['lulc_activity_potential_map'], activity_list)
+
+    prioritization_uris = [
+        args['activities'][activity_name]['prioritization_raster_uri']
+        for activity_name in activity_list]
+    prioritization_nodata_list = [
+        pygeoprocessing.geoprocessing.get_nodata_from_uri(prioritization_uri)
+        for prioritization_uri in prioritization_uris]
+    #make sure they're floats for division below
+    per_cell_cost_list = [
+        float(activity_cost[activity_index])
+        for activity_index in xrange(len(activity_list))]
+    n_action_masks = len(action_mask_uris)
+    #the number of available pixels in each block, list.append is thread
+    #safe if the blocks are calculated in parallel
+    available_pixel_counts = []
+
+    def _activity_prevent_prefer(lucode, *mask_and_score_blocks):
+        """masks out the pixels in each activity that are not allowed
             given their landcover type or shapefile mask, bumps
             up pixels that are prefered"""
 
-        #initialize to false
-        valid_mask = numpy.zeros(lucode.shape, dtype=numpy.bool)
-        for allowed_lucode in lucodes_to_allow:
-            valid_mask = valid_mask | (lucode == allowed_lucode)
-        valid_mask = valid_mask & (prevent_mask != 1)
-        valid_mask = valid_mask & (activity_score != prioritization_nodata)
-        return numpy.where(
-            valid_mask,
-            (activity_score + prefer_mask * prefer_boost) / per_cell_cost,
-            activity_nodata)
-
-    pygeoprocessing.geoprocessing.vectorize_datasets(
-        [args['lulc_uri'], mask_uri['prevent'], mask_uri['prefer'],
-         prioritization_raster_uri], _activity_prevent_prefer,
-        budget_selection_activity_uri,
-        gdal.GDT_Float32, activity_nodata, pixel_size_out, "intersection",
-        dataset_to_align_index=0, vectorize_op=False)
-
-
-def _write_array_to_uri(array, base_ds_uri, ds_nodata, ds_uri):
-    """This is a helper function to write a numpy array to a pre-allocated
-        GDAL dataset.
+        action_masks = mask_and_score_blocks[:n_action_masks]
+        activity_scores = mask_and_score_blocks[n_action_masks:]
+        allowed_mask = allowed_lucode_op(lucode)
+        result_list = []
+        for activity_index, activity_score in enumerate(activity_scores):
+            action_mask = action_masks[
+                activity_index / _ACTIVITIES_PER_ACTION_MASK]
+            action_mask_index = activity_index % _ACTIVITIES_PER_ACTION_MASK
+            prevent_mask = (action_mask >> _activity_action_bit(
+                action_mask_index, 'prevent')) & 1
+            prefer_mask = (action_mask >> _activity_action_bit(
+                action_mask_index, 'prefer')) & 1
+            valid_mask = allowed_mask[activity_index] & (prevent_mask != 1)
+            valid_mask &= (
+                activity_score != prioritization_nodata_list[activity_index])
+            #cast to the output type here so the nodata check below sees
+            #the values that get written
+            result_list.append(numpy.where(
+                valid_mask,
+                (activity_score + prefer_mask * prefer_boost) /
+                per_cell_cost_list[activity_index],
+                activity_nodata).astype(numpy.float32))
+
+        nodata_mask = numpy.ones(lucode.shape, dtype=bool)
+        for activity_result in result_list:
+            nodata_mask &= activity_result == activity_nodata
+        available_pixel_counts.append(
+            nodata_mask.size - numpy.count_nonzero(nodata_mask))
+        result_list.append(numpy.where(nodata_mask, activity_nodata, 1))
+        return result_list
+
+    natcap.rios.raster_engine.multi_output_block_op(
+        [args['lulc_uri']] + action_mask_uris + prioritization_uris,
+        _activity_prevent_prefer,
+        [(budget_selection_activity_uris[activity_name], gdal.GDT_Float32,
+          activity_nodata) for activity_name in activity_list] +
+        [(available_mask_uri, gdal.GDT_Byte, activity_nodata)],
+        pixel_size_out, dataset_to_align_index=0,
+        bounding_box_mode='intersection', n_workers=args.get('n_workers'))
+    return sum(available_pixel_counts)
+
+
+def _make_allowed_lucode_op(lulc_activity_potential_map, activity_list):
+    """Makes the function that finds which activities each landcover pixel
+        allows from a lucode by activity lookup table.  The lucodes are
+        looked up like the keys of `_make_multi_reclassify_op`, landcovers
+        that aren't in the map allow no activities.
+
+        lulc_activity_potential_map - a dictionary of lucode to the list of
+            activity names allowed on it
+        activity_list - the activity names in activity index order
+
+        returns a function of an array of lucodes that returns a boolean
+            array of shape (len(activity_list),) + the lucode array's shape"""
+
+    sorted_lucodes = sorted(set(
+        int(lucode) for lucode in lulc_activity_potential_map))
+    if len(sorted_lucodes) == 0:
+        def allowed_lucodes(lucode):
+            return numpy.zeros((len(activity_list),) + lucode.shape, dtype=bool)
+        return allowed_lucodes
+
+    lucode_min = sorted_lucodes[0]
+    lucode_max = sorted_lucodes[-1]
+    dense = lucode_max - lucode_min < _DENSE_LOOKUP_SIZE
+    if dense:
+        lucode_index = dict(
+            (lucode, lucode - lucode_min) for lucode in sorted_lucodes)
+        table_size = lucode_max - lucode_min + 1
+    else:
+        lucode_index = dict(
+            (lucode, index) for index, lucode in enumerate(sorted_lucodes))
+        table_size = len(sorted_lucodes)
+        lucodes = numpy.array(sorted_lucodes)
 
-        array - numpy array
+    #one row per activity, True where the lucode allows it
+    allowed_table = numpy.zeros((len(activity_list), table_size), dtype=bool)
+    for activity_index, activity_name in enumerate(activity_list):
+        for lucode, lucode_activities in (
+                lulc_activity_potential_map.iteritems()):
+            if activity_name in lucode_activities:
+                allowed_table[activity_index, lucode_index[int(lucode)]] = True
+
+    def allowed_lucodes(lucode):
+        if dense:
+            in_range = (lucode >= lucode_min) & (lucode <= lucode_max)
+            index = numpy.where(
+                in_range, lucode - lucode_min, 0).astype(numpy.intp)
+            #non integer values fall between the lucodes
+            found_mask = in_range & (index + lucode_min == lucode)
+        else:
+            index = numpy.minimum(
+                numpy.searchsorted(lucodes, lucode), lucodes.size - 1)
+            found_mask = lucodes[index] == lucode
+        return allowed_table[:, index] & found_mask
+    return allowed_lucodes
+
+
+#The width and height of the tiles of the portfolio rasters, also the tile
+#size of the allocation state so its tile rows fill whole raster tiles
+_PORTFOLIO_BLOCK_SIZE = 256
+#The GTiff creation options of the portfolio rasters, they're written a
+#tile row at a time so they can be compressed cheaply
+_PORTFOLIO_DATASET_OPTIONS = [
+    'TILED=YES', 'BLOCKXSIZE=%d' % _PORTFOLIO_BLOCK_SIZE,
+    'BLOCKYSIZE=%d' % _PORTFOLIO_BLOCK_SIZE, 'BIGTIFF=IF_SAFER',
+    'COMPRESS=LZW']
+
+
+def _write_array_to_uri(
+        array, base_ds_uri, ds_nodata, ds_uri, datatype=gdal.GDT_Byte,
+        dataset_options=None):
+    """This is a helper function to write a flat numpy array to a new GDAL
+        dataset, a row of blocks at a time from a 2D view of the array.
+
+        array - flat numpy array or memmap in row major order
         base_ds_uri - a uri to an existsing dataset that will be used to
             define the projection and size of the outgoing dataset
         ds_nodata - the nodata value for the output dataset
-        ds_uri - a uri to a valid dataset whose n_rows/n_cols are the same
-            dimensions as the array
+        ds_uri - a uri to the output dataset whose n_rows/n_cols multiply
+            to the size of the array
+        datatype - (optional) the GDAL datatype of the output, defaults to
+            gdal.GDT_Byte
+        dataset_options - (optional) the GTiff creation options of the
+            output, defaults to `_PORTFOLIO_DATASET_OPTIONS`
 
         returns nothing"""
 
+    if dataset_options is None:
+        dataset_options = _PORTFOLIO_DATASET_OPTIONS
     pygeoprocessing.geoprocessing.new_raster_from_base_uri(
-        base_ds_uri, ds_uri, 'GTiff', ds_nodata,
-        gdal.GDT_Byte)
+        base_ds_uri, ds_uri, 'GTiff', ds_nodata, datatype,
+        dataset_options=list(dataset_options))
     n_rows, n_cols = pygeoprocessing.geoprocessing.get_row_col_from_uri(ds_uri)
     dataset = gdal.Open(ds_uri, gdal.GA_Update)
     band = dataset.GetRasterBand(1)
-    #Need to resize array for writing gdal object
-    array.resize((n_rows, n_cols))
-    band.WriteArray(array)
-    #Reflatten it
-    array.resize((n_rows * n_cols,))
+    #a reshaped view, the rows of a block are written without a copy
+    array_rows = array.reshape((n_rows, n_cols))
+    block_rows = band.GetBlockSize()[1]
+    for row_start in xrange(0, n_rows, block_rows):
+        band.WriteArray(
+            array_rows[row_start:row_start + block_rows], xoff=0,
+            yoff=row_start)
     band = None
     dataset = None
 
 
-def _rasterize_activity_action(
-        shapefile_uri_list, activity_name, action_type, base_uri, out_uri):
-    """A helper function that will make a mask of all the features in a list
-        of shapefiles that have the requested activty name and action type.
+def _write_allocation_rasters(
+        allocation_state, base_ds_uri, activity_nodata, activity_outputs,
+        year_uri):
+    """Writes the activities allocated in ranges of years, and the year each
+        pixel was allocated in, a tile row of the allocation at a time to
+        `_PORTFOLIO_DATASET_OPTIONS` datasets.
+
+        allocation_state - an `allocation_state.AllocationState` whose
+            n_rows/n_cols are the same as base_ds_uri's
+        base_ds_uri - a uri to an existsing dataset that will be used to
+            define the projection and size of the outgoing datasets
+        activity_nodata - the nodata value of the activity outputs
+        activity_outputs - a list of (uri, first_year_index, last_year_index)
+            tuples, each output is a Byte dataset of the activity index of
+            the pixels allocated from first_year_index to last_year_index
+            inclusive and activity_nodata elsewhere
+        year_uri - the uri of a UInt16 dataset of the year index + 1 each
+            pixel was allocated in, nodata 0 where it's unallocated, or None
+            to not write it
+
+        returns nothing"""
+
+    datasets = []
+    for output_uri, _, _ in activity_outputs:
+        pygeoprocessing.geoprocessing.new_raster_from_base_uri(
+            base_ds_uri, output_uri, 'GTiff', activity_nodata, gdal.GDT_Byte,
+            dataset_options=list(_PORTFOLIO_DATASET_OPTIONS))
+        datasets.append(gdal.Open(output_uri, gdal.GA_Update))
+    bands = [dataset.GetRasterBand(1) for dataset in datasets]
+    if year_uri is not None:
+        pygeoprocessing.geoprocessing.new_raster_from_base_uri(
+            base_ds_uri, year_uri, 'GTiff', 0, gdal.GDT_UInt16,
+            dataset_options=list(_PORTFOLIO_DATASET_OPTIONS))
+        year_dataset = gdal.Open(year_uri, gdal.GA_Update)
+        year_band = year_dataset.GetRasterBand(1)
+
+    #the allocation is decoded once per tile row and every output is masked
+    #into the same buffers rather than allocating new arrays per output
+    buffer_shape = (allocation_state.tile_size, allocation_state.n_cols)
+    output_buffer = numpy.empty(buffer_shape, dtype=numpy.uint8)
+    in_range_buffer = numpy.empty(buffer_shape, dtype=numpy.bool)
+    before_last_buffer = numpy.empty(buffer_shape, dtype=numpy.bool)
+    for row_start in xrange(
+            0, allocation_state.n_rows, allocation_state.tile_size):
+        row_stop = min(
+            row_start + allocation_state.tile_size, allocation_state.n_rows)
+        activity_rows, year_rows = allocation_state.read_rows(
+            row_start, row_stop, activity_nodata)
+        output_rows = output_buffer[0:row_stop - row_start]
+        in_range = in_range_buffer[0:row_stop - row_start]
+        before_last = before_last_buffer[0:row_stop - row_start]
+        for band, (_, first_year_index, last_year_index) in zip(
+                bands, activity_outputs):
+            numpy.greater(year_rows, first_year_index, out=in_range)
+            numpy.less_equal(year_rows, last_year_index + 1, out=before_last)
+            in_range &= before_last
+            output_rows.fill(activity_nodata)
+            numpy.copyto(output_rows, activity_rows, where=in_range)
+            band.WriteArray(output_rows, xoff=0, yoff=row_start)
+        if year_uri is not None:
+            year_band.WriteArray(year_rows, xoff=0, yoff=row_start)
+
+    bands = None
+    datasets = None
+    if year_uri is not None:
+        year_band = None
+        year_dataset = None
+        pygeoprocessing.geoprocessing.calculate_raster_stats_uri(year_uri)
+
+
+#The actions of the prefer/prevent shapefiles, in bit order within an
+#activity's bits of a `_rasterize_activity_actions` mask
+_ACTIVITY_ACTIONS = ['prevent', 'prefer']
+#The number of activities whose actions fit in one UInt32 mask raster
+_ACTIVITIES_PER_ACTION_MASK = 32 / len(_ACTIVITY_ACTIONS)
+
+
+def _activity_action_bit(activity_index, action_type):
+    """returns the bit of an action of the activity at activity_index in a
+        `_rasterize_activity_actions` mask"""
+
+    return (
+        activity_index * len(_ACTIVITY_ACTIONS) +
+        _ACTIVITY_ACTIONS.index(action_type))
+
+
+def _rasterize_activity_actions(
+        shapefile_uri_list, activity_names, base_uri, out_uri):
+    """A helper function that makes a bitmask of where the features in a list
+        of shapefiles have each of the requested activity names and each
+        action in `_ACTIVITY_ACTIONS`, in one pass over the features.
 
         shapefile_uri_list - a list of shapefile uris which have at least
             fields 'activity_n' and 'action'
-        activity_name - the name of an activity that might be found in the
-            shapefile 'activity_n' field.
-        action - the name of an action in the 'action' field of the shapefile
-            usually 'prefer' or 'prevent'
+        activity_names - a list of at most `_ACTIVITIES_PER_ACTION_MASK`
+            activity names that might be found in the shapefile 'activity_n'
+            field.
         base_uri - a uri to a datasource that will serve as a geotransform and
             cell size reference for the output
-        out_uri - the name of the mask output dataset.  it will contain 1 where
-            the features in the shapefile_uri_list have the same activity_name
-            and action_type and 0 everywhere else.
+        out_uri - the name of the UInt32 mask output dataset.  Bit
+            `_activity_action_bit(index, action)` of a pixel is set where the
+            features in the shapefile_uri_list have activity_names[index] and
+            that action, 0 everywhere else.
 
         returns nothing"""
 
     #Make the mask raster first, in case we don't do anything else
     pygeoprocessing.geoprocessing.new_raster_from_base_uri(
-        base_uri, out_uri, 'GTiff', 0, gdal.GDT_Byte, fill_value=0)
+        base_uri, out_uri, 'GTiff', 0, gdal.GDT_UInt32, fill_value=0)
 
     #Make sure there are some shapefiles in there, if not we're done
     if len(shapefile_uri_list) == 0:
         return
 
+    action_bits = {}
+    for activity_index, activity_name in enumerate(activity_names):
+        for action_type in _ACTIVITY_ACTIONS:
+            action_bits[(activity_name, action_type)] = _activity_action_bit(
+                activity_index, action_type)
+
     sample_vector = ogr.Open(shapefile_uri_list[0])
     sample_layer = sample_vector.GetLayer()
     sample_srs = sample_layer.GetSpatialRef()
     sample_layer = None
     sample_vector = None
 
-    mask_vector_temp_dir = tempfile.mkdtemp()
-    mask_vector_path = os.path.join(mask_vector_temp_dir, 'mask.shp')
-    esri_driver = ogr.GetDriverByName('ESRI Shapefile')
-    mask_vector = esri_driver.CreateDataSource(mask_vector_path)
-    mask_layer = mask_vector.CreateLayer(
-        'mask', sample_srs, geom_type=ogr.wkbPolygon)
-
+    #The features of each activity and action are collected in their own
+    #in memory layer in a single pass over the shapefiles
+    mask_vector = ogr.GetDriverByName('Memory').CreateDataSource('mask')
+    mask_layers = {}
+    n_skipped = 0
     for shapefile_path in shapefile_uri_list:
         shapefile = ogr.Open(shapefile_path)
-        skipped_previous = False
         for layer in shapefile:
-            # reset reading just in case, i'm debugging a segfault and
-            # everything is suspicious
             layer.ResetReading()
             for feature in layer:
-                shape_activity_name = feature.GetField(
-                    feature.GetFieldIndex('activity_n'))
-                action = feature.GetField(feature.GetFieldIndex('action'))
-
-                # This is where we get to use the column we created above, to
-                # determine if the current feature represents an area where the
-                # activity is prevented and set the value of the field
-                # accordingly.
-                if shape_activity_name == activity_name and action == action_type:
-                    mask_layer.CreateFeature(feature)
-                    skipped_previous = False
-                else:
-                    # Make a note of which activity/action/feature combination
-                    # we're skipping, just for information.
-                    if not skipped_previous:
-                        LOGGER.info(
-                            'SKIPPING %s: %s == %s && %s == %s',
-                            os.path.basename(shapefile_path), activity_name,
-                            shape_activity_name, action, action_type)
-                        skipped_previous = True
-
-    # Just in case anything has not been flushed to disk, do so now.
-    mask_layer.SyncToDisk()
-
-    # Rasterize this layer onto the copied raster.
-    mask_dataset = gdal.Open(out_uri, gdal.GA_Update)
-    gdal.RasterizeLayer(mask_dataset, [1], mask_layer, burn_values=[1])
+                action_key = (
+                    feature.GetField(feature.GetFieldIndex('activity_n')),
+                    feature.GetField(feature.GetFieldIndex('action')))
+                if action_key not in action_bits:
+                    n_skipped += 1
+                    continue
+                if action_key not in mask_layers:
+                    mask_layers[action_key] = mask_vector.CreateLayer(
+                        'mask_%d' % action_bits[action_key], sample_srs,
+                        geom_type=ogr.wkbPolygon)
+                mask_layer = mask_layers[action_key]
+                mask_feature = ogr.Feature(mask_layer.GetLayerDefn())
+                mask_feature.SetGeometry(feature.GetGeometryRef())
+                mask_layer.CreateFeature(mask_feature)
+                mask_feature = None
+        shapefile = None
+    LOGGER.info(
+        'SKIPPING %d features that are not an action of %s', n_skipped,
+        activity_names)
+
+    if len(mask_layers) == 0:
+        mask_vector = None
+        return
 
-    #Remove the temporary vector layer from disk
-    mask_layer = None
-    ogr.DataSource.__swig_destroy__(mask_vector)
-    mask_vector = None
-    shutil.rmtree(mask_vector_temp_dir)
+    #Each activity and action is rasterized into its own band of a temporary
+    #in memory raster, compressed since the masks are mostly empty, the
+    #bands are then packed into the bitmask in one pass
+    action_keys = sorted(mask_layers)
+    action_raster_uri = '/vsimem/activity_actions_%s.tif' % uuid.uuid4().hex
+    n_rows, n_cols = pygeoprocessing.geoprocessing.get_row_col_from_uri(
+        base_uri)
+    base_dataset = gdal.Open(base_uri)
+    action_dataset = gdal.GetDriverByName('GTiff').Create(
+        action_raster_uri, n_cols, n_rows, len(action_keys), gdal.GDT_Byte,
+        options=['TILED=YES', 'INTERLEAVE=BAND', 'COMPRESS=DEFLATE'])
+    action_bands = None
+    #the in memory raster is unlinked even if rasterizing or packing fails
+    try:
+        action_dataset.SetProjection(base_dataset.GetProjection())
+        action_dataset.SetGeoTransform(base_dataset.GetGeoTransform())
+        base_dataset = None
+        for band_index, action_key in enumerate(action_keys):
+            gdal.RasterizeLayer(
+                action_dataset, [band_index + 1], mask_layers[action_key],
+                burn_values=[1])
+        mask_layers = None
+        mask_vector = None
+
+        action_bands = [
+            action_dataset.GetRasterBand(band_index + 1)
+            for band_index in xrange(len(action_keys))]
+        out_dataset = gdal.Open(out_uri, gdal.GA_Update)
+        out_band = out_dataset.GetRasterBand(1)
+        for block_offset, _ in pygeoprocessing.iterblocks(out_uri):
+            mask_block = numpy.zeros(
+                (block_offset['win_ysize'], block_offset['win_xsize']),
+                dtype=numpy.uint32)
+            for action_band, action_key in zip(action_bands, action_keys):
+                action_block = action_band.ReadAsArray(**block_offset)
+                mask_block |= (
+                    (action_block == 1).astype(numpy.uint32) <<
+                    action_bits[action_key])
+            out_band.WriteArray(
+                mask_block, xoff=block_offset['xoff'],
+                yoff=block_offset['yoff'])
+        out_band = None
+        out_dataset = None
+    finally:
+        action_bands = None
+        action_dataset = None
+        gdal.Unlink(action_raster_uri)
 
 
 def _normalize_raster(
         input_raster_uri, lulc_uri, output_raster_uri, nodata_output, interp_dict,
-        pixel_size_out):
+        pixel_size_out, n_workers=None, range_uri=None):
     """Map an input raster's values to an output raster based on the provided
         interpolation dictionary.
 
@@ -1118,6 +2592,10 @@ def _normalize_raster(
         output_raster_uri - a path to the output GDAL dataset.
         nodata_output: the nodata value for the output raster
         interp_dict: an interpolation dictionary.
+        n_workers: (optional) the number of threads to calculate blocks with.
+        range_uri: (optional) a uri to a json file of the range of the input
+            the normalization uses, see `_normalization_range_uri`.  The
+            range is read from it if it's there and recorded in it if not.
 
         Interpolation dictionary must have the following structure:
             {'type': 'interpolated',
@@ -1130,40 +2608,132 @@ def _normalize_raster(
     nodata_input = pygeoprocessing.geoprocessing.get_nodata_from_uri(input_raster_uri)
     interp_type = interp_dict['interpolation']
     if interp_type == 'linear':
-        raster_min, raster_max, _, _ = pygeoprocessing.geoprocessing.get_statistics_from_uri(
-            input_raster_uri)
-        domain = float(raster_max - raster_min)
-        #If the domain is 0 that means the numerator of the fraction will
-        #always be zero, so just set the denominator to 1.
-        if domain == 0:
-            domain = 1.0
-
-        if interp_dict['inverted']:
-            def interpolate(pixel_value, lulc_value_garbage):
-                invalid_mask = (pixel_value == nodata_input) | numpy.isnan(pixel_value)
-                value = (1.0 - ((pixel_value - raster_min) / domain))
-                return numpy.where(invalid_mask, nodata_output, value)
-                #if pixel_value == nodata_input or math.isnan(pixel_value):
-                #    return nodata_output
-                #return (1.0 - ((pixel_value - raster_min) / domain))
-        else:
-            def interpolate(pixel_value, lulc_value_garbage):
-                invalid_mask = (pixel_value == nodata_input) | numpy.isnan(pixel_value)
-                value = (pixel_value - raster_min) / domain
-                return numpy.where(invalid_mask, nodata_output, value)
-                #if pixel_value == nodata_input or math.isnan(pixel_value):
-                #    return nodata_output
-                #return (pixel_value - raster_min) / domain
-
-        pygeoprocessing.geoprocessing.vectorize_datasets(
-            [input_raster_uri, lulc_uri], interpolate, output_raster_uri,
-            gdal.GDT_Float32, nodata_output, pixel_size_out, 'intersection',
-            dataset_to_align_index=1, vectorize_op=False)
+        #The input is aligned to the LULC once, the exact range of its valid
+        #values in the LULC's extent is found in one pass over the aligned
+        #blocks, unless a run has recorded it already, and the normalization
+        #is applied in the next
+        aligned_uri_list = natcap.rios.raster_engine.align_rasters(
+            [input_raster_uri, lulc_uri], pixel_size_out,
+            dataset_to_align_index=1)
+        try:
+            raster_range = _read_normalization_range(
+                range_uri, input_raster_uri, lulc_uri)
+            if raster_range is None:
+                raster_range = _normalization_range(
+                    aligned_uri_list[0], nodata_input)
+                _write_normalization_range(
+                    range_uri, input_raster_uri, lulc_uri, raster_range)
+            raster_min, raster_max = raster_range
+            normalize = _make_linear_normalization(
+                nodata_input, nodata_output, raster_min, raster_max,
+                interp_dict['inverted'])
+
+            def interpolate(pixel_value):
+                return [normalize(pixel_value)]
+
+            natcap.rios.raster_engine.aligned_block_op(
+                aligned_uri_list[:1], interpolate,
+                [(output_raster_uri, gdal.GDT_Float32, nodata_output)],
+                n_workers=n_workers)
+        finally:
+            for aligned_uri in aligned_uri_list:
+                if os.path.exists(aligned_uri):
+                    os.remove(aligned_uri)
     else:
         raise Exception("unknown interp_type %s" % interp_type)
 
 
-def _normalize_rasters(args):
+def _normalization_range_uri(factor_uri):
+    """returns the uri of the json file of the range of a factor cached at
+        factor_uri, which shares its `stage_scheduler.FileCache`
+        fingerprint so it's evicted with it"""
+
+    return os.path.splitext(factor_uri)[0] + '_range.json'
+
+
+def _read_normalization_range(range_uri, raster_uri, lulc_uri):
+    """Reads a range recorded by `_write_normalization_range`.
+
+        returns the (min, max) recorded for raster_uri aligned to lulc_uri,
+            None if range_uri is None or has no such range"""
+
+    if range_uri is None or not os.path.exists(range_uri):
+        return None
+    with open(range_uri, 'r') as range_file:
+        range_dict = json.load(range_file)
+    if (range_dict['raster_uri'] != raster_uri or
+            range_dict['lulc_uri'] != lulc_uri):
+        return None
+    return range_dict['min'], range_dict['max']
+
+
+def _write_normalization_range(range_uri, raster_uri, lulc_uri, raster_range):
+    """Records the normalization range of raster_uri aligned to lulc_uri in
+        the json file range_uri, does nothing if range_uri is None.
+
+        returns nothing"""
+
+    if range_uri is None:
+        return
+    with open(range_uri, 'w') as range_file:
+        json.dump({
+            'raster_uri': raster_uri,
+            'lulc_uri': lulc_uri,
+            'min': raster_range[0],
+            'max': raster_range[1],
+            }, range_file, indent=4)
+
+
+def _normalization_range(aligned_uri, nodata_input):
+    """Finds the range a linear normalization maps to [0, 1].
+
+        aligned_uri - a uri to the raster to normalize, aligned to the LULC
+        nodata_input - the raster's nodata value
+
+        returns the exact (min, max) of the raster's pixels that aren't nodata
+            or NaN, (0, 0) if there aren't any"""
+
+    raster_min, raster_max = natcap.rios.raster_engine.valid_value_range(
+        aligned_uri, nodata_input)
+    if raster_min is None:
+        LOGGER.warn('%s has no valid values', aligned_uri)
+        return 0.0, 0.0
+    return raster_min, raster_max
+
+
+def _make_linear_normalization(
+        nodata_input, nodata_output, raster_min, raster_max, inverted):
+    """Makes the function that linearly maps a raster's values from
+        [raster_min, raster_max] to [0, 1], or [1, 0] if inverted.
+
+        returns a function of an array of the input raster"""
+
+    domain = float(raster_max - raster_min)
+    #If the domain is 0 that means the numerator of the fraction will
+    #always be zero, so just set the denominator to 1.
+    if domain == 0:
+        domain = 1.0
+
+    if inverted:
+        def interpolate(pixel_value):
+            invalid_mask = (pixel_value == nodata_input) | numpy.isnan(pixel_value)
+            value = (1.0 - ((pixel_value - raster_min) / domain))
+            return numpy.where(invalid_mask, nodata_output, value)
+            #if pixel_value == nodata_input or math.isnan(pixel_value):
+            #    return nodata_output
+            #return (1.0 - ((pixel_value - raster_min) / domain))
+    else:
+        def interpolate(pixel_value):
+            invalid_mask = (pixel_value == nodata_input) | numpy.isnan(pixel_value)
+            value = (pixel_value - raster_min) / domain
+            return numpy.where(invalid_mask, nodata_output, value)
+            #if pixel_value == nodata_input or math.isnan(pixel_value):
+            #    return nodata_output
+            #return (pixel_value - raster_min) / domain
+    return interpolate
+
+
+def _normalize_rasters(args, scheduler=None):
     """Open files needed for sorting input rasters into bins.  Calls rios_core
         to execute the actual sorting.
 
@@ -1180,38 +2750,144 @@ def _normalize_rasters(args):
              ...}
          args['lulc_uri'] - path to the IPA general LULC raster
             for mapping.
-            returns nothing.
+         args['factor_cache'] - (optional) a `stage_scheduler.FileCache` to
+            write the normalized rasters to instead of args['output_dir'],
+            factors already in it aren't normalized again.
+         args['normalized_uris'] - (optional) a dictionary of
+            `_factor_normalization_key` to normalized raster uri shared by
+            the `_normalize_rasters` calls of a run.  Factors already in it
+            aren't normalized again and the others are added to it.
+         args['table_factors'] - (optional) a list shared by the
+            `_normalize_rasters` calls of a run to add the (args, factor_name,
+            factor) of the table factors to, for the caller to reclassify
+            all at once with `_add_table_factor_tasks` before it adds the
+            tasks that read them.  If it's not there the table factors of
+            args['factors'] are reclassified in one pass per raster.
+         scheduler - (optional) a `stage_scheduler.StageScheduler` to add the
+            factors to instead of normalizing them now
+
+         returns a dictionary of factor name to the uri of its normalized
+            raster.
             """
-    pygeoprocessing.geoprocessing.create_directories([args['output_dir']])
-
+    if args.get('factor_cache') is None:
+        pygeoprocessing.geoprocessing.create_directories([args['output_dir']])
+
+    run_now = scheduler is None
+    if run_now:
+        scheduler = natcap.rios.stage_scheduler.StageScheduler()
+    normalized_uris = args.get('normalized_uris', {})
+    table_factors = args.get('table_factors', [])
+    factor_uris = {}
     for factor_name, factor in args['factors'].iteritems():
-        #open input raster, add to args dictionary, this is some hardcoded
-        #stuff to handle rasters that need to be generated from converting
-        #LULCs into lookup tables.  Those will have a
-        #factor['bins']['raster_uri'] defined, but those that don't default
-        #to factor['raster_uri']
-        try:
-            raster_uri = os.path.join(
-                args['output_dir'], factor['bins']['raster_uri'])
-            #This is a hack patch from how we used to hard record
-            #the general lulc in the UI, but now have a flexible
-            #directory registry.  With 3 days left, not a priority
-            #to rewrite this part, so sorry future engineer.
-            LOGGER.debug('it was defined, must need a LULC')
-            raster_uri = args['lulc_uri']
-        except KeyError:
-            raster_uri = factor['raster_uri']
-
-        factor['input_uri'] = str(raster_uri)
-        #for each input raster, create output raster, add to args
-        factor_uri = os.path.join(
-            args['output_dir'], factor_name + '%s.tif' % args['results_suffix'])
-
-        #This is a magic standard nodata value
-        output_nodata = -9999
-        factor['output_uri'] = factor_uri
-        factor['output_nodata'] = output_nodata
+        normalization_key = _factor_normalization_key(args['lulc_uri'], factor)
+        if normalization_key in normalized_uris:
+            LOGGER.debug('%s is already normalized', factor_name)
+            factor_uris[factor_name] = normalized_uris[normalization_key]
+            continue
+        factor_uris[factor_name] = _normalized_factor_uri(args, factor_name)
+        normalized_uris[normalization_key] = factor_uris[factor_name]
+        if 'type' not in factor['bins'] and 'key_field' in factor['bins']:
+            table_factors.append((args, factor_name, factor))
+            continue
+        scheduler.add_task(
+            _normalize_factor, args=(args, factor_name, factor),
+            reads=_factor_input_uris(args['lulc_uri'], factor),
+            cache_key={
+                'raster_uri': factor.get('raster_uri'),
+                'bins': factor['bins']},
+            writes=[factor_uris[factor_name]],
+            memory=_stage_memory(args, 3),
+            name='normalize %s' % factor_name)
+    if 'table_factors' not in args:
+        _add_table_factor_tasks(
+            table_factors, scheduler, n_workers=args.get('n_workers'))
+    if run_now:
+        scheduler.run()
+    return factor_uris
+
+
+def _normalized_factor_uri(args, factor_name):
+    """returns the uri of a factor normalized by `_normalize_rasters`"""
+
+    if args.get('factor_cache') is not None:
+        return _factor_cache_uri(
+            args['factor_cache'], args['lulc_uri'],
+            args['factors'][factor_name])
+    return os.path.join(
+        args['output_dir'], factor_name + '%s.tif' % args['results_suffix'])
+
+
+def _factor_cache_uri(factor_cache, lulc_uri, factor):
+    """returns the uri of factor normalized to lulc_uri in factor_cache, a
+        `stage_scheduler.FileCache`"""
+
+    return factor_cache.cache_uri(
+        _factor_input_uris(lulc_uri, factor),
+        {'raster_uri': factor.get('raster_uri'), 'bins': factor['bins'],
+         'version': _STAGE_CACHE_VERSION})
+
+
+def _factor_input_uris(lulc_uri, factor):
+    """returns the uris of the files `_normalize_factor` reads to normalize
+        factor"""
+
+    input_uris = [
+        lulc_uri,
+        factor['bins'].get('raster_uri', factor.get('raster_uri')),
+        factor['bins'].get('uri')]
+    return sorted(set(uri for uri in input_uris if uri))
+
+
+def _factor_normalization_key(lulc_uri, factor):
+    """returns a string that is the same for the factors of any objective
+        that normalize to the same raster"""
+
+    return json.dumps(
+        [_factor_input_uris(lulc_uri, factor), factor['bins']],
+        sort_keys=True)
+
+
+def _normalize_factor(args, factor_name, factor):
+    """Normalizes one factor of `_normalize_rasters`"""
+
+    #open input raster, add to args dictionary, this is some hardcoded
+    #stuff to handle rasters that need to be generated from converting
+    #LULCs into lookup tables.  Those will have a
+    #factor['bins']['raster_uri'] defined, but those that don't default
+    #to factor['raster_uri']
+    try:
+        raster_uri = os.path.join(
+            args['output_dir'], factor['bins']['raster_uri'])
+        #This is a hack patch from how we used to hard record
+        #the general lulc in the UI, but now have a flexible
+        #directory registry.  With 3 days left, not a priority
+        #to rewrite this part, so sorry future engineer.
+        LOGGER.debug('it was defined, must need a LULC')
+        raster_uri = args['lulc_uri']
+    except KeyError:
+        raster_uri = factor['raster_uri']
+
+    factor['input_uri'] = str(raster_uri)
+    #for each input raster, create output raster, add to args
+    factor_uri = _normalized_factor_uri(args, factor_name)
+    if args.get('factor_cache') is not None:
+        if os.path.exists(factor_uri):
+            LOGGER.info('using the cached %s normalization', factor_name)
+            return
+        #normalize next to the cache file and move it in once it's complete
+        cache_uri = factor_uri
+        factor_uri = cache_uri + '.partial'
+        range_uri = _normalization_range_uri(cache_uri)
+    else:
+        #without a cache the normalized factors are removed after the run
+        range_uri = None
+
+    #This is a magic standard nodata value
+    output_nodata = -9999
+    factor['output_uri'] = factor_uri
+    factor['output_nodata'] = output_nodata
 
+    try:
         if 'type' in factor['bins']:
             LOGGER.info(
                 "We're doing normalization because of %s",
@@ -1220,17 +2896,29 @@ def _normalize_rasters(args):
                 raster_uri, args['lulc_uri'], factor['output_uri'],
                 factor['output_nodata'], factor['bins'],
                 pygeoprocessing.geoprocessing.get_cell_size_from_uri(
-                    args['lulc_uri']))
+                    args['lulc_uri']), n_workers=args.get('n_workers'),
+                range_uri=range_uri)
 
         elif 'key_field' in factor['bins']:
             _map_raster_to_table(
-                factor['input_uri'], factor['output_uri'], -1.0, factor['bins'])
+                factor['input_uri'], factor['output_uri'], -1.0,
+                factor['bins'])
         else:
             raise Exception("Unknown normalization routine")
+    except:
+        #a partial file left in the factor cache would count against its
+        #size limit for good
+        if args.get('factor_cache') is not None and os.path.exists(
+                factor_uri):
+            os.remove(factor_uri)
+        raise
 
+    if args.get('factor_cache') is not None:
+        os.rename(factor_uri, cache_uri)
+        factor['output_uri'] = cache_uri
 
 
-def _create_objective_transition_scores(args):
+def _create_objective_transition_scores(args, scheduler=None):
     """Creates transition scores for each transition on a particular
         objective..
 
@@ -1244,107 +2932,220 @@ def _create_objective_transition_scores(args):
         args['priorities'] - a dictionary of the form
             {'transition type: {'Objective Weight' weight, ...},
              ...: ..., ...}
+        args['factor_uris'] - (optional) a dictionary of factor name to the
+            uri of its normalized raster for the factors that aren't in
+            args['input_dir']
+        scheduler - (optional) a `stage_scheduler.StageScheduler` to add the
+            transitions to instead of creating them now
 
         returns nothing"""
 
     pygeoprocessing.geoprocessing.create_directories([args['output_dir']])
+    run_now = scheduler is None
+    if run_now:
+        scheduler = natcap.rios.stage_scheduler.StageScheduler()
     for transition_name, factors in args['priorities'].iteritems():
         transition_uri = os.path.join(args['output_dir'], transition_name + '%s.tif' % args['results_suffix'])
-        LOGGER.info('Creating %s transition raster', transition_uri)
-
-        raster_list = []
-        weights = []
-        raster_nodata = []
-
-        for factor_name, factor_weight in factors.iteritems():
-            raster_list.append(os.path.join(args['input_dir'], factor_name + '%s.tif' % args['results_suffix']))
-            raster_nodata.append(pygeoprocessing.geoprocessing.get_nodata_from_uri(raster_list[-1]))
-            try:
-                weights.append(
-                    (float(factor_weight), False,
-                     factor_name=='Riparian continuity',
-                     factor_name=='On-pixel retention'))
-            except ValueError:
-                #The factor_weight must have a ~ in front
-                weights.append(
-                    (float(str(factor_weight)[1:]), True,
-                     factor_name=='Riparian continuity',
-                     factor_name=='On-pixel retention'))
-
-        _create_objective_transition_score(
-            raster_nodata, weights, raster_list, transition_uri,
-            args['cell_size'])
-
+        factor_uris = args.get('factor_uris', {})
+        raster_list = [
+            factor_uris.get(factor_name, os.path.join(args['input_dir'], factor_name + '%s.tif' % args['results_suffix']))
+            for factor_name in factors]
+        scheduler.add_task(
+            _create_objective_transition,
+            args=(transition_uri, raster_list, factors, args['cell_size']),
+            kwargs={'n_workers': args.get('n_workers')},
+            reads=raster_list, writes=[transition_uri],
+            cache_key={'factors': factors, 'cell_size': args['cell_size']},
+            memory=_stage_memory(args, len(raster_list) + 1),
+            name='objective transition %s' % transition_uri)
+    if run_now:
+        scheduler.run()
+
+
+def _create_objective_transition(
+        transition_uri, raster_list, factors, cell_size, n_workers=None):
+    """Creates one transition of `_create_objective_transition_scores` from
+        the normalized factor rasters in raster_list, which are in `factors`
+        order"""
+
+    LOGGER.info('Creating %s transition raster', transition_uri)
+
+    raster_nodata = []
+    weights = []
+    for raster_uri, (factor_name, factor_weight) in zip(
+            raster_list, factors.iteritems()):
+        raster_nodata.append(pygeoprocessing.geoprocessing.get_nodata_from_uri(raster_uri))
+        weights.append(_priority_weight(factor_name, factor_weight))
+
+    _create_objective_transition_score(
+        raster_nodata, weights, raster_list, transition_uri, cell_size,
+        n_workers=n_workers)
+
+
+
+def _priority_weight(factor_name, factor_weight):
+    """Parses a factor's weight in an objective's priorities.
+
+        returns a (weight, invert, is_riparian, is_onpixel) tuple"""
+
+    try:
+        return (
+            float(factor_weight), False,
+            factor_name=='Riparian continuity',
+            factor_name=='On-pixel retention')
+    except ValueError:
+        #The factor_weight must have a ~ in front
+        return (
+            float(str(factor_weight)[1:]), True,
+            factor_name=='Riparian continuity',
+            factor_name=='On-pixel retention')
 
 
 def _create_objective_transition_score(
-    raster_nodata, weights, raster_list, transition_uri, cell_size):
+    raster_nodata, weights, raster_list, transition_uri, cell_size,
+    n_workers=None):
     """creates objective transition socres"""
 
     out_nodata = -1.0
-    def calculate_priority(*pixels):
-        """Loop through all values in *pixels and calculate a normalized
-            weight value.
-
-            pixels - a python array of numeric values.
-
-            returns a python float between 0.0 and 1.0"""
-        pixel_sum = numpy.zeros(pixels[0].shape)
-        user_factor_sum = numpy.zeros(pixels[0].shape)
+    calculate_priority = _make_priority_op(raster_nodata, weights, out_nodata)
 
-        onpixel_value = numpy.empty(pixels[0].shape)
-        onpixel_value[:] = -1.0
-
-        nodata_mask = numpy.zeros(pixels[0].shape, dtype=numpy.bool)
-        riparian_nodata_mask = numpy.zeros(pixels[0].shape, dtype=numpy.bool)
-
-        for index in range(len(pixels)):
-            pixel_value_copy = pixels[index].copy()
-            #weight is a float Invert is a boolean
-            weight, invert, is_riparian, is_onpixel = weights[index]
-
-            raster_nodata_mask = (pixel_value_copy == raster_nodata[index])
+    natcap.rios.raster_engine.vectorize_datasets(
+        raster_list, calculate_priority, transition_uri, gdal.GDT_Float32,
+        out_nodata, cell_size, "intersection", n_workers=n_workers)
+
+
+def _make_priority_op(raster_nodata, weights, out_nodata):
+    """Makes the function that combines an objective's normalized factors
+        into a transition score.
+
+        raster_nodata - the nodata value of each factor
+        weights - the `_priority_weight` tuple of each factor, there's at
+            most one riparian and one on-pixel factor since they're named
+            factors
+        out_nodata - the nodata value of the result
+
+        returns a function of one array per factor"""
+
+    riparian_index = None
+    onpixel_index = None
+    for index, (_, _, is_riparian, is_onpixel) in enumerate(weights):
+        if is_riparian:
+            riparian_index = index
+        if is_onpixel:
+            onpixel_index = index
+
+    #Every factor but the riparian one is valid where the result isn't
+    #nodata, so the sum of the weights is one of two values, added up in
+    #factor order like the pixel sums
+    user_factor_sum = 0.0
+    riparian_nodata_factor_sum = 0.0
+    for index, (weight, _, _, _) in enumerate(weights):
+        user_factor_sum += weight
+        if index != riparian_index:
+            riparian_nodata_factor_sum += weight
+    if user_factor_sum == 0.0:
+        user_factor_sum = 1.0
+    if riparian_nodata_factor_sum == 0.0:
+        riparian_nodata_factor_sum = 1.0
+
+    #the work buffers of each thread, reused while the block size is the same
+    thread_buffers = threading.local()
 
-            if is_riparian:
-                riparian_nodata_mask = raster_nodata_mask
+    def calculate_priority(*pixels):
+        """Calculates the weighted average of the normalized factors of a
+            block.  A riparian factor that is nodata is left out of the
+            average and the on-pixel factor accounts for half of its weight;
+            pixels where any other factor is nodata are nodata.  The sums are
+            added up in the same order and types as the per pixel
+            calculation this replaced so the results are identical.
+
+            pixels - one array per factor in `weights` order.
+
+            returns an array of values between 0.0 and 1.0"""
+
+        shape = pixels[0].shape
+        buffers = getattr(thread_buffers, 'buffers', None)
+        if buffers is None or buffers['shape'] != shape:
+            buffers = {
+                'shape': shape,
+                'pixel_sum': numpy.empty(shape),
+                'onpixel_value': numpy.empty(shape),
+                'nodata_mask': numpy.empty(shape, dtype=bool),
+                'riparian_nodata_mask': numpy.empty(shape, dtype=bool),
+                'factor_nodata_mask': numpy.empty(shape, dtype=bool),
+                'values': {},
+                }
+            thread_buffers.buffers = buffers
+        pixel_sum = buffers['pixel_sum']
+        onpixel_value = buffers['onpixel_value']
+        nodata_mask = buffers['nodata_mask']
+        riparian_nodata_mask = buffers['riparian_nodata_mask']
+        factor_nodata_mask = buffers['factor_nodata_mask']
+
+        pixel_sum.fill(0.0)
+        nodata_mask.fill(False)
+        for index, (pixel_value, nodata, (weight, invert, _, _)) in (
+                enumerate(zip(pixels, raster_nodata, weights))):
+            if index == riparian_index:
+                factor_mask = riparian_nodata_mask
             else:
-                nodata_mask = raster_nodata_mask | nodata_mask
-
-            user_factor_sum += numpy.where(raster_nodata_mask, 0, weight)
+                factor_mask = factor_nodata_mask
+            if nodata is None:
+                factor_mask.fill(False)
+            else:
+                numpy.equal(pixel_value, nodata, out=factor_mask)
+            if index != riparian_index:
+                nodata_mask |= factor_mask
+
+            #the weighted value is calculated in the factor's type, a
+            #float32 factor is multiplied by its weight in float32
+            value_type = numpy.result_type(pixel_value, weight)
+            if value_type not in buffers['values']:
+                buffers['values'][value_type] = numpy.empty(
+                    shape, dtype=value_type)
+            value = buffers['values'][value_type]
 
             #Check to see if we need to do the weight*(1-pix) thing
             if invert:
-                pixel_value_copy = numpy.where(
-                    raster_nodata_mask, raster_nodata[index],
-                    1-pixel_value_copy)
+                numpy.subtract(1, pixel_value, out=value)
+                pixel_value = value
 
             #we should only ever have one on-pixel value
-            if is_onpixel:
-                onpixel_value = numpy.where(
-                    raster_nodata_mask, -1.0, pixel_value_copy)
-
-            pixel_sum += numpy.where(
-                raster_nodata_mask, 0, weight * pixel_value_copy)
-
-        user_factor_sum = numpy.where(
-            user_factor_sum == 0.0, 1.0, user_factor_sum)
-
-        #If riparian was nodata and onpixel was defined let
-        #onpixel account for the ENTIRE weight of riparian and onpixel
-        #super hacky, but at Adrian's request.
-        pixel_sum += numpy.where(
-            ~nodata_mask & riparian_nodata_mask & (onpixel_value != -1.0),
-            onpixel_value*0.5, 0)
-        user_factor_sum += numpy.where(
-            ~nodata_mask & riparian_nodata_mask & (onpixel_value != -1.0), 0.5,
-            0)
-
-        result = (pixel_sum / user_factor_sum)
-        return numpy.where(nodata_mask, out_nodata, result)
-
-    pygeoprocessing.geoprocessing.vectorize_datasets(
-        raster_list, calculate_priority, transition_uri, gdal.GDT_Float32,
-        out_nodata, cell_size, "intersection", vectorize_op=False)
+            if index == onpixel_index:
+                onpixel_value[:] = pixel_value
+
+            numpy.multiply(pixel_value, weight, out=value)
+            if index == riparian_index:
+                numpy.logical_not(riparian_nodata_mask, out=factor_nodata_mask)
+                numpy.add(
+                    pixel_sum, value, out=pixel_sum, where=factor_nodata_mask)
+            else:
+                #pixels where this factor is nodata end up nodata anyway
+                pixel_sum += value
+
+        if riparian_index is None:
+            result = pixel_sum / user_factor_sum
+        else:
+            factor_sum = numpy.where(
+                riparian_nodata_mask, riparian_nodata_factor_sum,
+                user_factor_sum)
+            #If riparian was nodata and onpixel was defined let
+            #onpixel account for the ENTIRE weight of riparian and onpixel
+            #super hacky, but at Adrian's request.
+            if onpixel_index is not None:
+                numpy.not_equal(onpixel_value, -1.0, out=factor_nodata_mask)
+                factor_nodata_mask &= riparian_nodata_mask
+                onpixel_value *= 0.5
+                numpy.add(
+                    pixel_sum, onpixel_value, out=pixel_sum,
+                    where=factor_nodata_mask)
+                numpy.add(
+                    factor_sum, 0.5, out=factor_sum, where=factor_nodata_mask)
+            result = numpy.divide(pixel_sum, factor_sum, out=factor_sum)
+        result[nodata_mask] = out_nodata
+        return result
+
+    return calculate_priority
 
 
 def _map_raster_to_table(
@@ -1360,16 +3161,210 @@ def _map_raster_to_table(
 
         returns the mapped raster."""
 
+    input_to_output_map = _table_value_map(bins, out_nodata)
+    output_raster_datatype = gdal.GDT_Float32
+    pygeoprocessing.geoprocessing.reclassify_dataset_uri(
+        bins['raster_uri'], input_to_output_map, raster_out_uri=output_raster_uri,
+        out_datatype = output_raster_datatype, out_nodata=out_nodata,
+        exception_flag='values_required')
+
+    LOGGER.debug('Finished normalizing into dictionary bins')
+
+
+def _add_table_factor_tasks(table_factors, scheduler, n_workers=None):
+    """Adds a task to the scheduler for each raster the table factors of
+        `_normalize_rasters` reclassify, which maps it through all of their
+        tables in one pass.
+
+        table_factors - a list of the (args, factor_name, factor) of the
+            table factors of one or more `_normalize_rasters` calls
+        scheduler - a `stage_scheduler.StageScheduler`
+        n_workers - (optional) the number of threads to calculate blocks with
+
+        returns nothing"""
+
+    factors_by_raster = {}
+    for table_factor in table_factors:
+        factors_by_raster.setdefault(
+            table_factor[2]['bins']['raster_uri'], []).append(table_factor)
+
+    for raster_uri, raster_factors in sorted(factors_by_raster.iteritems()):
+        reads = set()
+        for args, _, factor in raster_factors:
+            reads.update(_factor_input_uris(args['lulc_uri'], factor))
+        scheduler.add_task(
+            _map_raster_to_tables, args=(raster_uri, raster_factors),
+            kwargs={'n_workers': n_workers},
+            reads=reads,
+            cache_key=[
+                {'raster_uri': factor.get('raster_uri'),
+                 'bins': factor['bins']}
+                for _, _, factor in raster_factors],
+            writes=[
+                _normalized_factor_uri(args, factor_name)
+                for args, factor_name, _ in raster_factors],
+            memory=_stage_memory(
+                {'n_workers': n_workers}, len(raster_factors) + 1),
+            name='reclassify %s' % raster_uri)
+
+
+def _map_raster_to_tables(raster_uri, table_factors, n_workers=None):
+    """Reclassifies a raster through the tables of several table factors in
+        one pass over it.  Each table is read once and the lucodes of a block
+        are looked up once for all the factors, see
+        `_make_multi_reclassify_op`.
+
+        raster_uri - the bins['raster_uri'] of the factors.
+        table_factors - a list of the (args, factor_name, factor) of table
+            factors of `_normalize_rasters`, factors that are already in
+            args['factor_cache'] are skipped.
+        n_workers - (optional) the number of threads to calculate blocks with
+
+        returns nothing"""
+
+    out_nodata = -1.0
+    table_lookups = {}
+    value_maps = []
+    output_list = []
+    #(partial uri, cache uri) of the outputs that go in a factor cache
+    cache_moves = []
+    for args, factor_name, factor in table_factors:
+        factor_uri = _normalized_factor_uri(args, factor_name)
+        if args.get('factor_cache') is not None:
+            if os.path.exists(factor_uri):
+                LOGGER.info('using the cached %s normalization', factor_name)
+                continue
+            cache_moves.append((factor_uri + '.partial', factor_uri))
+            factor_uri = cache_moves[-1][0]
+        table_uri = factor['bins']['uri']
+        if table_uri not in table_lookups:
+            table_lookups[table_uri] = (
+                pygeoprocessing.geoprocessing.get_lookup_from_table(
+                    table_uri, 'lucode'))
+        value_maps.append(_table_value_map(
+            factor['bins'], out_nodata,
+            mapped_values=table_lookups[table_uri]))
+        output_list.append((factor_uri, gdal.GDT_Float32, out_nodata))
+
+    if len(output_list) == 0:
+        return
+    LOGGER.info(
+        'reclassifying %s into %d factors', raster_uri, len(output_list))
+    reclassify = _make_multi_reclassify_op(value_maps)
+    #a single raster is aligned with itself, like reclassify_dataset_uri's
+    #datasets_are_pre_aligned
+    try:
+        natcap.rios.raster_engine.aligned_block_op(
+            [raster_uri], reclassify, output_list, n_workers=n_workers)
+    except:
+        #a partial file left in the factor cache would count against its
+        #size limit for good
+        for partial_uri, _ in cache_moves:
+            if os.path.exists(partial_uri):
+                os.remove(partial_uri)
+        raise
+    for partial_uri, cache_uri in cache_moves:
+        os.rename(partial_uri, cache_uri)
+
+
+def _make_reclassify_op(value_map):
+    """Makes the function that maps raster values through `value_map`, it
+        raises a ValueError on values that aren't in `value_map` the same way
+        reclassify_dataset_uri does with exception_flag='values_required'.
+
+        returns a function of an array of raster values"""
+
+    reclassify_all = _make_multi_reclassify_op([value_map])
+
+    def reclassify(pixel_value):
+        return reclassify_all(pixel_value)[0]
+    return reclassify
+
+
+#the largest key range that is looked up in a dense array indexed by key
+_DENSE_LOOKUP_SIZE = 2**16
+
+
+def _make_multi_reclassify_op(value_maps):
+    """Makes the function that maps raster values through several value maps
+        at once, each raises a ValueError on values that aren't in it like
+        `_make_reclassify_op`.  The keys of all the maps are looked up once
+        per block, in a dense array indexed by key if they're integers in a
+        small enough range or by a binary search of the sorted keys if not.
+
+        value_maps - a list of dictionaries of raster value to output value
+
+        returns a function of an array of raster values that returns a list
+            of arrays parallel to value_maps"""
+
+    sorted_keys = sorted(set(
+        float(key) for value_map in value_maps for key in value_map))
+    key_min = sorted_keys[0]
+    key_max = sorted_keys[-1]
+    dense = (
+        all(key.is_integer() for key in sorted_keys) and
+        key_max - key_min < _DENSE_LOOKUP_SIZE)
+    if dense:
+        key_index = dict(
+            (key, int(key - key_min)) for key in sorted_keys)
+        table_size = int(key_max - key_min) + 1
+    else:
+        key_index = dict(
+            (key, index) for index, key in enumerate(sorted_keys))
+        table_size = len(sorted_keys)
+        keys = numpy.array(sorted_keys)
+
+    #one row per value map, present marks the keys that are in it
+    values = numpy.zeros((len(value_maps), table_size), dtype=numpy.float32)
+    present = numpy.zeros((len(value_maps), table_size), dtype=bool)
+    for map_index, value_map in enumerate(value_maps):
+        for key, value in value_map.iteritems():
+            values[map_index, key_index[float(key)]] = value
+            present[map_index, key_index[float(key)]] = True
+
+    def reclassify(pixel_value):
+        if dense:
+            in_range = (pixel_value >= key_min) & (pixel_value <= key_max)
+            index = numpy.where(
+                in_range, pixel_value - key_min, 0).astype(numpy.intp)
+            #non integer values fall between the keys
+            found_mask = in_range & (index + key_min == pixel_value)
+        else:
+            index = numpy.minimum(
+                numpy.searchsorted(keys, pixel_value), keys.size - 1)
+            found_mask = keys[index] == pixel_value
+        result_list = []
+        for map_index in xrange(len(value_maps)):
+            valid_mask = found_mask & present[map_index][index]
+            if not valid_mask.all():
+                raise ValueError(
+                    "The following values were in the raster but not in the "
+                    "value map: %s" % numpy.unique(pixel_value[~valid_mask]))
+            result_list.append(values[map_index][index])
+        return result_list
+    return reclassify
+
+
+def _table_value_map(bins, out_nodata, mapped_values=None):
+    """Reads the lucode to value mapping of a table normalized factor.
+
+        bins - the factor's bins dictionary, see `_map_raster_to_table`
+        out_nodata - the value that bins['raster_uri']'s nodata maps to
+        mapped_values - (optional) the lucode lookup of bins['uri'] if it has
+            already been read
+
+        returns a dictionary of raster value to normalized value"""
+
     input_to_output_map = {}
-    mapped_values = pygeoprocessing.geoprocessing.get_lookup_from_table(
-        bins['uri'], 'lucode')
+    if mapped_values is None:
+        mapped_values = pygeoprocessing.geoprocessing.get_lookup_from_table(
+            bins['uri'], 'lucode')
 
     for lucode, properties in mapped_values.iteritems():
         input_to_output_map[lucode] = properties[bins['value_field'].lower()]
 
     LOGGER.debug(input_to_output_map)
 
-    output_raster_datatype = gdal.GDT_Float32
     #add a nodata value
     raster_nodata = pygeoprocessing.get_nodata_from_uri(bins['raster_uri'])
     input_to_output_map[raster_nodata] = out_nodata
@@ -1381,12 +3376,7 @@ def _map_raster_to_table(
             _ = int(key)
         except ValueError:
             del input_to_output_map[key]
-    pygeoprocessing.geoprocessing.reclassify_dataset_uri(
-        bins['raster_uri'], input_to_output_map, raster_out_uri=output_raster_uri,
-        out_datatype = output_raster_datatype, out_nodata=out_nodata,
-        exception_flag='values_required')
-
-    LOGGER.debug('Finished normalizing into dictionary bins')
+    return input_to_output_map
 
 
 def _generate_report(report_dir, report_data):
@@ -0,0 +1,405 @@
+"""RIOS's stage scheduler: runs raster stages concurrently in the order
+implied by the files they read and write."""
+
+import os
+import sys
+import json
+import hashlib
+import logging
+import threading
+import Queue
+
+LOGGER = logging.getLogger('natcap.rios.stage_scheduler')
+
+
+class StageCache(object):
+    """The fingerprints of the files written by cached tasks, kept under the
+        'stage_fingerprints' key of a json file such as the IPA's directory
+        file registry.  Each fingerprint is kept with the modified time and
+        size of the file it was written to, so a file something else has
+        written since isn't trusted."""
+
+    def __init__(self, json_uri, version=None):
+        """Parameters:
+            json_uri - the uri of the json file to keep the fingerprints in,
+                other keys in the file are left as they are
+            version - (optional) a json serializable version of the code
+                that writes the files, part of every fingerprint so files
+                written by other versions are never reused"""
+
+        self.json_uri = json_uri
+        self.version = version
+        self.fingerprints = {}
+        if os.path.exists(json_uri):
+            with open(json_uri, 'r') as json_file:
+                self.fingerprints = json.load(json_file).get(
+                    'stage_fingerprints', {})
+
+    def get(self, uri):
+        """Returns the fingerprint `uri` was written with, None if unknown or
+            if the file has changed since"""
+        entry = self.fingerprints.get(os.path.abspath(uri))
+        if not isinstance(entry, list) or len(entry) != 2:
+            return None
+        fingerprint, file_signature = entry
+        if os.path.exists(uri) and _file_signature(uri) != file_signature:
+            return None
+        return fingerprint
+
+    def set(self, uri, fingerprint):
+        """Records the fingerprint `uri` was just written with, None to
+            forget it"""
+        if fingerprint is None:
+            self.fingerprints.pop(os.path.abspath(uri), None)
+        else:
+            self.fingerprints[os.path.abspath(uri)] = [
+                fingerprint, _file_signature(uri)]
+
+    def forget(self, uris):
+        """Forgets the fingerprints of files that are about to be written
+            without the cache and saves the json file"""
+        for uri in uris:
+            self.set(uri, None)
+        self.save()
+
+    def save(self):
+        """Writes the fingerprints to the json file"""
+        json_data = {}
+        if os.path.exists(self.json_uri):
+            with open(self.json_uri, 'r') as json_file:
+                json_data = json.load(json_file)
+        json_data['stage_fingerprints'] = self.fingerprints
+        with open(self.json_uri, 'w') as json_file:
+            json.dump(json_data, json_file, indent=4)
+
+
+class FileCache(object):
+    """A directory of files named after the fingerprint of the inputs and
+        parameters they were made from, so they can be reused across runs.
+        Once the files add up to more than a size limit the least recently
+        used ones are removed.  Files whose names start with the same
+        fingerprint, such as a sidecar file next to a cached file, are kept
+        and removed together."""
+
+    def __init__(self, cache_dir, size_limit=None):
+        """Parameters:
+            cache_dir - the directory to keep the files in, created if it
+                doesn't exist
+            size_limit - (optional) the number of bytes the files can add up
+                to, None for no limit"""
+
+        self.cache_dir = cache_dir
+        self.size_limit = size_limit
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def cache_uri(self, input_uris, parameters, extension='.tif'):
+        """Returns the uri of the file made from `input_uris` and
+            `parameters`, whether or not it's in the cache yet.
+
+        Parameters:
+            input_uris - the uris of the files the cached file is made from,
+                fingerprinted by their absolute path, modified time and size
+            parameters - a json serializable value of the other parameters
+                the cached file depends on
+            extension - the file extension of the cached file"""
+
+        input_signatures = [
+            [os.path.abspath(uri), _file_signature(uri)]
+            for uri in sorted(set(input_uris))]
+        fingerprint = hashlib.sha1(json.dumps(
+            [input_signatures, parameters], sort_keys=True,
+            default=str)).hexdigest()
+        return os.path.join(self.cache_dir, fingerprint + extension)
+
+    def evict(self, in_use_uris=()):
+        """Marks the files in `in_use_uris` as used and removes the least
+            recently used other files until the cache fits in its size
+            limit.  The files of a fingerprint are used and removed
+            together.
+
+        Returns:
+            the list of removed uris"""
+
+        for uri in in_use_uris:
+            if os.path.exists(uri):
+                os.utime(uri, None)
+        if self.size_limit is None:
+            return []
+
+        in_use_fingerprints = set(
+            _cache_fingerprint(uri) for uri in in_use_uris)
+        #fingerprint to [last modified time, total size, uris]
+        cached_entries = {}
+        total_size = 0
+        for filename in os.listdir(self.cache_dir):
+            uri = os.path.abspath(os.path.join(self.cache_dir, filename))
+            if not os.path.isfile(uri):
+                continue
+            file_stat = os.stat(uri)
+            total_size += file_stat.st_size
+            fingerprint = _cache_fingerprint(uri)
+            if fingerprint in in_use_fingerprints:
+                continue
+            entry = cached_entries.setdefault(fingerprint, [0, 0, []])
+            entry[0] = max(entry[0], file_stat.st_mtime)
+            entry[1] += file_stat.st_size
+            entry[2].append(uri)
+
+        removed_uris = []
+        for _, entry_size, uris in sorted(cached_entries.values()):
+            if total_size <= self.size_limit:
+                break
+            for uri in sorted(uris):
+                LOGGER.debug('evicting %s from the file cache', uri)
+                os.remove(uri)
+                removed_uris.append(uri)
+            total_size -= entry_size
+        if total_size > self.size_limit:
+            LOGGER.warn(
+                'the files in use in %s are over the %d byte cache limit',
+                self.cache_dir, self.size_limit)
+        return removed_uris
+
+
+def _cache_fingerprint(uri):
+    """Returns the fingerprint a `FileCache` file name starts with"""
+    return os.path.basename(uri).split('.')[0].split('_')[0]
+
+
+def _file_signature(uri):
+    """Returns [modified time, size] of the file at uri, None if missing"""
+    try:
+        file_stat = os.stat(uri)
+    except OSError:
+        return None
+    return [file_stat.st_mtime, file_stat.st_size]
+
+
+class StageScheduler(object):
+    """Runs tasks that read and write files on a pool of worker threads.  A
+        task only starts once every task added before it that writes a file
+        it reads, or reads or writes a file it writes, has finished; other
+        tasks run concurrently.  With one worker the tasks run in the order
+        they were added in the calling thread.
+
+        With a `StageCache`, a task added with a cache_key is skipped when its
+        outputs were written from the same cache_key and inputs and haven't
+        changed since, unless a task that runs needs an output that has since
+        been removed.  The inputs of a task are fingerprinted by the task
+        that writes them or, for files no task writes, by their modified time
+        and size."""
+
+    def __init__(
+            self, n_workers=None, memory_limit=None, stage_cache=None,
+            skip_up_to_date=True):
+        """Parameters:
+            n_workers - the number of tasks to run at once, None or 1
+                (default) runs them one at a time in the calling thread
+            memory_limit - (optional) the number of bytes the memory
+                estimates of the running tasks can add up to.  A task whose
+                estimate is over the limit on its own runs by itself.
+            stage_cache - (optional) a `StageCache` to skip tasks whose
+                outputs are up to date
+            skip_up_to_date - (optional) if False no task is skipped or
+                fingerprinted and the stage_cache only forgets the outputs
+                of every task before it runs, for runs that don't use the
+                cache but write files it may know"""
+
+        self.n_workers = n_workers
+        self.memory_limit = memory_limit
+        self.stage_cache = stage_cache
+        self.skip_up_to_date = skip_up_to_date
+        self._tasks = []
+
+    def add_task(
+            self, func, args=(), kwargs=None, reads=(), writes=(), memory=0,
+            name=None, cache_key=None):
+        """Adds a task that calls `func(*args, **kwargs)`.
+
+        Parameters:
+            reads - the uris of the files the task reads
+            writes - the uris of the files the task writes or removes
+            memory - an estimate of the task's peak memory in bytes
+            name - (optional) a name for the task in the log
+            cache_key - (optional) a json serializable value of all the
+                parameters the task's outputs depend on other than the files
+                in `reads`.  Tasks without one are never skipped.
+
+        Returns:
+            the task id, its index in the list `run` returns"""
+
+        reads = set(reads)
+        writes = set(writes)
+        dependencies = set(
+            task['id'] for task in self._tasks
+            if task['writes'] & (reads | writes) or task['reads'] & writes)
+        task = {
+            'id': len(self._tasks),
+            'func': func,
+            'args': args,
+            'kwargs': kwargs if kwargs is not None else {},
+            'reads': reads,
+            'writes': writes,
+            'memory': memory,
+            'name': name if name is not None else func.__name__,
+            'dependencies': dependencies,
+            'cache_key': cache_key,
+            }
+        self._tasks.append(task)
+        return task['id']
+
+    def run(self):
+        """Runs all the added tasks, re-raising the first exception a task
+            raises once the running tasks have finished.  No new tasks are
+            started after a task fails.
+
+        Returns:
+            a list of the tasks' return values indexed by task id"""
+
+        tasks = self._tasks
+        self._tasks = []
+        results = [None] * len(tasks)
+        fingerprints = self._fingerprint_tasks(tasks)
+        up_to_date = self._up_to_date_tasks(tasks, fingerprints)
+        for task_id in sorted(up_to_date):
+            LOGGER.info('%s is up to date', tasks[task_id]['name'])
+
+        def _start_task(task):
+            """Forgets the fingerprints of the outputs `task` overwrites"""
+            if fingerprints[task['id']] is not None or (
+                    self.stage_cache is not None and
+                    not self.skip_up_to_date):
+                self.stage_cache.forget(task['writes'])
+
+        def _finish_task(task):
+            """Records the fingerprints of the outputs `task` wrote"""
+            if fingerprints[task['id']] is not None:
+                for uri in task['writes']:
+                    self.stage_cache.set(uri, fingerprints[task['id']])
+                self.stage_cache.save()
+
+        if self.n_workers is None or self.n_workers <= 1:
+            for task in tasks:
+                if task['id'] in up_to_date:
+                    continue
+                LOGGER.debug('running %s', task['name'])
+                _start_task(task)
+                results[task['id']] = task['func'](
+                    *task['args'], **task['kwargs'])
+                _finish_task(task)
+            return results
+
+        done_queue = Queue.Queue()
+
+        def _run_task(task):
+            """Runs `task` and reports it to done_queue"""
+            try:
+                result = task['func'](*task['args'], **task['kwargs'])
+                done_queue.put((task['id'], result, None))
+            except:
+                done_queue.put((task['id'], None, sys.exc_info()))
+
+        pending = [task for task in tasks if task['id'] not in up_to_date]
+        running = set()
+        finished = set(up_to_date)
+        memory_in_use = 0
+        error = None
+        while pending or running:
+            if error is None:
+                for task in list(pending):
+                    if len(running) >= self.n_workers:
+                        break
+                    if not task['dependencies'] <= finished:
+                        continue
+                    if (self.memory_limit is not None and running and
+                            memory_in_use + task['memory'] >
+                            self.memory_limit):
+                        continue
+                    LOGGER.debug('starting %s', task['name'])
+                    _start_task(task)
+                    pending.remove(task)
+                    running.add(task['id'])
+                    memory_in_use += task['memory']
+                    worker = threading.Thread(target=_run_task, args=(task,))
+                    worker.daemon = True
+                    worker.start()
+            if not running:
+                break
+
+            task_id, result, exc_info = done_queue.get()
+            running.remove(task_id)
+            finished.add(task_id)
+            memory_in_use -= tasks[task_id]['memory']
+            results[task_id] = result
+            if exc_info is None:
+                _finish_task(tasks[task_id])
+            elif error is None:
+                LOGGER.error('%s failed', tasks[task_id]['name'])
+                error = exc_info
+
+        if error is not None:
+            raise error[0], error[1], error[2]
+        return results
+
+    def _fingerprint_tasks(self, tasks):
+        """Fingerprints the cache_key and inputs of each task.
+
+        Returns:
+            a list of fingerprints indexed by task id, None for the tasks
+            that can't be cached"""
+
+        fingerprints = []
+        #the fingerprint of the last task to write each uri
+        writer_fingerprints = {}
+        for task in tasks:
+            fingerprint = None
+            if (self.stage_cache is not None and self.skip_up_to_date and
+                    task['cache_key'] is not None):
+                input_signatures = []
+                for uri in sorted(task['reads']):
+                    if uri in writer_fingerprints:
+                        input_signatures.append(
+                            [uri, writer_fingerprints[uri]])
+                    else:
+                        input_signatures.append([uri, _file_signature(uri)])
+                #an input written by a task that can't be cached could
+                #change at any time
+                if None not in [
+                        writer_fingerprints.get(uri, '')
+                        for uri in task['reads']]:
+                    fingerprint = hashlib.sha1(json.dumps(
+                        [self.stage_cache.version, task['func'].__name__,
+                         task['cache_key'], input_signatures],
+                        sort_keys=True, default=str)).hexdigest()
+            for uri in task['writes']:
+                writer_fingerprints[uri] = fingerprint
+            fingerprints.append(fingerprint)
+        return fingerprints
+
+    def _up_to_date_tasks(self, tasks, fingerprints):
+        """Finds the tasks that don't need to run: their outputs were all
+            written with their current fingerprint and haven't changed
+            since, and the outputs that aren't there anymore are neither
+            read by a later task that runs nor final outputs.
+
+        Returns:
+            a set of task ids"""
+
+        up_to_date = set()
+        #uris read by later tasks that run and uris written by later tasks
+        needed_uris = set()
+        overwritten_uris = set()
+        for task in reversed(tasks):
+            fingerprint = fingerprints[task['id']]
+            if fingerprint is not None and all(
+                    self.stage_cache.get(uri) == fingerprint and (
+                        os.path.exists(uri) or (
+                            uri not in needed_uris and
+                            uri in overwritten_uris))
+                    for uri in task['writes']):
+                up_to_date.add(task['id'])
+            else:
+                needed_uris |= task['reads']
+            overwritten_uris |= task['writes']
+        return up_to_date